@@ -14,6 +14,7 @@ a = Analysis(
         'PySide6.QtGui',
         'PySide6.QtCore',
         'PySide6.QtSvg',
+        'PySide6.QtNetwork',
         'winreg',
         'requests',
         'yaml',
@@ -15,29 +15,62 @@ import re
 import threading
 import socket
 import http.server
+import socketserver
 import argparse
 import winreg
+import io
+import gzip
 import json
+import marshal
+import pickle
+import base64
 import ctypes
+import functools
+import itertools
+import contextlib
+import hashlib
+import hmac
+import math
+import gc
+import secrets
+import time
+import tempfile
+import sqlite3
+import csv
+import asyncio
+import ipaddress
+import logging
+import logging.handlers
+from collections import deque
+from concurrent.futures import (
+    ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeout,
+)
 from datetime import datetime
-from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
+from types import MappingProxyType
+from urllib.parse import urlparse, parse_qs, urlencode, urlunparse, quote
 from pathlib import Path
 
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-    QLabel, QPushButton, QLineEdit, QTextEdit, QFrame, QDialog,
+    QLabel, QPushButton, QLineEdit, QPlainTextEdit, QFrame, QDialog,
     QMessageBox, QSystemTrayIcon, QMenu, QProgressBar,
-    QScrollArea, QStackedWidget,
+    QScrollArea, QStackedWidget, QFileDialog,
 )
 from PySide6.QtGui import (
-    QIcon, QPixmap, QColor, QPainter, QFont, QAction, QTextCursor,
+    QIcon, QPixmap, QColor, QPainter, QFont, QAction, QTextCursor, QTextCharFormat,
 )
-from PySide6.QtCore import Qt, QSize, QThread, Signal, QTimer, QRect
+from PySide6.QtCore import Qt, QSize, QThread, Signal, QTimer, QRect, QObject, QLockFile
+from PySide6.QtNetwork import QLocalServer, QLocalSocket
 
 import requests
 import yaml
 import qtawesome as qta
 
+try:
+    import orjson  # необязательно: без него JSON-вывод идёт через стандартный json
+except ImportError:
+    orjson = None
+
 # ─────────────────────────────────────────────
 # Константы
 # ─────────────────────────────────────────────
@@ -45,7 +78,12 @@ import qtawesome as qta
 APP_NAME = "Clash Config Manager"
 APP_VERSION = "2.0"
 DEFAULT_PORT = 8080
+PORT_RANGE = 20
+STALE_RETRY_SEC = 60
+JOB_DEADLINE = 60          # секунды на всю конвертацию
+DOWNLOAD_CHUNK = 64 * 1024
 AUTOSTART_KEY = r"Software\Microsoft\Windows\CurrentVersion\Run"
+SETTINGS_POLL_MS = 2000
 
 if getattr(sys, "frozen", False):
     APP_DIR = Path(sys.executable).parent
@@ -55,8 +93,17 @@ else:
 CONFIG_FILE   = APP_DIR / "app_config.json"
 OUTPUT_FILE   = APP_DIR / "clean.yaml"
 SUB_CACHE_FILE = APP_DIR / "sub_cache.json"
+LOG_FILE       = APP_DIR / "clash_app.log"
+
+LOG_CAPACITY     = 2000     # строк в окне лога, старые вытесняются
+LOG_FLUSH_MS     = 100      # строки копятся и выводятся пачкой
+LOG_FILE_MAX     = 1024 * 1024
+LOG_FILE_BACKUPS = 3
+
+# Ключи настроек, от которых зависит результат конвертации
+CONVERT_SETTINGS = ("url", "region_groups", "split_providers", "dns_prefetch", "dns_pin", "transform",
+                    "split_groups", "group_split_size", "latency_order", "json_output")
 
-SUPPORTED_TYPES       = {"vless", "vmess", "ss", "trojan", "hysteria2", "tuic", "wireguard"}
 SUPPORTED_GROUP_TYPES = {"select", "url-test", "fallback", "load-balance"}
 HIDDIFY_EXCLUDE       = "naive|shadowtls|ssh|mieru|xhttp|shadowsocks+shadowtls"
 
@@ -113,13 +160,15 @@ COLORS = {
 # Хелперы для qtawesome иконок
 # ─────────────────────────────────────────────
 
+@functools.lru_cache(maxsize=None)
 def _ico(name: str, color: str = COLORS["text"], size: int = 16) -> QIcon:
-    """Создаёт QIcon через qtawesome с нужным цветом."""
+    """Создаёт QIcon через qtawesome с нужным цветом. Кешируется."""
     return qta.icon(name, color=color)
 
 
+@functools.lru_cache(maxsize=None)
 def _px(name: str, color: str = COLORS["text"], size: int = 16) -> QPixmap:
-    """Создаёт QPixmap через qtawesome с нужным цветом и размером."""
+    """Создаёт QPixmap через qtawesome с нужным цветом и размером. Кешируется."""
     return qta.icon(name, color=color).pixmap(QSize(size, size))
 
 
@@ -141,77 +190,97 @@ def _make_fallback_pixmap(size: int) -> QPixmap:
     return px
 
 
+@functools.lru_cache(maxsize=None)
+def _icon_png() -> QPixmap | None:
+    """icon.png рядом со скриптом, декодируется один раз."""
+    icon_path = os.path.join(os.path.dirname(__file__), "icon.png")
+    if os.path.exists(icon_path):
+        pixmap = QPixmap(icon_path)
+        if not pixmap.isNull():
+            return pixmap
+    return None
+
+
+def _png_icon(fallback_size: int) -> QIcon:
+    pixmap = _icon_png()
+    if pixmap is None:
+        return QIcon(_make_fallback_pixmap(fallback_size))
+    icon = QIcon()
+    icon.addPixmap(pixmap)
+    return icon
+
+
+@functools.lru_cache(maxsize=None)
 def load_app_icon() -> QIcon:
     """
     Загружает главный значок приложения из файла icon.png
     (используется для заголовка окна и ярлыка программы).
     """
-    base = os.path.dirname(__file__)
-    icon_path = os.path.join(base, "icon.png")
-    if os.path.exists(icon_path):
-        pixmap = QPixmap(icon_path)
-        if not pixmap.isNull():
-            icon = QIcon()
-            icon.addPixmap(pixmap)
-            return icon
-    # если этого файла нет, пробуем icon.png
-    icon_path = os.path.join(base, "icon.png")
-    if os.path.exists(icon_path):
-        pixmap = QPixmap(icon_path)
-        if not pixmap.isNull():
-            icon = QIcon()
-            icon.addPixmap(pixmap)
-            return icon
-    return QIcon(_make_fallback_pixmap(256))
+    return _png_icon(256)
 
 
+@functools.lru_cache(maxsize=None)
 def load_taskbar_icon() -> QIcon:
     """
     Иконка для панели задач (Windows). Используется файл
     "icon.png" рядом со скриптом.
     """
-    icon_path = os.path.join(os.path.dirname(__file__), "icon.png")
-    if os.path.exists(icon_path):
-        pixmap = QPixmap(icon_path)
-        if not pixmap.isNull():
-            icon = QIcon()
-            icon.addPixmap(pixmap)
-            return icon
-    return QIcon(_make_fallback_pixmap(256))
+    return _png_icon(256)
 
 
+@functools.lru_cache(maxsize=None)
 def load_tray_icon() -> QIcon:
     """
     Иконка для системного трея  загружается из файла icon.png.
     """
-    icon_path = os.path.join(os.path.dirname(__file__), "icon.png")
-    
-    if os.path.exists(icon_path):
-        pixmap = QPixmap(icon_path)
-        if not pixmap.isNull():
-            icon = QIcon()
-            icon.addPixmap(pixmap)
-            return icon
-    
-    # Если иконка не найдена, используем fallback
-    return QIcon(_make_fallback_pixmap(48))
+    return _png_icon(48)
 
 
 # ─────────────────────────────────────────────
 # Глобальное состояние
 # ─────────────────────────────────────────────
 
-_sub_header    = ""
-_sub_info: dict = {}
+_STARTUP_T0    = time.perf_counter()
 _http_server   = None
 _server_running = False
 
+# Stale-while-revalidate: сервер отдаёт то, что есть, и просит одно обновление
+_stale_max_age   = 0       # секунды, 0 — выключено
+_refresh_lock    = threading.Lock()
+_refresh_inflight = False
+_refresh_retry_at = 0.0
+_on_stale = None           # вызывается из потока сервера, если конфиг устарел
+
 # ─────────────────────────────────────────────
 # Настройки
 # ─────────────────────────────────────────────
 
 def load_settings() -> dict:
-    defaults = {"url": "", "port": DEFAULT_PORT, "autostart": False}
+    defaults = {
+        "url": "", "port": DEFAULT_PORT, "port_range": PORT_RANGE, "autostart": False,
+        "refresh_interval": 0,  # минуты, 0 — только вручную и при запуске
+        "region_groups": False,
+        "split_providers": False,
+        "split_groups": False,
+        "group_split_size": 100,  # узлов в url-test/fallback группе до деления
+        "latency_order": False,
+        "controller": "",         # адрес Clash API; пусто — external-controller из конфига
+        "controller_secret": "",
+        "push_reload": False,     # сразу отправлять новый конфиг в Clash через API
+        "dns_prefetch": False,
+        "dns_pin": False,
+        "max_age": 0,  # минуты; запрос к устаревшему конфигу запускает обновление
+        "job_deadline": JOB_DEADLINE,
+        "log_file": False,  # дублировать лог в clash_app.log с ротацией
+        "transform": {},  # include/exclude/rename/group_max — см. ProxyTransform
+        "lan_mode": False,  # слушать все интерфейсы, см. «Доступ из локальной сети»
+        "lan_devices": {},  # имя устройства → токен
+        "lan_rate": LAN_RATE,
+        "record_upstream": False,  # сохранять ответы провайдера в fixtures/
+        "mirrors": {},  # URL подписки → список зеркал, см. race_mirrors
+        "rss_budget_mb": RSS_BUDGET_MB,  # 0 — не предупреждать
+        "json_output": False,  # писать конфиг минифицированным JSON вместо YAML
+    }
     try:
         if CONFIG_FILE.exists():
             with open(CONFIG_FILE, "r", encoding="utf-8") as f:
@@ -221,6 +290,13 @@ def load_settings() -> dict:
     return defaults
 
 
+def settings_mtime() -> int:
+    try:
+        return CONFIG_FILE.stat().st_mtime_ns
+    except OSError:
+        return 0
+
+
 def save_settings(settings: dict):
     try:
         with open(CONFIG_FILE, "w", encoding="utf-8") as f:
@@ -333,29 +409,421 @@ def prepare_url(url: str) -> str:
     return url
 
 
+def pack_blob(value) -> bytes | None:
+    """
+    Упаковывает данные в один непрерывный bytes. Десятки тысяч живых dict,
+    разбросанных среди освобождённого дерева разбора, не дают аллокатору
+    вернуть память — блоб не мешает.
+    """
+    if value is None:
+        return None
+    try:
+        return marshal.dumps(value)
+    except ValueError:
+        # в YAML бывают даты и прочие типы, которых marshal не знает
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def unpack_blob(blob: bytes):
+    if blob[:1] == pickle.PROTO:
+        return pickle.loads(blob)
+    return marshal.loads(blob)
+
+
+# ─────────────────────────────────────────────
+# Пользовательские правила (app_config.json → "transform")
+# ─────────────────────────────────────────────
+#
+# {
+#   "include":   [{"field": "name", "keyword": "HK"}, {"field": "server", "regex": "\\.jp$"}],
+#   "exclude":   [{"keyword": "剩余流量"}, {"field": "type", "regex": "^ss$"}],
+#   "rename":    [{"regex": "^\\[VIP\\]\\s*", "replace": ""}],
+#   "group_max": 50            # или {"Выбор": 100, "*": 50}
+# }
+#
+# field — name | type | server (по умолчанию name); keyword — подстрока без учёта регистра.
+# Узел остаётся, если include пуст или сработало хоть одно include-правило,
+# и не сработало ни одно exclude.
+
+TRANSFORM_FIELDS = ("name", "type", "server")
+_GLOBAL_FLAGS_RE = re.compile(r"^\(\?([aiLmsux]+)\)")
+# \1, \g<...>, (?P=...), (?(1)...) — ссылки на группы, сдвигаемые склейкой
+_GROUP_REF_RE = re.compile(r"(?<!\\)(?:\\\\)*\\(?:[1-9]|g<)|\(\?P=|\(\?\(")
+
+
+def _rule_pattern(rule: dict) -> str:
+    if "keyword" in rule:
+        return "(?i:" + re.escape(str(rule["keyword"])) + ")"
+    pattern = str(rule.get("regex", ""))
+    # (?i) в начале нельзя вставить внутрь общей альтернативы — делаем локальным
+    m = _GLOBAL_FLAGS_RE.match(pattern)
+    if m:
+        pattern = f"(?{m.group(1)}:{pattern[m.end():]})"
+    return pattern
+
+
+def _combinable(rx: re.Pattern) -> bool:
+    """
+    Правило без именованных групп и ссылок на группы можно склеить с
+    другими: в общей регулярке имена столкнутся, а номера групп сдвинутся.
+    """
+    return not rx.groupindex and not _GROUP_REF_RE.search(rx.pattern)
+
+
+def _rule_label(kind: str, rule: dict) -> str:
+    field = rule.get("field", "name")
+    if "keyword" in rule:
+        return f"{kind} {field} ~ «{rule['keyword']}»"
+    return f"{kind} {field} =~ /{rule.get('regex', '')}/"
+
+
+class ProxyTransform:
+    """
+    Скомпилированные правила. Все правила одного вида и поля собираются
+    в одну регулярку с именованными группами: на узел — один search на поле,
+    а по lastgroup видно, какое правило сработало. Правила со своими группами
+    и ссылками на них (см. _combinable) проверяются отдельной регуляркой.
+    """
+
+    def __init__(self, spec: dict):
+        self.labels: dict = {}
+        self.include = self._compile_matchers("include", spec.get("include") or [])
+        self.exclude = self._compile_matchers("exclude", spec.get("exclude") or [])
+        self.renames = []
+        for i, rule in enumerate(spec.get("rename") or []):
+            key = f"rename{i}"
+            self.labels[key] = f"rename /{rule.get('regex', '')}/"
+            try:
+                self.renames.append((key, re.compile(str(rule.get("regex", ""))),
+                                     str(rule.get("replace", ""))))
+            except re.error as e:
+                raise ValueError(f"Правило {self.labels[key]}: {e}") from None
+        # гейт — только ускорение: если правило не склеивается, обходимся без него
+        self.rename_gate = None
+        if self.renames and all(_combinable(r) for _k, r, _t in self.renames):
+            self.rename_gate = self._join(
+                [_rule_pattern({"regex": r.pattern}) for _k, r, _t in self.renames],
+                [k for k, _r, _t in self.renames])
+        group_max = spec.get("group_max") or {}
+        self.group_max = {"*": group_max} if isinstance(group_max, int) else dict(group_max)
+
+    def _join(self, parts: list, keys: list) -> re.Pattern:
+        try:
+            return re.compile("|".join(parts))
+        except re.error as e:
+            rules = ", ".join(self.labels[k] for k in keys)
+            raise ValueError(f"Правила {rules} не собираются в одну регулярку: {e}") from None
+
+    def _compile_matchers(self, kind: str, rules: list) -> tuple:
+        """((поле, регулярка, ключ правила или None — смотреть lastgroup), ...)"""
+        by_field: dict = {}
+        alone = []
+        for i, rule in enumerate(rules):
+            field = rule.get("field", "name")
+            if field not in TRANSFORM_FIELDS:
+                raise ValueError(f"Правило {kind}: неизвестное поле {field!r}")
+            key = f"{kind}{i}"
+            self.labels[key] = _rule_label(kind, rule)
+            pattern = _rule_pattern(rule)
+            try:
+                rx = re.compile(pattern)
+            except re.error as e:
+                raise ValueError(f"Правило {self.labels[key]}: {e}") from None
+            if _combinable(rx):
+                by_field.setdefault(field, []).append((key, f"(?P<{key}>{pattern})"))
+            else:
+                alone.append((field, rx, key))
+        joined = [(f, self._join([p for _k, p in parts], [k for k, _p in parts]), None)
+                  for f, parts in by_field.items()]
+        return tuple(joined + alone)
+
+    def accept(self, proxy: dict, hits: dict) -> bool:
+        if self.include:
+            for field, rx, key in self.include:
+                m = rx.search(str(proxy.get(field, "")))
+                if m:
+                    key = key or m.lastgroup
+                    hits[key] = hits.get(key, 0) + 1
+                    break
+            else:
+                return False
+        for field, rx, key in self.exclude:
+            m = rx.search(str(proxy.get(field, "")))
+            if m:
+                key = key or m.lastgroup
+                hits[key] = hits.get(key, 0) + 1
+                return False
+        return True
+
+    def rename(self, name: str, hits: dict) -> str:
+        if self.rename_gate is None or not self.rename_gate.search(name):
+            return name
+        for key, rx, repl in self.renames:
+            new, n = rx.subn(repl, name)
+            if n:
+                hits[key] = hits.get(key, 0) + 1
+                name = new
+        return name.strip() or name
+
+    def limit_groups(self, groups: list, proxy_names: set, hits: dict) -> list:
+        """Обрезает число узлов (не подгрупп) в группах по group_max."""
+        if not self.group_max:
+            return groups
+        default = self.group_max.get("*")
+        out = []
+        for g in groups:
+            limit = self.group_max.get(g.get("name"), default)
+            members = g.get("proxies", [])
+            if limit is None or sum(1 for p in members if p in proxy_names) <= limit:
+                out.append(g)
+                continue
+            kept, n = [], 0
+            for p in members:
+                if p in proxy_names:
+                    if n >= limit:
+                        continue
+                    n += 1
+                kept.append(p)
+            hits["group_max"] = hits.get("group_max", 0) + 1
+            out.append({**g, "proxies": kept})
+        self.labels.setdefault("group_max", "group_max (обрезано групп)")
+        return out
+
+    def report(self, hits: dict) -> list:
+        """[(описание правила, число срабатываний)] в порядке правил."""
+        return [(label, hits.get(key, 0)) for key, label in self.labels.items()]
+
+
+@functools.lru_cache(maxsize=8)
+def _compile_transform(spec_json: str) -> ProxyTransform:
+    return ProxyTransform(json.loads(spec_json))
+
+
+def get_transform(spec: dict | None) -> ProxyTransform | None:
+    """Компилирует правила один раз на уникальный spec."""
+    if not spec:
+        return None
+    return _compile_transform(json.dumps(spec, sort_keys=True, ensure_ascii=False))
+
+
+# ─────────────────────────────────────────────
+# Валидация прокси
+# ─────────────────────────────────────────────
+
+TYPE_ALIASES = {"shadowsocks": "ss", "hy2": "hysteria2", "wg": "wireguard"}
+
+# Поля, общие для всех протоколов
+_COMMON_REQUIRED = ("name", "server", "port")
+_COMMON_BOOL     = ("udp", "tls", "skip-cert-verify", "tfo")
+_COMMON_ALIASES  = {"allowInsecure": "skip-cert-verify", "insecure": "skip-cert-verify"}
+
+# Таблица схем: обязательные поля, типы и синонимы для каждого протокола.
+# any_of — достаточно хотя бы одного из полей.
+PROXY_SCHEMAS = {
+    "vless": {
+        "required": ("uuid",),
+        "bool":     ("reality",),
+        "aliases":  {"id": "uuid", "sni": "servername"},
+    },
+    "vmess": {
+        "required": ("uuid",),
+        "int":      ("alterId",),
+        "aliases":  {"id": "uuid", "aid": "alterId", "alter-id": "alterId",
+                     "sni": "servername", "security": "cipher"},
+        "defaults": {"cipher": "auto", "alterId": 0},
+    },
+    "ss": {
+        "required": ("cipher", "password"),
+        "aliases":  {"method": "cipher"},
+    },
+    "trojan": {
+        "required": ("password",),
+        "aliases":  {"servername": "sni"},
+    },
+    "hysteria2": {
+        "required": ("password",),
+        "aliases":  {"auth": "password", "auth-str": "password", "servername": "sni"},
+    },
+    "tuic": {
+        "any_of":   ("uuid", "token"),
+        "int":      ("request-timeout",),
+        "bool":     ("reduce-rtt", "disable-sni"),
+        "aliases":  {"servername": "sni"},
+    },
+    "wireguard": {
+        "required": ("private-key",),
+        "int":      ("mtu",),
+        "aliases":  {"privateKey": "private-key", "publicKey": "public-key"},
+    },
+}
+
+_TRUE_STRINGS  = {"true", "1", "yes", "on"}
+_FALSE_STRINGS = {"false", "0", "no", "off", ""}
+
+
+def _compile_validator(schema: dict):
+    """
+    Собирает из записи таблицы функцию проверки одного узла.
+    Все кортежи и словари считаются один раз, на узел остаются только
+    обращения к dict. Функция правит узел на месте и возвращает список ошибок.
+    """
+    aliases  = tuple({**_COMMON_ALIASES, **schema.get("aliases", {})}.items())
+    required = _COMMON_REQUIRED + tuple(schema.get("required", ()))
+    any_of   = tuple(schema.get("any_of", ()))
+    int_keys = tuple(schema.get("int", ()))
+    bool_keys = _COMMON_BOOL + tuple(schema.get("bool", ()))
+    defaults = tuple(schema.get("defaults", {}).items())
+
+    def check(proxy: dict) -> list:
+        errors = []
+        for src, dst in aliases:
+            if src in proxy:
+                val = proxy.pop(src)
+                if dst not in proxy:
+                    proxy[dst] = val
+        for key, val in defaults:
+            if key not in proxy:
+                proxy[key] = val
+        for key in required:
+            if proxy.get(key) in (None, ""):
+                errors.append(f"нет поля {key}")
+        if any_of and not any(proxy.get(k) not in (None, "") for k in any_of):
+            errors.append(f"нужно одно из полей: {', '.join(any_of)}")
+
+        port = proxy.get("port")
+        if port is not None and type(port) is not int:
+            try:
+                proxy["port"] = port = int(str(port).strip())
+            except ValueError:
+                errors.append(f"порт не число: {port!r}")
+                port = None
+        if type(port) is int and not 0 < port < 65536:
+            errors.append(f"порт вне диапазона: {port}")
+
+        for key in int_keys:
+            val = proxy.get(key)
+            if val is not None and type(val) is not int:
+                try:
+                    proxy[key] = int(str(val).strip())
+                except ValueError:
+                    errors.append(f"{key} не число: {val!r}")
+        for key in bool_keys:
+            val = proxy.get(key)
+            if val is None or type(val) is bool:
+                continue
+            s = str(val).strip().lower()
+            if s in _TRUE_STRINGS:
+                proxy[key] = True
+            elif s in _FALSE_STRINGS:
+                proxy[key] = False
+            else:
+                errors.append(f"{key} не bool: {val!r}")
+        return errors
+
+    return check
+
+
+_VALIDATORS = {t: _compile_validator(s) for t, s in PROXY_SCHEMAS.items()}
+
+
 def normalize_proxy(proxy: dict) -> dict:
     proxy.pop("transport", None)
     return proxy
 
 
-def filter_proxies(proxies: list) -> tuple:
-    kept, removed = [], {}
+def filter_proxies(proxies: list, transform: ProxyTransform | None = None,
+                   hits: dict | None = None) -> tuple:
+    """
+    Отбирает поддерживаемые и валидные узлы, применяя пользовательские правила
+    в том же проходе. Возвращает (kept, removed, invalid, renamed):
+    removed — счётчик по неподдерживаемым типам и правилам, invalid — список
+    (имя, [ошибки]), renamed — {исходное имя: итоговое} для ссылок из групп.
+    """
+    kept, removed, invalid, renamed = [], {}, [], {}
+    used = set()
+    hits = {} if hits is None else hits
+    validators = _VALIDATORS
     for proxy in proxies:
         if not isinstance(proxy, dict):
             continue
         pt = str(proxy.get("type", "")).lower()
-        if pt in SUPPORTED_TYPES:
-            if "name" in proxy:
-                proxy["name"] = clean_name(str(proxy["name"]))
-            kept.append(normalize_proxy(proxy))
-        else:
+        pt = TYPE_ALIASES.get(pt, pt)
+        check = validators.get(pt)
+        if check is None:
             removed[pt] = removed.get(pt, 0) + 1
-    return kept, removed
+            continue
+        proxy["type"] = pt
+        original = str(proxy["name"]) if "name" in proxy else None
+        if original is not None:
+            proxy["name"] = clean_name(original)
+        # include/exclude смотрят на имя до переименования
+        if transform is not None:
+            if not transform.accept(proxy, hits):
+                removed["правила"] = removed.get("правила", 0) + 1
+                continue
+            if original is not None:
+                name = transform.rename(proxy["name"], hits)
+                if name in used:
+                    base, i = name, 2
+                    while name in used:
+                        name, i = f"{base} {i}", i + 1
+                proxy["name"] = name
+        errors = check(proxy)
+        if errors:
+            invalid.append((str(proxy.get("name", "?")), errors))
+            continue
+        # псевдоним только для оставшихся узлов: иначе группа сошлётся
+        # на отброшенный узел или на чужой с тем же итоговым именем
+        if original is not None and proxy["name"] != original:
+            renamed.setdefault(original, proxy["name"])
+        used.add(proxy.get("name"))
+        kept.append(normalize_proxy(proxy))
+    return kept, removed, invalid, renamed
+
+
+# Поля, определяющие подключение. Имя узла в отпечаток не входит.
+FINGERPRINT_FIELDS = (
+    "type", "server", "port", "ports",
+    "uuid", "alterId", "password", "cipher", "token", "private-key", "public-key",
+    "pre-shared-key",
+    "tls", "sni", "servername", "flow", "alpn", "client-fingerprint", "reality-opts",
+    "network", "ws-opts", "grpc-opts", "h2-opts", "http-opts",
+    "obfs", "obfs-password", "plugin", "plugin-opts",
+)
+
+
+def _freeze(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return value
+
 
+def proxy_fingerprint(proxy: dict) -> tuple:
+    """Хешируемый отпечаток узла по полям подключения."""
+    return tuple((k, _freeze(proxy[k])) for k in FINGERPRINT_FIELDS if k in proxy)
 
-def process_groups(groups: list, valid_proxy_names: set) -> list:
+
+def dedup_proxies(proxies: list) -> tuple:
+    """
+    Оставляет по одному узлу на отпечаток (первый встреченный).
+    Возвращает (kept, alias_map), где alias_map — {имя дубля: имя оставшегося}.
+    """
+    seen, kept, alias_map = {}, [], {}
+    for proxy in proxies:
+        fp = proxy_fingerprint(proxy)
+        survivor = seen.get(fp)
+        if survivor is None:
+            seen[fp] = str(proxy.get("name", ""))
+            kept.append(proxy)
+        else:
+            alias_map[str(proxy.get("name", ""))] = survivor
+    return kept, alias_map
+
+
+def process_groups(groups: list, valid_proxy_names: set, alias_map: dict | None = None) -> list:
     if not groups:
         return []
+    alias_map = alias_map or {}
     rename_map = {
         str(g.get("name", "")): translate_group_name(str(g.get("name", "")))
         for g in groups if isinstance(g, dict)
@@ -372,6 +840,7 @@ def process_groups(groups: list, valid_proxy_names: set) -> list:
         new_list = []
         for item in group.get("proxies", []) or []:
             s = str(item)
+            s = alias_map.get(s, s)
             if s in valid_proxy_names:
                 new_list.append(s)
             elif s in rename_map:
@@ -380,6 +849,9 @@ def process_groups(groups: list, valid_proxy_names: set) -> list:
                 new_list.append(s)
             elif s in ("DIRECT", "REJECT"):
                 new_list.append(s)
+        if alias_map:
+            # после подмены дублей в списке могут появиться повторы
+            new_list = list(dict.fromkeys(new_list))
         if gt in ("fallback", "url-test", "load-balance"):
             new_list = [p for p in new_list if p not in ("DIRECT", "REJECT")]
         if any(p not in ("DIRECT", "REJECT") for p in new_list):
@@ -400,147 +872,3154 @@ def find_main_group(groups: list) -> str:
     return groups[0]["name"] if groups else "Выбор"
 
 
-def process_config(data: dict):
-    result = {}
-    for key in ("port", "socks-port", "mixed-port", "redir-port", "allow-lan",
-                "bind-address", "mode", "log-level", "external-controller",
-                "dns", "tun", "ipv6", "unified-delay", "tcp-concurrent",
-                "global-client-fingerprint", "geodata-mode", "geox-url",
-                "geo-auto-update", "geo-update-interval"):
-        if key in data:
-            result[key] = data[key]
-
-    clean_proxies, removed = filter_proxies(data.get("proxies", []) or [])
-    result["proxies"] = clean_proxies
-    valid_names = {str(p["name"]) for p in clean_proxies if "name" in p}
-    clean_groups = process_groups(data.get("proxy-groups", []) or [], valid_names)
-    result["proxy-groups"] = clean_groups
-    main_group = find_main_group(clean_groups)
-    result["rules"] = list(LOCAL_RULES) + [f"MATCH,{main_group}"]
-    return result, removed, len(clean_proxies), len(clean_groups), main_group
+# ─────────────────────────────────────────────
+# Группы по регионам
+# ─────────────────────────────────────────────
+
+# Код региона → (название группы, ключевые слова на ru/en/zh)
+REGIONS = {
+    "HK": ("Гонконг",        ("гонконг", "hong kong", "hongkong", "香港")),
+    "JP": ("Япония",         ("япони", "japan", "tokyo", "osaka", "日本", "东京")),
+    "SG": ("Сингапур",       ("сингапур", "singapore", "新加坡", "狮城")),
+    "TW": ("Тайвань",        ("тайван", "taiwan", "台湾", "台灣")),
+    "US": ("США",            ("сша", "united states", "美国", "美國")),
+    "KR": ("Корея",          ("коре", "korea", "seoul", "韩国", "韓國")),
+    "GB": ("Великобритания", ("великобритан", "англи", "лондон", "united kingdom",
+                              "britain", "england", "london", "英国")),
+    "DE": ("Германия",       ("герман", "франкфурт", "germany", "frankfurt", "德国")),
+    "FR": ("Франция",        ("франци", "париж", "france", "paris", "法国")),
+    "RU": ("Россия",         ("росси", "москв", "russia", "moscow", "俄罗斯")),
+    "NL": ("Нидерланды",     ("нидерланд", "голланд", "амстердам", "netherlands",
+                              "holland", "amsterdam", "荷兰")),
+    "CA": ("Канада",         ("канад", "canada", "加拿大")),
+    "AU": ("Австралия",      ("австрали", "australia", "澳大利亚", "澳洲")),
+    "IN": ("Индия",          ("инди", "india", "印度")),
+    "TR": ("Турция",         ("турци", "turkey", "türkiye", "istanbul", "土耳其")),
+    "BR": ("Бразилия",       ("бразили", "brazil", "巴西")),
+    "AR": ("Аргентина",      ("аргентин", "argentina", "阿根廷")),
+    "FI": ("Финляндия",      ("финлянд", "finland", "helsinki", "芬兰")),
+    "SE": ("Швеция",         ("швеци", "sweden", "stockholm", "瑞典")),
+    "PL": ("Польша",         ("польш", "poland", "warsaw", "波兰")),
+    "KZ": ("Казахстан",      ("казахстан", "kazakhstan", "哈萨克斯坦")),
+    "UA": ("Украина",        ("украин", "ukraine", "乌克兰")),
+    "LV": ("Латвия",         ("латви", "latvia", "riga", "拉脱维亚")),
+    "EE": ("Эстония",        ("эстони", "estonia", "tallinn", "爱沙尼亚")),
+    "CH": ("Швейцария",      ("швейцари", "switzerland", "zurich", "瑞士")),
+    "AE": ("ОАЭ",            ("оаэ", "эмират", "дубай", "emirates", "dubai", "阿联酋", "迪拜")),
+    "ES": ("Испания",        ("испани", "spain", "madrid", "西班牙")),
+    "IT": ("Италия",         ("итали", "italy", "milan", "意大利")),
+}
+ISO_ALIASES = {"UK": "GB", "USA": "US"}
+
+REGION_TEST_URL = "http://www.gstatic.com/generate_204"
+
+
+def _trie_pattern(words) -> str:
+    """Регулярка с общими префиксами, вынесенными в дерево (a(?:bc|d) вместо abc|ad)."""
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def emit(node: dict) -> str:
+        end = "" in node
+        branches = [re.escape(ch) + emit(sub) for ch, sub in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if end:
+            body = "(?:" + body + ")?"
+        return body
+
+    return emit(trie)
+
+
+# Окончания после русских основ: основа на -и/-е (инди, коре) склоняется
+# как Индия, остальные — как Канада, Тайвань, Эмираты. Только из этого
+# списка, иначе «инди» находится в «Индивидуальный», а «коре» — в «Коренной».
+_CYRILLIC_SOFT_ENDINGS = r"(?:я|и|ю|ей|йск[а-яё]*)"
+_CYRILLIC_ENDINGS = (r"(?:а|е|и|у|ы|ю|я|ь|ов|ах|ам|ами|ом|ой|ей|ем|ия|ии|ию|ией"
+                     r"|ь?ск[а-яё]*)?")
+
+
+def _build_region_matcher():
+    """
+    Латинские названия — целыми словами (India не найдётся в Indiana),
+    русские основы — с одним из известных окончаний (франци: Франция,
+    Франции), иероглифы пишутся слитно и границ слов не имеют.
+    """
+    words = {}
+    scripts: dict = {"latin": [], "cyrillic": [], "cyrillic_soft": [], "word": []}
+    for code, (_ru, keywords) in REGIONS.items():
+        for kw in keywords:
+            kw = kw.lower()
+            words[kw] = code
+            if re.search("[а-яё]", kw):
+                scripts["cyrillic_soft" if kw[-1] in "ие" else "cyrillic"].append(kw)
+            elif re.match("[a-zà-ÿ]", kw):
+                scripts["latin"].append(kw)
+            else:
+                scripts["word"].append(kw)
+    codes = sorted(set(REGIONS) | set(ISO_ALIASES), key=len, reverse=True)
+    pattern = (
+        r"(?P<flag>[🇦-🇿]{2})"
+        r"|(?<![A-Za-z])(?P<iso>" + "|".join(codes) + r")(?![A-Za-z])"
+        r"|(?<![A-Za-z])(?i:(?P<latin>" + _trie_pattern(scripts["latin"]) + r"))(?![A-Za-z])"
+        r"|(?<![а-яёА-ЯЁ])(?i:(?P<cyrillic>" + _trie_pattern(scripts["cyrillic"]) + r")"
+        + _CYRILLIC_ENDINGS
+        + r"|(?P<cyrillic_soft>" + _trie_pattern(scripts["cyrillic_soft"]) + r")"
+        + _CYRILLIC_SOFT_ENDINGS + r")(?![а-яёА-ЯЁ])"
+        r"|(?P<word>" + _trie_pattern(scripts["word"]) + r")"
+    )
+    return re.compile(pattern), words
+
+
+_REGION_RE, _REGION_WORDS = _build_region_matcher()
+
+
+@functools.lru_cache(maxsize=131072)
+def classify_region(name: str) -> str | None:
+    """
+    Определяет код региона по имени узла: флаг, ISO-код или название страны.
+    Первое совпадение с известным регионом, так что флаг без своей группы
+    (🇺🇳 Hong Kong) не заслоняет название дальше в имени. Результат
+    кешируется до release_memory().
+    """
+    for m in _REGION_RE.finditer(name):
+        kind = m.lastgroup
+        if kind == "flag":
+            code = "".join(chr(ord(c) - 0x1F1E6 + ord("A")) for c in m.group("flag"))
+            if code in REGIONS:
+                return code
+        elif kind == "iso":
+            return ISO_ALIASES.get(m.group("iso"), m.group("iso"))
+        else:
+            return _REGION_WORDS.get(m.group(kind).lower())
+    return None
+
+
+def proxy_regions(proxies: list, raw_names: dict) -> dict:
+    """
+    {имя узла: код региона или None}.
+    raw_names — {итоговое имя: исходное}: флаги из имён убирает clean_name,
+    поэтому классифицируем по имени до очистки.
+    """
+    regions = {}
+    for proxy in proxies:
+        name = str(proxy.get("name", ""))
+        regions[name] = classify_region(raw_names.get(name) or name)
+    return regions
+
+
+def build_region_groups(proxies: list, regions: dict, groups: list) -> list:
+    """
+    Собирает url-test группы по регионам и добавляет их в главную select-группу.
+    regions — результат proxy_regions. Возвращает новый список групп.
+    """
+    by_region: dict = {}
+    for proxy in proxies:
+        name = str(proxy["name"])
+        code = regions.get(name)
+        if code:
+            by_region.setdefault(code, []).append(name)
+
+    existing = {g.get("name") for g in groups}
+    region_groups = []
+    for code in REGIONS:
+        members = by_region.get(code)
+        name = REGIONS[code][0]
+        if not members or name in existing:
+            continue
+        region_groups.append({
+            "name": name, "type": "url-test", "proxies": members,
+            "url": REGION_TEST_URL, "interval": 300, "tolerance": 50,
+        })
+    if not region_groups:
+        return groups
+
+    region_names = [g["name"] for g in region_groups]
+    groups = list(groups)
+    main = find_main_group(groups) if groups else None
+    for i, g in enumerate(groups):
+        if g.get("name") == main and g.get("type") == "select":
+            groups[i] = {**g, "proxies": region_names + list(g.get("proxies", []))}
+            break
+    else:
+        all_names = [str(p["name"]) for p in proxies]
+        groups.insert(0, {"name": "Выбор", "type": "select", "proxies": region_names + all_names})
+    return groups + region_groups
+
+
+# ─────────────────────────────────────────────
+# Деление больших групп с проверкой задержки
+# ─────────────────────────────────────────────
+#
+# Ядро Clash проверяет каждый узел url-test/fallback/load-balance группы раз
+# в interval. Группа на тысячи узлов — это тысячи запросов за интервал.
+# Большая группа делится на подгруппы не больше GROUP_SPLIT_SIZE узлов (сначала
+# по регионам, затем ровными кусками), подгруппы — под родителем того же
+# типа; если подгрупп самих слишком много, добавляется ещё уровень.
+# interval подгрупп растёт как √n от размера исходной группы, поэтому число
+# проверок в секунду растёт как √n, а не линейно (до потолка _MAX_INTERVAL).
+
+GROUP_SPLIT_SIZE  = 100
+HEALTH_CHECK_TYPES = ("url-test", "fallback", "load-balance")
+_BASE_INTERVAL    = 300    # секунды для группы до _BASE_GROUP_SIZE узлов
+_BASE_GROUP_SIZE  = 50
+_MAX_INTERVAL     = 3600
+
+
+def tune_group(group: dict, size: int) -> dict:
+    """interval/tolerance/lazy по размеру группы; значения провайдера не уменьшает."""
+    g = dict(group)
+    scale = math.sqrt(max(size, 1) / _BASE_GROUP_SIZE)
+    interval = min(int(_BASE_INTERVAL * max(scale, 1.0)), _MAX_INTERVAL)
+    g["interval"] = max(int(g.get("interval") or 0), interval)
+    if g.get("type") == "url-test":
+        tolerance = 50 + int(25 * math.log2(max(scale, 1.0)))
+        g["tolerance"] = max(int(g.get("tolerance") or 0), tolerance)
+    g.setdefault("lazy", True)
+    g.setdefault("url", REGION_TEST_URL)
+    return g
+
+
+def _balanced_chunks(items: list, max_size: int) -> list:
+    """Ровные куски не больше max_size: 250 при 100 → 84/83/83, а не 100/100/50."""
+    count = -(-len(items) // max_size)
+    size, extra = divmod(len(items), count)
+    chunks, start = [], 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+def _split_members(name: str, members: list, regions: dict, max_size: int,
+                   sub_type: str, taken: set, out: list, total: int) -> list:
+    """
+    Режет members на подгруппы (добавляя их в out); возвращает их имена.
+    interval подгрупп считается по total — числу узлов всей исходной группы.
+    """
+    buckets: dict = {}
+    for member in members:
+        buckets.setdefault(regions.get(member) or "", []).append(member)
+    names = []
+    for code, items in buckets.items():
+        label = REGIONS[code][0] if code in REGIONS else "прочие"
+        if len(buckets) == 1 and len(items) > max_size:
+            label = ""
+        chunks = _balanced_chunks(items, max_size)
+        for i, chunk in enumerate(chunks, 1):
+            sub_name = " · ".join(p for p in (name, label, str(i) if len(chunks) > 1 else "") if p)
+            base, n = sub_name, 2
+            while sub_name in taken:
+                sub_name, n = f"{base} ({n})", n + 1
+            taken.add(sub_name)
+            out.append(tune_group({"name": sub_name, "type": sub_type, "proxies": chunk},
+                                  total))
+            names.append(sub_name)
+    if len(names) > max_size:
+        # подгрупп больше лимита — ещё один уровень, уже без деления по регионам
+        return _split_members(name, names, {}, max_size, sub_type, taken, out, len(names))
+    return names
+
+
+def split_large_groups(groups: list, proxy_names: set, regions: dict,
+                       max_size: int = GROUP_SPLIT_SIZE) -> tuple:
+    """
+    Делит группы с проверкой задержки, в которых больше max_size узлов,
+    и подстраивает interval/tolerance/lazy у всех таких групп.
+    Возвращает (groups, число разделённых групп).
+    """
+    max_size = max(int(max_size), 2)
+    taken = {g.get("name") for g in groups}
+    result, subgroups, split = [], [], 0
+    for group in groups:
+        if group.get("type") not in HEALTH_CHECK_TYPES:
+            result.append(group)
+            continue
+        members = list(group.get("proxies", []))
+        nodes = [p for p in members if p in proxy_names]
+        if len(nodes) <= max_size:
+            result.append(tune_group(group, len(members)))
+            continue
+        sub_type = "load-balance" if group["type"] == "load-balance" else "url-test"
+        names = _split_members(str(group["name"]), nodes, regions, max_size,
+                               sub_type, taken, subgroups, len(nodes))
+        others = [p for p in members if p not in proxy_names]
+        result.append(tune_group({**group, "proxies": others + names},
+                                 len(others) + len(names)))
+        split += 1
+    return result + subgroups, split
+
+
+# ─────────────────────────────────────────────
+# Задержки узлов из external-controller
+# ─────────────────────────────────────────────
+#
+# "latency_order": true — перед конвертацией спрашиваем у запущенного Clash
+# (REST API) задержки узлов текущего конфига и копим историю по отпечатку
+# узла в latency.json. По ней select-группы сортируются от быстрых к
+# медленным, а узлы, раз за разом не отвечающие, уходят в конец всех групп.
+
+LATENCY_FILE        = APP_DIR / "latency.json"
+LATENCY_HISTORY     = 10    # замеров на узел
+LATENCY_DEAD_STREAK = 3     # столько неудач подряд — узел в конец групп
+LATENCY_CONCURRENCY = 16
+LATENCY_PROBES      = 200   # активных замеров за раз; остальное — из истории ядра
+LATENCY_BUDGET      = 15    # секунд на сбор
+LATENCY_TIMEOUT_MS  = 5000
+
+
+def fingerprint_key(proxy: dict) -> str:
+    """Короткий устойчивый ключ отпечатка — переживает переименование узла."""
+    return hashlib.sha1(repr(proxy_fingerprint(proxy)).encode("utf-8")).hexdigest()[:16]
+
+
+class LatencyHistory:
+    """
+    nodes: {ключ: {"d": [задержки, 0 — не ответил], "t": время последнего
+    замера ядра}}; names: {имя в отданном конфиге: ключ} — чтобы сопоставить
+    имена из API с отпечатками (после подстановки IP отпечаток уже другой).
+    """
+
+    def __init__(self, data: dict | None = None):
+        data = data or {}
+        self.nodes: dict = data.get("nodes", {})
+        self.names: dict = data.get("names", {})
+        # растёт с каждым изменением nodes — дешёвый ключ кеша этапа order
+        self.version: int = data.get("version", 0)
+
+    @classmethod
+    def load(cls) -> "LatencyHistory":
+        try:
+            with open(LATENCY_FILE, "r", encoding="utf-8") as f:
+                return cls(json.load(f))
+        except (OSError, ValueError):
+            return cls()
+
+    def save(self):
+        # ключи узлов, которых давно нет в конфиге, не копим
+        live = set(self.names.values())
+        nodes = {k: v for k, v in self.nodes.items() if k in live}
+        if len(nodes) != len(self.nodes):
+            self.nodes = nodes
+            self.version += 1
+        write_if_changed(LATENCY_FILE, json.dumps(
+            {"nodes": self.nodes, "names": self.names, "version": self.version},
+            ensure_ascii=False, separators=(",", ":")))
+
+    def record(self, key: str, delay: int, stamp=None):
+        node = self.nodes.setdefault(key, {"d": [], "t": None})
+        if stamp is not None:
+            if node["t"] == stamp:
+                return False
+            node["t"] = stamp
+        node["d"] = (node["d"] + [int(delay)])[-LATENCY_HISTORY:]
+        self.version += 1
+        return True
+
+    def score(self, key: str) -> tuple:
+        """(мёртв, медиана живых замеров); узлы без истории — посередине."""
+        samples = self.nodes.get(key, {}).get("d") or []
+        dead = len(samples) >= LATENCY_DEAD_STREAK and not any(samples[-LATENCY_DEAD_STREAK:])
+        alive = sorted(d for d in samples if d > 0)
+        median = alive[len(alive) // 2] if alive else float("inf") if samples else None
+        return dead, median
+
+
+class ClashController:
+    """Клиент REST API ядра: /proxies и /proxies/<имя>/delay."""
+
+    def __init__(self, address: str, secret: str = "", timeout: float = 5.0):
+        address = str(address).strip()
+        if address.startswith(":"):
+            address = "127.0.0.1" + address
+        if "://" not in address:
+            address = "http://" + address
+        self.base = address.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        if secret:
+            self.session.headers["Authorization"] = f"Bearer {secret}"
+
+    def proxies(self) -> dict:
+        resp = self.session.get(f"{self.base}/proxies", timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.json().get("proxies", {})
+
+    def delay(self, name: str, url: str = REGION_TEST_URL,
+              timeout_ms: int = LATENCY_TIMEOUT_MS) -> int:
+        """Задержка в мс; 0 — узел не ответил."""
+        try:
+            resp = self.session.get(
+                f"{self.base}/proxies/{quote(name, safe='')}/delay",
+                params={"url": url, "timeout": timeout_ms},
+                timeout=timeout_ms / 1000 + 2,
+            )
+        except requests.exceptions.RequestException:
+            return 0
+        if resp.status_code != 200:
+            return 0
+        return int(resp.json().get("delay") or 0)
+
+    def reload_config(self, payload: str, timeout: float):
+        """PUT /configs: ядро применяет переданный конфиг целиком."""
+        resp = self.session.put(f"{self.base}/configs", params={"force": "true"},
+                                json={"path": "", "payload": payload}, timeout=timeout)
+        resp.raise_for_status()
+
+    def update_provider(self, name: str, timeout: float):
+        """PUT /providers/proxies/<имя>: ядро перекачивает провайдер с нашего сервера."""
+        resp = self.session.put(f"{self.base}/providers/proxies/{quote(name, safe='')}",
+                                timeout=timeout)
+        resp.raise_for_status()
+
+
+def collect_delays(controller: ClashController, history: LatencyHistory,
+                   budget: float = LATENCY_BUDGET, concurrency: int = LATENCY_CONCURRENCY,
+                   max_probes: int = LATENCY_PROBES) -> dict:
+    """
+    Пополняет history. Сначала берёт последние проверки самого ядра из
+    /proxies (один запрос на все узлы), узлы без них меряет через /delay —
+    не больше max_probes и не дольше budget секунд.
+    Возвращает {"passive", "probed", "dead", "skipped"}.
+    """
+    deadline = time.monotonic() + budget
+    info = controller.proxies()
+    stats = {"passive": 0, "probed": 0, "dead": 0, "skipped": 0}
+    to_probe = []
+    for name, key in history.names.items():
+        node = info.get(name)
+        if node is None:
+            continue
+        checks = node.get("history") or []
+        if checks:
+            last = checks[-1]
+            delay = int(last.get("delay") or 0) if node.get("alive", True) else 0
+            if history.record(key, delay, stamp=last.get("time")):
+                stats["passive"] += 1
+                stats["dead"] += delay == 0
+        else:
+            to_probe.append((name, key))
+
+    stats["skipped"] = max(len(to_probe) - max_probes, 0)
+    to_probe = to_probe[:max_probes]
+    if to_probe:
+        pool = ThreadPoolExecutor(max_workers=concurrency)
+        futures = {pool.submit(controller.delay, name): key for name, key in to_probe}
+        try:
+            for fut in as_completed(futures, timeout=max(deadline - time.monotonic(), 0.1)):
+                delay = fut.result()
+                history.record(futures[fut], delay)
+                stats["probed"] += 1
+                stats["dead"] += delay == 0
+        except FuturesTimeout:
+            stats["skipped"] += len(to_probe) - stats["probed"]
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+    return stats
+
+
+def order_by_latency(groups: list, name_keys: dict, history: LatencyHistory) -> tuple:
+    """
+    select-группы: сначала не-узлы (группы, DIRECT) в прежнем порядке, затем
+    узлы от быстрых к медленным. Во всех группах мёртвые узлы — в конец.
+    Возвращает (groups, число узлов, ушедших в конец).
+    """
+    scores = {name: history.score(key) for name, key in name_keys.items()}
+    dead = {name for name, (is_dead, _m) in scores.items() if is_dead}
+    result = []
+    for group in groups:
+        members = list(group.get("proxies", []))
+        if group.get("type") == "select":
+            others = [m for m in members if m not in scores]
+            nodes = [m for m in members if m in scores]
+            # без истории — после измеренных живых, но перед недавно не ответившими (inf)
+            nodes.sort(key=lambda m: (m in dead, 10 ** 6 if scores[m][1] is None
+                                      else scores[m][1]))
+            members = others + nodes
+        elif dead:
+            members = [m for m in members if m not in dead] + [m for m in members if m in dead]
+        result.append({**group, "proxies": members})
+    return result, len(dead)
+
+
+# ─────────────────────────────────────────────
+# Конвейер process_config
+# ─────────────────────────────────────────────
+#
+# process_config — цепочка этапов с явными входами. Выход этапа кешируется
+# (блобом) под хешем ключей входов и значений настроек, которые этап читает.
+# Смена, например, group_split_size пересчитывает только split, а фильтрация
+# 50k узлов и группы берутся из кеша. Хранится по одному результату на этап.
+
+PASSTHROUGH_KEYS = (
+    "port", "socks-port", "mixed-port", "redir-port", "allow-lan",
+    "bind-address", "mode", "log-level", "external-controller",
+    "dns", "tun", "ipv6", "unified-delay", "tcp-concurrent",
+    "global-client-fingerprint", "geodata-mode", "geox-url",
+    "geo-auto-update", "geo-update-interval",
+)
+
+
+def _need_regions(options: dict) -> bool:
+    return bool(options.get("region_groups") or options.get("split_providers")
+                or options.get("split_groups"))
+
+
+def _stage_base(inp: dict, options: dict):
+    data = inp["source"]
+    return {key: data[key] for key in PASSTHROUGH_KEYS if key in data}
+
+
+def _stage_proxies(inp: dict, options: dict):
+    raw_proxies = inp["source"].get("proxies", []) or []
+    raw_names = {id(p): str(p.get("name", "")) for p in raw_proxies if isinstance(p, dict)}
+    transform = get_transform(options.get("transform"))
+    hits: dict = {}
+    kept, removed, invalid, renamed = filter_proxies(raw_proxies, transform, hits)
+    kept, alias_map = dedup_proxies(kept)
+    duplicates = len(alias_map)
+    # группы ссылаются на исходные имена: исходное → итоговое → оставшийся дубль
+    for old, new in renamed.items():
+        alias_map.setdefault(old, alias_map.get(new, new))
+    return {
+        "proxies": kept, "removed": removed, "invalid": invalid,
+        "alias_map": alias_map, "duplicates": duplicates, "hits": hits,
+        "raw_names": {str(p["name"]): raw_names[id(p)] for p in kept
+                      if "name" in p and id(p) in raw_names},
+    }
+
+
+def _valid_names(proxies: dict) -> set:
+    return {str(p["name"]) for p in proxies["proxies"] if "name" in p}
+
+
+def _stage_regions(inp: dict, options: dict):
+    if not _need_regions(options):
+        return {}
+    return proxy_regions(inp["proxies"]["proxies"], inp["proxies"]["raw_names"])
+
+
+def _stage_groups(inp: dict, options: dict):
+    return process_groups(inp["source"].get("proxy-groups", []) or [],
+                          _valid_names(inp["proxies"]), inp["proxies"]["alias_map"])
+
+
+def _stage_region_groups(inp: dict, options: dict):
+    if not options.get("region_groups"):
+        return inp["groups"]
+    return build_region_groups(inp["proxies"]["proxies"], inp["regions"], inp["groups"])
+
+
+def _stage_order(inp: dict, options: dict):
+    latency = inp["latency"]
+    if latency is None:
+        return {"groups": inp["region_groups"], "name_keys": {}, "demoted": 0}
+    name_keys = {str(p["name"]): fingerprint_key(p) for p in inp["proxies"]["proxies"]
+                 if "name" in p}
+    groups, demoted = order_by_latency(inp["region_groups"], name_keys, latency)
+    return {"groups": groups, "name_keys": name_keys, "demoted": demoted}
+
+
+def _stage_limit(inp: dict, options: dict):
+    hits = dict(inp["proxies"]["hits"])
+    groups = inp["order"]["groups"]
+    transform = get_transform(options.get("transform"))
+    if transform is not None:
+        groups = transform.limit_groups(groups, _valid_names(inp["proxies"]), hits)
+    return {"groups": groups, "hits": hits}
+
+
+def _stage_split(inp: dict, options: dict):
+    groups = inp["limit"]["groups"]
+    if not options.get("split_groups"):
+        return {"groups": groups, "split": 0}
+    groups, split = split_large_groups(
+        groups, _valid_names(inp["proxies"]), inp["regions"],
+        options.get("group_split_size") or GROUP_SPLIT_SIZE,
+    )
+    return {"groups": groups, "split": split}
+
+
+# этап → (входы, настройки, функция); "source" и "latency" — внешние входы
+PIPELINE = {
+    "base":          (("source",), (), _stage_base),
+    "proxies":       (("source",), ("transform",), _stage_proxies),
+    "regions":       (("proxies",), ("region_groups", "split_providers", "split_groups"),
+                      _stage_regions),
+    "groups":        (("source", "proxies"), (), _stage_groups),
+    "region_groups": (("groups", "proxies", "regions"), ("region_groups",),
+                      _stage_region_groups),
+    "order":         (("region_groups", "proxies", "latency"), (), _stage_order),
+    "limit":         (("order", "proxies"), ("transform",), _stage_limit),
+    "split":         (("limit", "proxies", "regions"), ("split_groups", "group_split_size"),
+                      _stage_split),
+}
+
+# В памяти — только ключи; выходы этапов лежат блобами в STAGE_CACHE_DIR,
+# по файлу на этап, и читаются лишь при промахе следующего этапа
+STAGE_CACHE_DIR = APP_DIR / "stage_cache"
+
+_stage_cache: dict = {}   # этап → ключ выхода, лежащего в STAGE_CACHE_DIR
+_stage_stats: dict = {name: {"hit": 0, "miss": 0} for name in PIPELINE}
+
+
+def spill_blob(path: Path, blob: bytes) -> bool:
+    """Пишет блоб в кеш на диске. False — не вышло, вызывающий обходится без кеша."""
+    try:
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(blob)
+        return True
+    except OSError:
+        return False
+
+
+def load_blob(path: Path):
+    """Блоб из кеша на диске; None — файла нет или он побит."""
+    try:
+        return unpack_blob(path.read_bytes())
+    except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+        return None
+
+
+def stage_cache_stats() -> dict:
+    """Счётчики попаданий/промахов кеша по этапам за время работы."""
+    return {name: dict(st) for name, st in _stage_stats.items()}
+
+
+def clear_stage_cache():
+    _stage_cache.clear()
+    for path in STAGE_CACHE_DIR.glob("*.bin") if STAGE_CACHE_DIR.is_dir() else ():
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+
+def _latency_key(latency: LatencyHistory | None) -> str:
+    return "" if latency is None else f"v{latency.version}"
+
+
+def run_pipeline(source, options: dict, latency: LatencyHistory | None = None,
+                 source_key: str | None = None) -> tuple:
+    """
+    Выполняет этапы PIPELINE. source — dict или функция, возвращающая dict:
+    её зовут, только если этапу, читающему источник, не хватило кеша.
+    source_key — хеш источника; None — без кеша.
+    Возвращает (get, {этап: True, если из кеша}); get(этап) — выход этапа,
+    распаковывается из кеша только по запросу.
+    """
+    loader = source if callable(source) else (lambda: source)
+    externals = {"source": functools.lru_cache(maxsize=1)(loader), "latency": lambda: latency}
+    keys = {"source": source_key, "latency": _latency_key(latency)}
+    outputs, from_cache = {}, {}
+
+    def compute(name):
+        inputs, _option_keys, func = PIPELINE[name]
+        outputs[name] = func({i: value(i) for i in inputs}, options)
+        _stage_cache.pop(name, None)
+        if keys[name] is not None and spill_blob(STAGE_CACHE_DIR / f"{name}.bin",
+                                                 pack_blob(outputs[name])):
+            _stage_cache[name] = keys[name]
+        return outputs[name]
+
+    def value(name):
+        if name in externals:
+            return externals[name]()
+        if name not in outputs:
+            out = load_blob(STAGE_CACHE_DIR / f"{name}.bin")
+            if out is None:
+                # файл кеша пропал — этап считается заново
+                from_cache[name] = False
+                return compute(name)
+            outputs[name] = out
+        return outputs[name]
+
+    for name, (inputs, option_keys, func) in PIPELINE.items():
+        key = None
+        if source_key is not None:
+            key = hashlib.sha1(repr((
+                name, [keys[i] for i in inputs],
+                [json.dumps(options.get(k), sort_keys=True, default=str) for k in option_keys],
+            )).encode("utf-8")).hexdigest()
+        keys[name] = key
+        if key is not None and _stage_cache.get(name) == key:
+            _stage_stats[name]["hit"] += 1
+            from_cache[name] = True
+            continue
+        _stage_stats[name]["miss"] += 1
+        from_cache[name] = False
+        compute(name)
+    return value, from_cache
+
+
+def process_config(data, options: dict | None = None,
+                   latency: LatencyHistory | None = None, source_key: str | None = None):
+    """
+    Собирает итоговый конфиг. data — dict или функция, возвращающая dict
+    (см. run_pipeline). Возвращает (config, stats).
+    """
+    options = options or {}
+    get, from_cache = run_pipeline(data, options, latency, source_key)
+    proxies, split, order = get("proxies"), get("split"), get("order")
+    clean_groups = split["groups"]
+    # кеш хранит блобы, так что дальнейшие правки узлов на месте (DNS) ему не вредят
+    result = dict(get("base"))
+    result["proxies"] = proxies["proxies"]
+    result["proxy-groups"] = clean_groups
+    main_group = find_main_group(clean_groups)
+    result["rules"] = list(LOCAL_RULES) + [f"MATCH,{main_group}"]
+    transform = get_transform(options.get("transform"))
+    stats = {
+        "removed":    proxies["removed"],
+        "invalid":    proxies["invalid"],
+        "duplicates": proxies["duplicates"],
+        "rule_hits":  transform.report(get("limit")["hits"]) if transform else [],
+        "proxies":    len(proxies["proxies"]),
+        "groups":     len(clean_groups),
+        "main_group": main_group,
+        "regions":    get("regions"),
+        "split_groups": split["split"],
+        "name_keys":  order["name_keys"],
+        "demoted":    order["demoted"],
+        "stages":     from_cache,
+    }
+    return result, stats
+
+
+# ─────────────────────────────────────────────
+# Proxy-providers: база + отдельные файлы узлов
+# ─────────────────────────────────────────────
+
+PROVIDERS_DIR       = APP_DIR / "providers"
+PROVIDER_SHARD_SIZE = 1000
+PROVIDER_INTERVAL   = 3600
+
+
+def shard_proxies(proxies: list, regions: dict, max_size: int = PROVIDER_SHARD_SIZE) -> dict:
+    """Раскладывает узлы по провайдерам: по региону, крупные регионы — кусками по max_size."""
+    by_key: dict = {}
+    for proxy in proxies:
+        code = regions.get(str(proxy.get("name", ""))) or "other"
+        by_key.setdefault(code.lower(), []).append(proxy)
+    shards = {}
+    for key, items in by_key.items():
+        if len(items) <= max_size:
+            shards[f"sub-{key}"] = items
+            continue
+        for i in range(0, len(items), max_size):
+            shards[f"sub-{key}-{i // max_size + 1}"] = items[i:i + max_size]
+    return shards
+
+
+def split_providers(config: dict, regions: dict, port: int) -> tuple:
+    """
+    Выносит узлы из config в proxy-providers, отдаваемые локальным сервером.
+    Группы получают `use` на провайдеры со своими узлами и `filter`, если
+    берут из них не все узлы. Возвращает (base_config, {имя: [узлы]}).
+    Своя проверка у провайдеров выключена: узлы и так проверяют url-test и
+    fallback с интервалами из tune_group, а каждый шард проверял бы их ещё раз.
+    """
+    shards = shard_proxies(config.get("proxies", []), regions)
+    shard_of = {}
+    for shard, items in shards.items():
+        for proxy in items:
+            shard_of[str(proxy["name"])] = shard
+
+    groups = []
+    for group in config.get("proxy-groups", []):
+        members = group.get("proxies", [])
+        nodes = [p for p in members if p in shard_of]
+        g2 = dict(group)
+        g2["proxies"] = [p for p in members if p not in shard_of]
+        if nodes:
+            use = list(dict.fromkeys(shard_of[p] for p in nodes))
+            g2["use"] = use
+            if len(set(nodes)) < sum(len(shards[u]) for u in use):
+                g2["filter"] = "^(?:" + "|".join(re.escape(p) for p in dict.fromkeys(nodes)) + ")$"
+        if not g2["proxies"]:
+            del g2["proxies"]
+        groups.append(g2)
+
+    base = {}
+    for key, value in config.items():
+        if key == "proxies":
+            continue
+        if key == "proxy-groups":
+            base["proxy-providers"] = {
+                name: {
+                    "type": "http",
+                    "url": f"http://localhost:{port}/providers/{name}.yaml",
+                    "path": f"./providers/{name}.yaml",
+                    "interval": PROVIDER_INTERVAL,
+                    "health-check": {"enable": False, "url": REGION_TEST_URL},
+                }
+                for name in shards
+            }
+            value = groups
+        base[key] = value
+    return base, shards
+
+
+# ─────────────────────────────────────────────
+# Предварительное разрешение DNS
+# ─────────────────────────────────────────────
+
+DNS_CACHE_FILE  = APP_DIR / "dns_cache.json"
+DNS_CONCURRENCY = 32
+DNS_TIMEOUT     = 3.0       # секунды на один хост
+DNS_TTL         = 3600      # getaddrinfo не отдаёт TTL — держим час
+DNS_FAIL_TTL    = 300
+
+# Поле SNI по протоколам: при подстановке IP имя хоста переезжает сюда
+SNI_FIELDS = {"vless": "servername", "vmess": "servername",
+              "trojan": "sni", "hysteria2": "sni", "tuic": "sni"}
+
+_dns_cache: dict | None = None   # {host: {"ips": [...], "expires": ts}}
+
+
+def _is_ip(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+def load_dns_cache() -> dict:
+    global _dns_cache
+    if _dns_cache is None:
+        try:
+            with open(DNS_CACHE_FILE, "r", encoding="utf-8") as f:
+                _dns_cache = json.load(f)
+        except Exception:
+            _dns_cache = {}
+    return _dns_cache
+
+
+def save_dns_cache():
+    if _dns_cache is None:
+        return
+    now = time.time()
+    alive = {h: e for h, e in _dns_cache.items() if e.get("expires", 0) > now}
+    try:
+        with open(DNS_CACHE_FILE, "w", encoding="utf-8") as f:
+            json.dump(alive, f)
+    except Exception:
+        pass
+
+
+def _system_resolver(executor):
+    """getaddrinfo в своём пуле: зависший резолвер не держит asyncio.run после дедлайна."""
+    async def resolve(host: str) -> list:
+        loop = asyncio.get_running_loop()
+        infos = await loop.run_in_executor(
+            executor, functools.partial(socket.getaddrinfo, host, None, type=socket.SOCK_STREAM))
+        # IPv4 вперёд: у части клиентов IPv6 выключен
+        return sorted({info[4][0] for info in infos}, key=lambda ip: ":" in ip)
+    return resolve
+
+
+async def _resolve_many(hosts: list, resolver, limit: int, timeout: float,
+                        total_timeout: float) -> tuple:
+    """({host: [ip]} для успевших к total_timeout, [хосты, которые не успели])."""
+    sem = asyncio.Semaphore(limit)
+
+    async def one(host):
+        async with sem:
+            try:
+                return await asyncio.wait_for(resolver(host), timeout)
+            except (OSError, asyncio.TimeoutError, UnicodeError):
+                return []
+
+    tasks = {asyncio.ensure_future(one(h)): h for h in hosts}
+    done, pending = await asyncio.wait(tasks, timeout=total_timeout)
+    for task in pending:
+        task.cancel()
+    return {tasks[t]: t.result() for t in done}, [tasks[t] for t in pending]
+
+
+def resolve_hosts(hosts, resolver=None, total_timeout: float = 30.0) -> tuple:
+    """
+    Разрешает имена параллельно (не больше DNS_CONCURRENCY одновременно)
+    с учётом кеша. resolver — async-функция host -> [ip], для тестов.
+    Возвращает ({host: [ip]}, сколько взято из кеша, [не успевшие к total_timeout]).
+    Не успевшие — ни живы, ни мертвы: в результат и кеш они не попадают.
+    """
+    cache = load_dns_cache()
+    now = time.time()
+    result, todo = {}, []
+    for host in hosts:
+        entry = cache.get(host)
+        if entry and entry.get("expires", 0) > now:
+            result[host] = entry["ips"]
+        else:
+            todo.append(host)
+    from_cache = len(result)
+    unknown = []
+    if todo:
+        executor = ThreadPoolExecutor(max_workers=DNS_CONCURRENCY, thread_name_prefix="dns")
+        try:
+            fresh, unknown = asyncio.run(_resolve_many(
+                todo, resolver or _system_resolver(executor), DNS_CONCURRENCY, DNS_TIMEOUT,
+                total_timeout))
+        finally:
+            # не ждём зависшие getaddrinfo — их результат уже никому не нужен
+            executor.shutdown(wait=False, cancel_futures=True)
+        now = time.time()
+        for host, ips in fresh.items():
+            result[host] = ips
+            cache[host] = {"ips": ips, "expires": now + (DNS_TTL if ips else DNS_FAIL_TTL)}
+        save_dns_cache()
+    return result, from_cache, unknown
+
+
+def pin_proxy_ip(proxy: dict, ip: str) -> bool:
+    """
+    Подставляет IP в server, сохраняя имя хоста для TLS (sni/servername)
+    и для Host у websocket. gRPC/h2/http не трогаем: там имя нужно в нескольких местах.
+    """
+    host = str(proxy["server"])
+    network = proxy.get("network", "tcp")
+    if network not in ("tcp", "ws"):
+        return False
+    sni_key = SNI_FIELDS.get(proxy.get("type"))
+    if sni_key and not proxy.get(sni_key):
+        proxy[sni_key] = host
+    if network == "ws":
+        ws = proxy.setdefault("ws-opts", {})
+        headers = ws.setdefault("headers", {})
+        if not any(k.lower() == "host" for k in headers):
+            headers["Host"] = host
+    proxy["server"] = ip
+    return True
+
+
+def prefetch_dns(proxies: list, pin: bool = False, resolver=None,
+                 total_timeout: float = 30.0) -> dict:
+    """Разрешает server всех узлов; при pin=True подставляет IP. Возвращает статистику."""
+    hosts = list(dict.fromkeys(
+        str(p["server"]) for p in proxies if p.get("server") and not _is_ip(str(p["server"]))
+    ))
+    resolved, from_cache, unknown = resolve_hosts(hosts, resolver, total_timeout)
+    failed = [h for h in hosts if h in resolved and not resolved[h]]
+    failed_set = set(failed)
+    dead = [str(p.get("name", "")) for p in proxies if str(p.get("server", "")) in failed_set]
+    pinned = 0
+    if pin:
+        for proxy in proxies:
+            ips = resolved.get(str(proxy.get("server", "")))
+            if ips and pin_proxy_ip(proxy, ips[0]):
+                pinned += 1
+    return {"hosts": len(hosts), "cached": from_cache, "failed": failed,
+            "dead": dead, "pinned": pinned, "unknown": unknown}
+
+
+# ─────────────────────────────────────────────
+# Запись результата
+# ─────────────────────────────────────────────
+
+def dump_yaml(data) -> str:
+    return yaml.dump(data, allow_unicode=True, sort_keys=False,
+                     width=4096, default_flow_style=False)
+
+
+def dump_json(data) -> str:
+    """Минифицированный JSON: это тоже YAML, ядро Clash Meta читает его как конфиг."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def dump_config(data, as_json: bool = False) -> str:
+    return dump_json(data) if as_json else dump_yaml(data)
+
+
+def load_config_text(text: str):
+    """Разбирает clean.yaml или провайдера в любом из форматов вывода."""
+    if text.lstrip().startswith("{"):
+        try:
+            return json.loads(text)
+        except ValueError:
+            pass
+    return yaml.safe_load(text)
+
+
+def config_body_type(body: bytes) -> str:
+    """Content-Type конфига: JSON-вывод узнаём по первому символу."""
+    if body[:1] == b"{":
+        return "application/json; charset=utf-8"
+    return "application/x-yaml; charset=utf-8"
+
+
+
+def write_if_changed(path: Path, text: str) -> bool:
+    """Пишет файл, только если содержимое отличается. Возвращает True, если записал."""
+    data = text.encode("utf-8")
+    try:
+        if path.stat().st_size == len(data) and path.read_bytes() == data:
+            return False
+    except OSError:
+        pass
+    path.write_bytes(data)
+    return True
+
+
+_etag_cache: dict = {}
+
+
+def file_etag(path: str) -> str | None:
+    """ETag по содержимому файла; пересчитывается только при смене mtime/размера."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _etag_cache.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    try:
+        with open(path, "rb") as f:
+            etag = '"' + hashlib.sha1(f.read()).hexdigest()[:20] + '"'
+    except OSError:
+        return None
+    _etag_cache[path] = (key, etag)
+    return etag
+
+
+# ─────────────────────────────────────────────
+# Снимок отдаваемого конфига
+# ─────────────────────────────────────────────
+#
+# Всё, что видят клиенты, окно и трей, — один неизменяемый Snapshot: тела
+# clean.yaml и файлов провайдеров с ETag и Content-Type, заголовок подписки,
+# время и статистика конвертации. Поток конвертации собирает новый снимок
+# целиком и подменяет ссылку _snapshot. Присваивание атомарно, так что
+# читатели обходятся без блокировок: запрос берёт ссылку один раз, и
+# заголовок подписки всегда от той же конвертации, что и тело.
+
+class Snapshot:
+    """
+    files: {путь на сервере: (bytes, etag, content_type)}. derived — кеш
+    производного от files (модель, рендеры форматов): он лишь дополняется
+    и не меняет того, что снимок отдаёт.
+    """
+
+    __slots__ = ("files", "sub_header", "sub_info", "created", "stats", "derived")
+
+    def __init__(self, files: dict | None = None, sub_header: str = "",
+                 sub_info: dict | None = None, created: float = 0.0,
+                 stats: dict | None = None, model: bytes | None = None):
+        for name, value in (
+            ("files", MappingProxyType({
+                path: (body, '"' + hashlib.sha1(body).hexdigest()[:20] + '"', ctype)
+                for path, (body, ctype) in (files or {}).items()
+            })),
+            ("sub_header", sub_header),
+            ("sub_info", MappingProxyType(dict(sub_info or {}))),
+            ("created", created),
+            ("stats", MappingProxyType(dict(stats or {}))),
+            ("derived", {"model": model} if model is not None else {}),
+        ):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Snapshot неизменяем — публикуйте новый")
+
+    def age(self) -> float | None:
+        return max(time.time() - self.created, 0.0) if self.created else None
+
+    def model(self) -> dict | None:
+        """Результат process_config; после перезапуска — восстановленный из files."""
+        blob = self.derived.get("model")
+        if blob is None:
+            model = load_model(self.files)
+            if model is None:
+                return None
+            blob = self.derived["model"] = pack_blob(model)
+        return unpack_blob(blob)
+
+
+_snapshot = Snapshot()
+
+
+def current_snapshot() -> Snapshot:
+    return _snapshot
+
+
+def publish_snapshot(snapshot: Snapshot):
+    global _snapshot
+    _snapshot = snapshot
+
+
+def snapshot_files(base: str, providers: dict | None = None) -> dict:
+    """{путь: (bytes, content_type)} для Snapshot из текстов базы и провайдеров."""
+    def entry(text):
+        body = text.encode("utf-8")
+        return body, config_body_type(body)
+    files = {f"/{OUTPUT_FILE.name}": entry(base)}
+    for name, text in (providers or {}).items():
+        files[f"/providers/{name}.yaml"] = entry(text)
+    return files
+
+
+def load_snapshot() -> Snapshot:
+    """Снимок из файлов прошлого запуска: clean.yaml, провайдеры и sub_cache.json."""
+    files = {}
+    try:
+        body = OUTPUT_FILE.read_bytes()
+        created = OUTPUT_FILE.stat().st_mtime
+    except OSError:
+        return Snapshot()
+    files[f"/{OUTPUT_FILE.name}"] = (body, config_body_type(body))
+    for path in PROVIDERS_DIR.glob("*.yaml") if PROVIDERS_DIR.is_dir() else ():
+        try:
+            data = path.read_bytes()
+        except OSError:
+            continue
+        files[f"/providers/{path.name}"] = (data, config_body_type(data))
+    header, info = "", {}
+    try:
+        with open(SUB_CACHE_FILE, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        header, info = cached.get("header", ""), cached.get("info", {})
+    except (OSError, ValueError, AttributeError):
+        pass
+    return Snapshot(files, header, info, created)
+
+
+# ─────────────────────────────────────────────
+# Другие форматы: sing-box JSON и список ссылок
+# ─────────────────────────────────────────────
+#
+# Все форматы строятся из модели снимка (Snapshot.model) — результата
+# process_config. Рендер — при первом запросе формата, дальше из кеша
+# снимка до следующей конвертации. Модель хранится блобом (см. pack_blob).
+
+_render_lock = threading.Lock()
+
+
+def load_model(files) -> dict | None:
+    """
+    Восстанавливает модель из clean.yaml снимка после перезапуска. В режиме
+    proxy-providers узлы берутся из файлов провайдеров, а группы снова
+    получают список узлов по use/filter.
+    """
+    entry = files.get(f"/{OUTPUT_FILE.name}")
+    if entry is None:
+        return None
+    try:
+        config = load_config_text(entry[0].decode("utf-8", errors="replace"))
+    except yaml.YAMLError:
+        return None
+    if not isinstance(config, dict):
+        return None
+    providers = config.pop("proxy-providers", None) or {}
+    if not providers:
+        return config
+    shards = {}
+    for name in providers:
+        shard = files.get(f"/providers/{name}.yaml")
+        try:
+            text = shard[0].decode("utf-8", errors="replace")
+            shards[name] = (load_config_text(text) or {}).get("proxies", []) or []
+        except (TypeError, yaml.YAMLError, AttributeError):
+            shards[name] = []
+    config["proxies"] = list(config.get("proxies", []) or []) + [
+        p for items in shards.values() for p in items
+    ]
+    for group in config.get("proxy-groups", []):
+        use = group.pop("use", None)
+        flt = group.pop("filter", None)
+        if not use:
+            continue
+        rx = re.compile(flt) if flt else None
+        nodes = [str(p.get("name")) for u in use for p in shards.get(u, [])]
+        group["proxies"] = list(group.get("proxies", [])) + [
+            n for n in nodes if rx is None or rx.search(n)
+        ]
+    return config
+
+
+def _sb_tls(proxy: dict, force: bool = False) -> dict | None:
+    if not (force or proxy.get("tls") or proxy.get("reality-opts")):
+        return None
+    tls = {"enabled": True}
+    sni = proxy.get("servername") or proxy.get("sni")
+    if sni:
+        tls["server_name"] = sni
+    if proxy.get("skip-cert-verify"):
+        tls["insecure"] = True
+    if proxy.get("alpn"):
+        tls["alpn"] = list(proxy["alpn"])
+    fp = proxy.get("client-fingerprint")
+    reality = proxy.get("reality-opts")
+    if reality:
+        tls["reality"] = {"enabled": True, "public_key": reality.get("public-key", ""),
+                          "short_id": str(reality.get("short-id", ""))}
+        fp = fp or "chrome"  # reality в sing-box работает только с uTLS
+    if fp:
+        tls["utls"] = {"enabled": True, "fingerprint": fp}
+    return tls
+
+
+def _sb_transport(proxy: dict) -> dict | None:
+    network = proxy.get("network", "tcp")
+    if network == "ws":
+        opts = proxy.get("ws-opts") or {}
+        transport = {"type": "ws", "path": opts.get("path", "/")}
+        if opts.get("headers"):
+            transport["headers"] = dict(opts["headers"])
+        return transport
+    if network == "grpc":
+        opts = proxy.get("grpc-opts") or {}
+        return {"type": "grpc", "service_name": opts.get("grpc-service-name", "")}
+    if network in ("h2", "http"):
+        opts = proxy.get(f"{network}-opts") or {}
+        transport = {"type": "http"}
+        if opts.get("host"):
+            host = opts["host"]
+            transport["host"] = host if isinstance(host, list) else [host]
+        if opts.get("path"):
+            path = opts["path"]
+            transport["path"] = path[0] if isinstance(path, list) else path
+        return transport
+    return None
+
+
+def singbox_outbound(proxy: dict) -> dict | None:
+    """Узел Clash → outbound sing-box; None — протокол/плагин не переносится."""
+    pt = proxy["type"]
+    out = {"type": {"ss": "shadowsocks"}.get(pt, pt), "tag": str(proxy["name"]),
+           "server": proxy["server"], "server_port": proxy["port"]}
+    if pt == "ss":
+        out["method"] = proxy["cipher"]
+        out["password"] = str(proxy["password"])
+        plugin = proxy.get("plugin")
+        if plugin == "obfs":
+            opts = proxy.get("plugin-opts") or {}
+            out["plugin"] = "obfs-local"
+            out["plugin_opts"] = f"obfs={opts.get('mode', 'http')};obfs-host={opts.get('host', '')}"
+        elif plugin:
+            return None
+    elif pt in ("vless", "vmess"):
+        out["uuid"] = proxy["uuid"]
+        if pt == "vless" and proxy.get("flow"):
+            out["flow"] = proxy["flow"]
+        if pt == "vmess":
+            out["security"] = proxy.get("cipher", "auto")
+            out["alter_id"] = proxy.get("alterId", 0)
+    elif pt == "trojan":
+        out["password"] = str(proxy["password"])
+    elif pt == "hysteria2":
+        out["password"] = str(proxy["password"])
+        if proxy.get("obfs"):
+            out["obfs"] = {"type": proxy["obfs"], "password": str(proxy.get("obfs-password", ""))}
+    elif pt == "tuic":
+        if not proxy.get("uuid"):
+            return None     # TUIC v4 (только token): sing-box умеет лишь v5
+        out["uuid"] = proxy["uuid"]
+        out["password"] = str(proxy.get("password", ""))
+        if proxy.get("congestion-controller"):
+            out["congestion_control"] = proxy["congestion-controller"]
+        if proxy.get("udp-relay-mode"):
+            out["udp_relay_mode"] = proxy["udp-relay-mode"]
+    elif pt == "wireguard":
+        out["private_key"] = proxy["private-key"]
+        out["peer_public_key"] = proxy.get("public-key", "")
+        if proxy.get("pre-shared-key"):
+            out["pre_shared_key"] = proxy["pre-shared-key"]
+        out["local_address"] = [
+            a if "/" in a else a + ("/128" if ":" in a else "/32")
+            for a in (str(proxy.get("ip", "")), str(proxy.get("ipv6", ""))) if a
+        ]
+        if proxy.get("mtu"):
+            out["mtu"] = proxy["mtu"]
+        if proxy.get("reserved"):
+            out["reserved"] = proxy["reserved"]
+        return out
+    else:
+        return None
+
+    tls = _sb_tls(proxy, force=pt in ("trojan", "hysteria2", "tuic"))
+    if tls:
+        out["tls"] = tls
+    if pt in ("vless", "vmess", "trojan"):
+        transport = _sb_transport(proxy)
+        if transport:
+            out["transport"] = transport
+    return out
+
+
+_SB_BUILTIN = {"DIRECT": "direct", "REJECT": "block"}
+
+
+def render_singbox(config: dict) -> bytes:
+    outbounds, tags = [], set()
+    for proxy in config.get("proxies", []):
+        out = singbox_outbound(proxy)
+        if out is not None:
+            outbounds.append(out)
+            tags.add(out["tag"])
+
+    groups = {}
+    for group in config.get("proxy-groups", []):
+        gt = group.get("type")
+        sb = {"type": "selector" if gt == "select" else "urltest", "tag": str(group["name"])}
+        if sb["type"] == "urltest":
+            sb["url"] = group.get("url", REGION_TEST_URL)
+            sb["interval"] = f"{int(group.get('interval', 300))}s"
+            if group.get("tolerance") is not None:
+                sb["tolerance"] = int(group["tolerance"])
+        sb["outbounds"] = [_SB_BUILTIN.get(m, m) for m in group.get("proxies", [])]
+        groups[sb["tag"]] = sb
+    # sing-box не принимает пустые группы: выкидываем их, пока есть что выкидывать
+    known = tags | set(_SB_BUILTIN.values())
+    while True:
+        alive = known | set(groups)
+        empty = []
+        for tag, sb in groups.items():
+            sb["outbounds"] = [m for m in sb["outbounds"] if m in alive]
+            if not sb["outbounds"]:
+                empty.append(tag)
+        if not empty:
+            break
+        for tag in empty:
+            del groups[tag]
+
+    main = find_main_group(config.get("proxy-groups", []))
+    result = {
+        "log": {"level": "warn"},
+        "inbounds": [{"type": "mixed", "tag": "mixed-in", "listen": "127.0.0.1",
+                      "listen_port": int(config.get("mixed-port") or 2080)}],
+        "outbounds": list(groups.values()) + outbounds + [
+            {"type": "direct", "tag": "direct"}, {"type": "block", "tag": "block"},
+        ],
+        "route": {"final": main if main in groups else "direct",
+                  "auto_detect_interface": True},
+    }
+    return json.dumps(result, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def _uri_host(server) -> str:
+    server = str(server)
+    return f"[{server}]" if ":" in server else server
+
+
+def _uri_query(params: dict) -> str:
+    pairs = [(k, str(v)) for k, v in params.items() if v not in (None, "", False)]
+    return ("?" + urlencode(pairs, quote_via=quote)) if pairs else ""
+
+
+def _uri_transport(proxy: dict, params: dict):
+    network = proxy.get("network", "tcp")
+    params["type"] = network
+    if network == "ws":
+        opts = proxy.get("ws-opts") or {}
+        params["path"] = opts.get("path")
+        params["host"] = (opts.get("headers") or {}).get("Host")
+    elif network == "grpc":
+        params["serviceName"] = (proxy.get("grpc-opts") or {}).get("grpc-service-name")
+
+
+def proxy_uri(proxy: dict) -> str | None:
+    """Узел Clash → ссылка вида vless://…; None — для протокола нет общепринятой ссылки."""
+    pt = proxy["type"]
+    name = quote(str(proxy["name"]), safe="")
+    addr = f"{_uri_host(proxy['server'])}:{proxy['port']}"
+    sni = proxy.get("servername") or proxy.get("sni")
+    if pt == "ss":
+        userinfo = base64.urlsafe_b64encode(
+            f"{proxy['cipher']}:{proxy['password']}".encode()).decode().rstrip("=")
+        params = {}
+        if proxy.get("plugin") == "obfs":
+            opts = proxy.get("plugin-opts") or {}
+            params["plugin"] = f"obfs-local;obfs={opts.get('mode', 'http')};obfs-host={opts.get('host', '')}"
+        elif proxy.get("plugin"):
+            return None
+        return f"ss://{userinfo}@{addr}{_uri_query(params)}#{name}"
+    if pt == "vmess":
+        network = proxy.get("network", "tcp")
+        ws = proxy.get("ws-opts") or {}
+        data = {
+            "v": "2", "ps": str(proxy["name"]), "add": str(proxy["server"]),
+            "port": str(proxy["port"]), "id": proxy["uuid"], "aid": str(proxy.get("alterId", 0)),
+            "scy": proxy.get("cipher", "auto"), "net": network, "type": "none",
+            "host": (ws.get("headers") or {}).get("Host", ""),
+            "path": ws.get("path", "") if network == "ws"
+                    else (proxy.get("grpc-opts") or {}).get("grpc-service-name", ""),
+            "tls": "tls" if proxy.get("tls") else "", "sni": sni or "",
+        }
+        raw = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return "vmess://" + base64.b64encode(raw).decode()
+    if pt in ("vless", "trojan"):
+        user = proxy["uuid"] if pt == "vless" else quote(str(proxy["password"]), safe="")
+        params = {}
+        reality = proxy.get("reality-opts")
+        if reality:
+            params.update(security="reality", pbk=reality.get("public-key"),
+                          sid=reality.get("short-id"))
+        elif proxy.get("tls") or pt == "trojan":
+            params["security"] = "tls"
+        else:
+            params["security"] = "none"
+        params.update(sni=sni, fp=proxy.get("client-fingerprint"), flow=proxy.get("flow"))
+        if proxy.get("skip-cert-verify"):
+            params["allowInsecure"] = 1
+        _uri_transport(proxy, params)
+        return f"{pt}://{user}@{addr}{_uri_query(params)}#{name}"
+    if pt == "hysteria2":
+        params = {"sni": sni, "obfs": proxy.get("obfs"),
+                  "obfs-password": proxy.get("obfs-password"),
+                  "insecure": 1 if proxy.get("skip-cert-verify") else None}
+        return f"hysteria2://{quote(str(proxy['password']), safe='')}@{addr}{_uri_query(params)}#{name}"
+    if pt == "tuic" and proxy.get("uuid"):
+        auth = f"{proxy['uuid']}:{quote(str(proxy.get('password', '')), safe='')}"
+        params = {"sni": sni, "congestion_control": proxy.get("congestion-controller"),
+                  "udp_relay_mode": proxy.get("udp-relay-mode"),
+                  "alpn": ",".join(proxy.get("alpn") or []),
+                  "allow_insecure": 1 if proxy.get("skip-cert-verify") else None}
+        return f"tuic://{auth}@{addr}{_uri_query(params)}#{name}"
+    return None
+
+
+def render_uri_list(config: dict) -> bytes:
+    links = [uri for uri in map(proxy_uri, config.get("proxies", [])) if uri]
+    return base64.b64encode("\n".join(links).encode("utf-8"))
+
+
+# путь на сервере → (формат, Content-Type, функция рендера)
+RENDERERS = {
+    "/singbox.json": ("singbox", "application/json; charset=utf-8", render_singbox),
+    "/sub.txt":      ("uri", "text/plain; charset=utf-8", render_uri_list),
+}
+
+
+def render_format(path: str, snapshot: Snapshot | None = None) -> tuple | None:
+    """
+    (bytes, etag, content_type) для пути из RENDERERS; None — конфига ещё нет.
+    Рендер выполняется один раз на снимок, под блокировкой — параллельные
+    запросы одного формата ждут первый, а не считают его заново.
+    """
+    snapshot = snapshot or _snapshot
+    fmt, ctype, render = RENDERERS[path]
+    with _render_lock:
+        cached = snapshot.derived.get(fmt)
+        if cached:
+            return cached
+        model = snapshot.model()
+        if model is None:
+            return None
+        body = render(model)
+        etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        snapshot.derived[fmt] = (body, etag, ctype)
+        return snapshot.derived[fmt]
+
+
+# ─────────────────────────────────────────────
+# Возраст конфига и обновление по запросу
+# ─────────────────────────────────────────────
+
+def request_refresh() -> bool:
+    """
+    Просит одно фоновое обновление. Повторные вызовы до refresh_finished()
+    склеиваются; после неудачи следующая попытка — не раньше STALE_RETRY_SEC.
+    """
+    global _refresh_inflight
+    with _refresh_lock:
+        if _refresh_inflight or _on_stale is None or time.time() < _refresh_retry_at:
+            return False
+        _refresh_inflight = True
+    _on_stale()
+    return True
+
+
+def refresh_finished(ok: bool):
+    global _refresh_inflight, _refresh_retry_at
+    with _refresh_lock:
+        _refresh_inflight = False
+        if ok:
+            _refresh_retry_at = 0.0
+        else:
+            _refresh_retry_at = time.time() + STALE_RETRY_SEC
+
+
+# ─────────────────────────────────────────────
+# Доступ из локальной сети
+# ─────────────────────────────────────────────
+#
+# "lan_mode": true — сервер слушает все интерфейсы. Устройства из
+# "lan_devices" ({имя: токен}) ходят по http://<ip>:<порт>/t/<токен>/clean.yaml.
+# Запросы с этого же компьютера токена не требуют. Все устройства получают
+# один и тот же кеш — провайдер видит одну загрузку, а не N.
+
+LAN_RATE = 30              # запросов в минуту на устройство и на адрес
+LAN_IP_BUCKETS = 1024      # адресов, после которых полные вёдра забываются
+_TOKEN_PATH_RE = re.compile(r"^/t/([^/]+)(/.*)$")
+
+_lan_lock = threading.Lock()
+_lan_tokens: tuple = ()    # ((токен bytes, имя устройства), ...)
+_lan_rate = LAN_RATE
+_lan_buckets: dict = {}    # устройство → [доступно запросов, time.monotonic()]
+_lan_ip_buckets: dict = {} # адрес клиента → то же, до проверки токена
+_lan_stats: dict = {}      # устройство → счётчики, см. lan_record
+
+
+def configure_lan(devices: dict, rate: int = LAN_RATE):
+    global _lan_tokens, _lan_rate
+    with _lan_lock:
+        _lan_tokens = tuple((str(t).encode(), str(name)) for name, t in (devices or {}).items() if t)
+        _lan_rate = max(int(rate or LAN_RATE), 1)
+        _lan_buckets.clear()
+        _lan_ip_buckets.clear()
+
+
+def lan_device(token: str) -> str | None:
+    """Имя устройства по токену. Сравниваются все токены, без раннего выхода."""
+    token_b = token.encode()
+    found = None
+    for known, name in _lan_tokens:
+        if hmac.compare_digest(known, token_b):
+            found = name
+    return found
+
+
+def _take_token(buckets: dict, key: str) -> tuple:
+    now = time.monotonic()
+    per_sec = _lan_rate / 60.0
+    with _lan_lock:
+        bucket = buckets.setdefault(key, [float(_lan_rate), now])
+        bucket[0] = min(float(_lan_rate), bucket[0] + (now - bucket[1]) * per_sec)
+        bucket[1] = now
+        if bucket[0] >= 1.0:
+            bucket[0] -= 1.0
+            return True, 0
+        return False, int((1.0 - bucket[0]) / per_sec) + 1
+
+
+def lan_allow(device: str) -> tuple:
+    """Token bucket на устройство: (разрешено, через сколько секунд повторить)."""
+    return _take_token(_lan_buckets, device)
+
+
+def lan_allow_ip(ip: str) -> tuple:
+    """
+    То же по адресу клиента. Проверяется до поиска токена, так что подбор
+    токенов упирается в 429, а не получает неограниченно быстрые 403.
+    """
+    if len(_lan_ip_buckets) > LAN_IP_BUCKETS:
+        # вёдра, успевшие наполниться, ничего не ограничивают
+        now, per_sec = time.monotonic(), _lan_rate / 60.0
+        with _lan_lock:
+            for key, (tokens, stamp) in list(_lan_ip_buckets.items()):
+                if tokens + (now - stamp) * per_sec >= _lan_rate:
+                    del _lan_ip_buckets[key]
+    return _take_token(_lan_ip_buckets, ip)
+
+
+def lan_record(device: str, ip: str, code, nbytes: int):
+    with _lan_lock:
+        st = _lan_stats.setdefault(
+            device, {"requests": 0, "not_modified": 0, "limited": 0, "bytes": 0,
+                     "last_seen": 0.0, "last_ip": ""},
+        )
+        st["requests"] += 1
+        st["bytes"] += nbytes
+        if code == 304:
+            st["not_modified"] += 1
+        elif code == 429:
+            st["limited"] += 1
+        st["last_seen"] = time.time()
+        st["last_ip"] = ip
+
+
+def lan_stats() -> dict:
+    with _lan_lock:
+        return {name: dict(st) for name, st in _lan_stats.items()}
+
+
+def is_loopback(ip: str) -> bool:
+    try:
+        return ipaddress.ip_address(ip.split("%")[0]).is_loopback
+    except ValueError:
+        return False
+
+
+def lan_address() -> str:
+    """IP этого компьютера в локальной сети (UDP connect пакетов не шлёт)."""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("10.255.255.255", 1))
+            return s.getsockname()[0]
+    except OSError:
+        return "127.0.0.1"
+
+
+def lan_path_allowed(url_path: str) -> bool:
+    """Наружу — только конфиги, а не app_config.json и прочее из APP_DIR, даже через localhost."""
+    return (url_path == f"/{OUTPUT_FILE.name}" or url_path in RENDERERS
+            or (url_path.startswith("/providers/") and url_path.endswith(".yaml")
+                and "/" not in url_path[len("/providers/"):]))
+
+
+# ─────────────────────────────────────────────
+# HTTP-сервер
+# ─────────────────────────────────────────────
+
+class ConfigHTTPServer(http.server.ThreadingHTTPServer):
+    # На Windows SO_REUSEADDR позволяет занять порт поверх чужого сокета,
+    # поэтому там вместо него — SO_EXCLUSIVEADDRUSE.
+    allow_reuse_address = os.name != "nt"
+    # server_close() дожидается потоков с недоотданными ответами
+    daemon_threads = False
+
+    def server_bind(self):
+        if os.name == "nt" and hasattr(socket, "SO_EXCLUSIVEADDRUSE"):
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_EXCLUSIVEADDRUSE, 1)
+        # HTTPServer.server_bind зовёт socket.getfqdn — это DNS-запрос на
+        # каждый старт, а имя хоста нам не нужно
+        socketserver.TCPServer.server_bind(self)
+        host, port = self.server_address[:2]
+        self.server_name = host
+        self.server_port = port
+
+
+def make_server(port: int, host: str = "localhost") -> ConfigHTTPServer:
+    directory = str(APP_DIR)
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=directory, **kwargs)
+
+        def send_head(self):
+            # одна ссылка на снимок на весь запрос: тело, ETag и заголовок
+            # подписки — от одной конвертации, даже если рядом публикуется новая
+            self._snap = snap = _snapshot
+            self._age = None
+            self._etag = None
+            self._device = self._token = None
+            self._retry_after = self._length = 0
+            parsed = urlparse(self.path)
+            url_path = parsed.path
+            m = _TOKEN_PATH_RE.match(url_path)
+            if m or not is_loopback(self.client_address[0]):
+                allowed, self._retry_after = lan_allow_ip(self.client_address[0])
+                if not allowed:
+                    self.send_error(429)
+                    return None
+                if not m or (device := lan_device(m.group(1))) is None:
+                    self.send_error(403)
+                    return None
+                self._device, self._token = device, m.group(1)
+                url_path = m.group(2)
+                self.path = url_path + (f"?{parsed.query}" if parsed.query else "")
+                allowed, self._retry_after = lan_allow(device)
+                if not allowed:
+                    self.send_error(429)
+                    return None
+            if not lan_path_allowed(url_path):
+                self.send_error(404)
+                return None
+            if (url_path == f"/{OUTPUT_FILE.name}" or url_path.startswith("/providers/")
+                    or url_path in RENDERERS):
+                self._age = snap.age()
+                if _stale_max_age and self._age is not None and self._age > _stale_max_age:
+                    request_refresh()
+            if url_path in RENDERERS:
+                rendered = render_format(url_path, snap)
+                if rendered is None:
+                    self.send_error(404, None, "Конфиг ещё не сконвертирован")
+                    return None
+                return self._send_entry(rendered)
+            entry = snap.files.get(url_path)
+            if entry is not None:
+                if self._device and url_path == f"/{OUTPUT_FILE.name}":
+                    entry = (self._lan_base(entry[0]), *entry[1:])
+                return self._send_entry(entry)
+            path = self.translate_path(self.path)
+            self._etag = file_etag(path) if os.path.isfile(path) else None
+            if self._etag and self._etag in self.headers.get("If-None-Match", ""):
+                self.send_response(304)
+                self.end_headers()
+                return None
+            return super().send_head()
+
+        def _lan_base(self, body: bytes) -> bytes:
+            # ссылки на провайдеров в базе указывают на localhost — устройству
+            # отдаём их через адрес, по которому оно пришло, и его токен
+            host = self.headers.get("Host") or f"{lan_address()}:{self.server.server_port}"
+            return body.replace(
+                f"http://localhost:{self.server.server_port}/providers/".encode(),
+                f"http://{host}/t/{self._token}/providers/".encode(),
+            )
+
+        def _send_entry(self, entry: tuple):
+            body, self._etag, ctype = entry
+            if self._etag in self.headers.get("If-None-Match", ""):
+                self.send_response(304)
+                self.end_headers()
+                return None
+            return self._send_bytes(body, ctype)
+
+        def _send_bytes(self, body: bytes, ctype: str):
+            self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            return io.BytesIO(body)
+
+        def send_header(self, keyword, value):
+            if keyword == "Content-Length":
+                self._length = int(value)
+            super().send_header(keyword, value)
+
+        def end_headers(self):
+            if getattr(self, "_etag", None):
+                self.send_header("ETag", self._etag)
+            age = getattr(self, "_age", None)
+            if age is not None:
+                self.send_header("Age", str(int(age)))
+                if _stale_max_age and age > _stale_max_age:
+                    self.send_header("Warning", '110 - "Response is Stale"')
+            if getattr(self, "_retry_after", 0):
+                self.send_header("Retry-After", str(self._retry_after))
+            sub_header = getattr(self, "_snap", _snapshot).sub_header
+            if sub_header:
+                self.send_header("subscription-userinfo", sub_header)
+            self.send_header("Content-Disposition", "inline")
+            super().end_headers()
+            count_served(getattr(self, "_length", 0) if self._code == 200 else 0)
+            if getattr(self, "_device", None):
+                lan_record(self._device, self.client_address[0], self._code,
+                           getattr(self, "_length", 0) if self._code == 200 else 0)
+
+        def log_request(self, code="-", size="-"):
+            self._code = code
+
+        def log_message(self, fmt, *args):
+            pass
+
+    server = ConfigHTTPServer((host, port), Handler)
+    server.host = host
+    return server
+
+
+def bind_server(port: int, span: int = 1, host: str = "localhost") -> ConfigHTTPServer:
+    """
+    Занимает первый свободный порт из port .. port+span-1 сразу через bind,
+    без предварительных проб. port=0 — эфемерный порт от ОС.
+    """
+    if port == 0:
+        return make_server(0, host)
+    error = None
+    for p in range(port, port + max(span, 1)):
+        try:
+            return make_server(p, host)
+        except OSError as e:
+            error = e
+    raise error
+
+
+def _drain_server(server):
+    server.shutdown()
+    server.server_close()
+
+
+def start_server(port: int, span: int = 1, host: str = "localhost") -> ConfigHTTPServer:
+    """
+    Поднимает сервер (см. bind_server) и запускает его в фоновом потоке.
+    Фактический порт — server.server_address[1].
+    Если сервер уже работал — старый останавливается только после того,
+    как новый начал принимать соединения, и дожидается начатых ответов.
+    Смена интерфейса на том же порту (localhost ↔ все) так не получится:
+    тогда старый сервер сначала останавливается.
+    Ошибку bind (OSError) пробрасывает вызывающему.
+    """
+    global _http_server, _server_running
+    try:
+        server = bind_server(port, span, host)
+    except OSError:
+        old = _http_server
+        if old is None or old.host == host or old.server_address[1] != port:
+            raise
+        stop_server()
+        try:
+            server = bind_server(port, span, host)
+        except OSError:
+            start_server(port, host=old.host)
+            raise
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    old, _http_server = _http_server, server
+    _server_running = True
+    if old is not None:
+        threading.Thread(target=_drain_server, args=(old,), daemon=True).start()
+    return server
+
+
+def stop_server():
+    global _http_server, _server_running
+    if _http_server:
+        _drain_server(_http_server)
+        _http_server = None
+    _server_running = False
+
+
+# ─────────────────────────────────────────────
+# Push-перезагрузка конфига в Clash
+# ─────────────────────────────────────────────
+#
+# "push_reload": true — после конвертации, изменившей результат, ядро
+# получает его сразу, а не при следующем опросе подписки: в режиме
+# proxy-providers — обновлением изменённых провайдеров, иначе PUT /configs.
+# Несколько конвертаций подряд склеиваются в один push (PUSH_DEBOUNCE).
+
+PUSH_DEBOUNCE = 2.0        # секунды тишины перед отправкой
+PUSH_TIMEOUT  = 5.0
+PUSH_RETRIES  = 3          # попыток, паузы между ними 1 и 2 с
+PUSH_BACKOFF  = 1.0
+
+
+def config_digest(text: str) -> str:
+    """Хеш тела конфига без шапки-комментария: метка времени в ней меняется всегда."""
+    lines = text.splitlines(keepends=True)
+    start = 0
+    while start < len(lines) and (lines[start].startswith("#") or not lines[start].strip()):
+        start += 1
+    return hashlib.sha1("".join(lines[start:]).encode("utf-8")).hexdigest()
+
+
+class ReloadPusher:
+    """Отложенная отправка с повторами; работает в своих потоках, а не в потоке конвертации."""
+
+    def __init__(self, log):
+        self._log = log
+        self._lock = threading.Lock()
+        self._timer: threading.Timer | None = None
+        self._controller: ClashController | None = None
+        self._payload: str | None = None
+        self._providers: set = set()
+
+    def schedule(self, controller: ClashController, payload: str | None = None,
+                 providers=()):
+        """payload — весь конфиг (PUT /configs); providers — имена для обновления."""
+        with self._lock:
+            self._controller = controller
+            if payload is not None:
+                self._payload, self._providers = payload, set()
+            elif self._payload is None:
+                self._providers.update(providers)
+            if self._timer:
+                self._timer.cancel()
+            self._timer = threading.Timer(PUSH_DEBOUNCE, self._fire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def cancel(self):
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+
+    def _fire(self):
+        with self._lock:
+            controller, payload, providers = self._controller, self._payload, sorted(self._providers)
+            self._timer, self._payload, self._providers = None, None, set()
+        if payload is None and not providers:
+            return
+        t0 = time.perf_counter()
+        # None — весь конфиг; после частичного отказа повторяем только неудавшиеся
+        pending = [None] if payload is not None else providers
+        error = None
+        for attempt in range(PUSH_RETRIES):
+            if attempt:
+                time.sleep(PUSH_BACKOFF * 2 ** (attempt - 1))
+            failed = []
+            for name in pending:
+                try:
+                    if name is None:
+                        controller.reload_config(payload, PUSH_TIMEOUT)
+                    else:
+                        controller.update_provider(name, PUSH_TIMEOUT)
+                except requests.exceptions.RequestException as e:
+                    failed.append(name)
+                    error = e
+            pending = failed
+            if not pending:
+                what = "конфиг" if payload is not None else f"провайдеры ({len(providers)})"
+                self._log(f"✓ Clash перезагрузил {what} за {time.perf_counter() - t0:.1f} с",
+                          "success")
+                return
+        if payload is not None:
+            self._log(f"Не удалось отправить конфиг в Clash: {error}", "warning")
+        else:
+            self._log(f"Clash не обновил провайдеры {', '.join(pending)}: {error}", "warning")
+
+
+# ─────────────────────────────────────────────
+# Память в простое
+# ─────────────────────────────────────────────
+#
+# Между обновлениями приложение часами висит в трее. После конвертации
+# локальные text/data уже недостижимы, но освобождённое остаётся у
+# аллокатора — возвращаем его системе и сообщаем RSS.
+
+RSS_BUDGET_MB = 150
+
+
+class _ProcessMemoryCounters(ctypes.Structure):
+    _fields_ = [("cb", ctypes.c_ulong), ("PageFaultCount", ctypes.c_ulong),
+                ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+
+def process_rss() -> int | None:
+    """Резидентная память процесса в байтах (Working Set на Windows)."""
+    if os.name == "nt":
+        try:
+            counters = _ProcessMemoryCounters()
+            counters.cb = ctypes.sizeof(counters)
+            handle = ctypes.windll.kernel32.GetCurrentProcess()
+            if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters),
+                                                        counters.cb):
+                return counters.WorkingSetSize
+        except (AttributeError, OSError):
+            pass
+        return None
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+@functools.lru_cache(maxsize=1)
+def _malloc_trim():
+    try:
+        return ctypes.CDLL("libc.so.6").malloc_trim
+    except (OSError, AttributeError):
+        return None
+
+
+def release_memory() -> int | None:
+    """
+    Полная сборка мусора и возврат свободных страниц системе:
+    malloc_trim на Linux, сброс рабочего набора на Windows.
+    Возвращает RSS после очистки.
+
+    Кеш classify_region сбрасывается: его ключи — имена узлов, разбросанные
+    по всем аренам разобранной подписки, и на 50k узлов они не дают отдать
+    сотни мегабайт. Заново классифицировать имена — десятки миллисекунд.
+    """
+    classify_region.cache_clear()
+    gc.collect()
+    if os.name == "nt":
+        try:
+            kernel32 = ctypes.windll.kernel32
+            kernel32.SetProcessWorkingSetSize(kernel32.GetCurrentProcess(),
+                                              ctypes.c_size_t(-1), ctypes.c_size_t(-1))
+        except (AttributeError, OSError):
+            pass
+    else:
+        trim = _malloc_trim()
+        if trim is not None:
+            trim(0)
+    return process_rss()
 
 
 # ─────────────────────────────────────────────
-# HTTP-сервер
+# Зеркала подписки
 # ─────────────────────────────────────────────
+#
+# Провайдеры публикуют подписку на нескольких доменах, и часть из них в любой
+# момент медленная или заблокирована. Зеркала качаем со сдвигом, как в happy
+# eyeballs: следующее стартует через MIRROR_STAGGER или сразу после отказа
+# предыдущего. Первый полный ответ побеждает, остальные загрузки обрываются.
 
-def find_free_port(preferred: int = DEFAULT_PORT) -> int:
-    for port in range(preferred, preferred + 20):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            if s.connect_ex(("localhost", port)) != 0:
-                return port
-    return preferred
+MIRROR_FILE    = APP_DIR / "mirrors.json"
+MIRROR_STAGGER = 1.0   # секунд до старта следующего зеркала
+MIRROR_ALPHA   = 0.3   # вес нового замера в скользящем среднем
 
 
-def start_server(port: int):
-    global _http_server, _server_running
-    directory = str(APP_DIR)
+class MirrorCancelled(Exception):
+    pass
 
-    class Handler(http.server.SimpleHTTPRequestHandler):
-        def __init__(self, *args, **kwargs):
-            super().__init__(*args, directory=directory, **kwargs)
 
-        def end_headers(self):
-            if _sub_header:
-                self.send_header("subscription-userinfo", _sub_header)
-            self.send_header("Access-Control-Allow-Origin", "*")
-            self.send_header("Content-Disposition", "inline")
-            super().end_headers()
+class MirrorStats:
+    """
+    urls: {url: {"ms": скользящее среднее полной загрузки, "ok": успехов,
+    "fail": отказов, "streak": отказов подряд}}.
+    """
 
-        def log_message(self, fmt, *args):
-            pass
+    def __init__(self, data: dict | None = None):
+        self.urls: dict = (data or {}).get("urls", {})
 
-    _http_server = http.server.HTTPServer(("localhost", port), Handler)
-    _server_running = True
-    _http_server.serve_forever()
+    @classmethod
+    def load(cls) -> "MirrorStats":
+        try:
+            with open(MIRROR_FILE, "r", encoding="utf-8") as f:
+                return cls(json.load(f))
+        except (OSError, ValueError):
+            return cls()
+
+    def save(self, keep=()):
+        # зеркала, которых больше нет в настройках, не копим
+        keep = set(keep)
+        self.urls = {u: v for u, v in self.urls.items() if u in keep}
+        write_if_changed(MIRROR_FILE, json.dumps(
+            {"urls": self.urls}, ensure_ascii=False, separators=(",", ":")))
+
+    def _entry(self, url: str) -> dict:
+        return self.urls.setdefault(url, {"ms": None, "ok": 0, "fail": 0, "streak": 0})
+
+    def record_ok(self, url: str, seconds: float):
+        entry = self._entry(url)
+        ms = seconds * 1000
+        entry["ms"] = round(ms if entry["ms"] is None
+                            else entry["ms"] + MIRROR_ALPHA * (ms - entry["ms"]), 1)
+        entry["ok"] += 1
+        entry["streak"] = 0
+
+    def record_lost(self, url: str, seconds: float):
+        # оборванная загрузка шла не меньше seconds — только поднимаем оценку
+        entry = self.urls.get(url)
+        if entry and entry["ms"] is not None:
+            entry["ms"] = max(entry["ms"], round(seconds * 1000, 1))
+
+    def record_fail(self, url: str):
+        entry = self._entry(url)
+        entry["fail"] += 1
+        entry["streak"] += 1
+
+    def rank(self, urls: list) -> list:
+        """Сначала быстрые проверенные, затем неизвестные, в конце отказывающие."""
+        def key(item):
+            index, url = item
+            entry = self.urls.get(url) or {}
+            ms = entry.get("ms")
+            return entry.get("streak", 0), float("inf") if ms is None else ms, index
+        return [url for _, url in sorted(enumerate(urls), key=key)]
+
+
+def looks_like_config(text: str) -> bool:
+    """Заглушки блокировок и капчи отдают HTML со статусом 200 — такой ответ не победитель."""
+    head = text.lstrip()[:64].lower()
+    return bool(head) and not head.startswith(("<!doctype", "<html", "<?xml"))
+
+
+def race_mirrors(urls: list, fetch, job, stagger: float = MIRROR_STAGGER) -> tuple:
+    """
+    Качает urls (уже в порядке ранга) со сдвигом stagger. fetch(url, abort)
+    возвращает результат или бросает исключение; abort взводится, когда
+    победитель найден. Возвращает (url, результат, секунды, {url: ошибка},
+    {url: секунды до обрыва}). Если отказали все — бросает ошибку первого зеркала.
+    """
+    abort = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=len(urls), thread_name_prefix="mirror")
+    started: dict = {}
+    errors: dict = {}
 
+    def attempt(url):
+        t0 = time.perf_counter()
+        return fetch(url, abort), time.perf_counter() - t0
 
-def stop_server():
-    global _http_server, _server_running
-    if _http_server:
-        _http_server.shutdown()
-        _http_server = None
-    _server_running = False
+    def launch():
+        url = urls[len(started)]
+        future = pool.submit(attempt, url)
+        started[future] = (url, time.perf_counter())
+        return future
+
+    try:
+        pending = {launch()}
+        next_at = time.monotonic() + stagger
+        while True:
+            job.checkpoint()
+            more = len(started) < len(urls)
+            timeout = min(next_at - time.monotonic(), 0.1) if more else 0.1
+            done, pending = wait(pending, timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                url = started[future][0]
+                try:
+                    result, seconds = future.result()
+                except Exception as e:
+                    errors[url] = e
+                    continue
+                lost = {u: time.perf_counter() - t for f, (u, t) in started.items()
+                        if f in pending}
+                return url, result, seconds, errors, lost
+            if more and (done or time.monotonic() >= next_at):
+                # отказ не ждёт сдвига — сразу пробуем следующее
+                pending.add(launch())
+                next_at = time.monotonic() + stagger
+            elif not pending and not more:
+                raise errors[urls[0]]
+    finally:
+        abort.set()
+        pool.shutdown(wait=False)
+
+
+# ─────────────────────────────────────────────
+# История конвертаций
+# ─────────────────────────────────────────────
+#
+# Строки лога пропадают при очистке, а рост подписки или времени конвертации
+# виден только за недели. Каждое обновление пишется строкой в history.db:
+# объём загрузки, время этапов, узлы и группы, удалённые по типам, попадания
+# в кеш этапов и сколько запросов отдал сервер с прошлой конвертации.
+
+HISTORY_FILE = APP_DIR / "history.db"
+HISTORY_KEEP = 5000   # записей; старые удаляются при вставке
+HISTORY_COLUMNS = ("ts", "ok", "download_bytes", "total_sec", "proxies", "groups",
+                   "cached_stages", "served_requests", "served_bytes", "rss",
+                   "timings", "removed")
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+HISTORY_SPARK_POINTS = 40   # последних записей на графике
+HISTORY_TABLE_ROWS = 8
+
+_traffic_lock = threading.Lock()
+_traffic = {"requests": 0, "bytes": 0}
+
+
+def count_served(nbytes: int):
+    with _traffic_lock:
+        _traffic["requests"] += 1
+        _traffic["bytes"] += nbytes
+
+
+def take_traffic() -> dict:
+    """Отданное сервером с прошлого вызова; счётчики обнуляются."""
+    with _traffic_lock:
+        taken = dict(_traffic)
+        _traffic.update(requests=0, bytes=0)
+    return taken
+
+
+def _history_db() -> sqlite3.Connection:
+    # соединение на вызов: пишет поток конвертации, читает окно
+    conn = sqlite3.connect(HISTORY_FILE, timeout=5)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS conversions ("
+        "ts REAL NOT NULL, ok INTEGER, download_bytes INTEGER, total_sec REAL, "
+        "proxies INTEGER, groups INTEGER, cached_stages INTEGER, served_requests INTEGER, "
+        "served_bytes INTEGER, rss INTEGER, timings TEXT, removed TEXT)")
+    conn.execute("CREATE INDEX IF NOT EXISTS conversions_ts ON conversions (ts)")
+    return conn
+
+
+def record_history(row: dict):
+    values = [row.get(k) for k in HISTORY_COLUMNS]
+    for i, k in enumerate(HISTORY_COLUMNS):
+        if k in ("timings", "removed"):
+            values[i] = json.dumps(values[i] or {}, ensure_ascii=False, separators=(",", ":"))
+    conn = _history_db()
+    try:
+        with conn:
+            conn.execute(f"INSERT INTO conversions ({', '.join(HISTORY_COLUMNS)}) "
+                         f"VALUES ({', '.join('?' * len(HISTORY_COLUMNS))})", values)
+            conn.execute("DELETE FROM conversions WHERE ts < (SELECT ts FROM conversions "
+                         "ORDER BY ts DESC LIMIT 1 OFFSET ?)", (HISTORY_KEEP - 1,))
+    finally:
+        conn.close()
+
+
+def load_history(limit: int | None = None) -> list:
+    """Записи по возрастанию времени; limit — только последние."""
+    conn = _history_db()
+    try:
+        rows = conn.execute(
+            f"SELECT {', '.join(HISTORY_COLUMNS)} FROM conversions "
+            f"ORDER BY ts DESC LIMIT ?", (-1 if limit is None else limit,)).fetchall()
+    finally:
+        conn.close()
+    records = []
+    for values in reversed(rows):
+        record = dict(zip(HISTORY_COLUMNS, values))
+        for k in ("timings", "removed"):
+            try:
+                record[k] = json.loads(record[k] or "{}")
+            except ValueError:
+                record[k] = {}
+        records.append(record)
+    return records
+
+
+def export_history_csv(path) -> int:
+    """Вся история в CSV, этапы и удалённые типы — отдельными колонками. Возвращает число строк."""
+    records = load_history()
+    stages = sorted({k for r in records for k in r["timings"]},
+                    key=lambda k: (list(STAGE_LABELS).index(k) if k in STAGE_LABELS else 99, k))
+    removed = sorted({k for r in records for k in r["removed"]})
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["time", *HISTORY_COLUMNS[1:-2],
+                         *(f"stage_{k}" for k in stages), *(f"removed_{k}" for k in removed)])
+        for r in records:
+            writer.writerow([
+                datetime.fromtimestamp(r["ts"]).isoformat(timespec="seconds"),
+                *(r[k] for k in HISTORY_COLUMNS[1:-2]),
+                *(round(r["timings"].get(k, 0.0), 3) for k in stages),
+                *(r["removed"].get(k, 0) for k in removed),
+            ])
+    return len(records)
+
+
+def sparkline(values: list) -> str:
+    values = [v for v in values if v is not None]
+    if not values:
+        return ""
+    low, high = min(values), max(values)
+    span = (high - low) or 1
+    return "".join(SPARK_CHARS[int((v - low) / span * (len(SPARK_CHARS) - 1))] for v in values)
 
 
 # ─────────────────────────────────────────────
 # Поток конвертации
 # ─────────────────────────────────────────────
 
+class JobCancelled(Exception):
+    pass
+
+
+class JobDeadlineExceeded(Exception):
+    pass
+
+
+class ConvertJob:
+    """Одна конвертация: URL, настройки, флаг отмены, дедлайн и время этапов."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, url: str, options: dict | None = None, deadline_sec: float = JOB_DEADLINE,
+                 reuse: bool = False):
+        self.id = next(ConvertJob._ids)
+        self.url = url
+        self.options = dict(options or {})
+        self.reuse = reuse  # пересобрать из последней загрузки, если URL тот же
+        self.deadline_sec = deadline_sec
+        self.deadline = float("inf")
+        self.timings: dict = {}
+        self.stats: dict = {}  # для истории: объём загрузки, узлы, группы...
+        self.ok = False
+        self._cancel = threading.Event()
+
+    def begin(self):
+        self.deadline = time.monotonic() + self.deadline_sec
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def checkpoint(self):
+        if self._cancel.is_set():
+            raise JobCancelled()
+        if self.remaining() <= 0:
+            raise JobDeadlineExceeded()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        self.checkpoint()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - t0
+
+
+class SourceDocument:
+    """Последняя загрузка подписки: хеш тела, заголовок трафика, разобранный YAML блобом на диске."""
+
+    def __init__(self, url: str, key: str, data: dict, sub_hdr: str):
+        self.url = url
+        self.key = key
+        self.sub_hdr = sub_hdr
+        # адрес API ядра нужен задержкам и push до разбора блоба
+        self.meta = {k: data.get(k) for k in ("external-controller", "secret")}
+        self.path = STAGE_CACHE_DIR / "source.bin"
+        blob = pack_blob(data)
+        # на диск не записалось — держим блоб в памяти
+        self._blob = None if spill_blob(self.path, blob) else blob
+
+    def available(self) -> bool:
+        return self._blob is not None or self.path.is_file()
+
+    def data(self) -> dict:
+        if self._blob is not None:
+            return unpack_blob(self._blob)
+        data = load_blob(self.path)
+        if data is None:
+            raise ValueError("Кеш разобранной подписки недоступен — нужна новая загрузка")
+        return data
+
+
+STAGE_LABELS = {"download": "скачивание", "parse": "разбор", "latency": "задержки",
+                "filter": "фильтр", "dns": "DNS", "dump": "запись"}
+
+
+def format_timings(timings: dict) -> str:
+    # порядок этапов берём из STAGE_LABELS: Qt-сигнал не сохраняет порядок ключей
+    order = [k for k in STAGE_LABELS if k in timings] + [k for k in timings if k not in STAGE_LABELS]
+    parts = [f"{STAGE_LABELS.get(k, k)} {timings[k]:.2f} с" for k in order]
+    parts.append(f"всего {sum(timings.values()):.2f} с")
+    return " · ".join(parts)
+
+
 class ConvertWorker(QThread):
+    """
+    Постоянный поток конвертации с очередью из одного места: новая задача
+    вытесняет ещё не начатую, текущую можно отменить между этапами.
+    """
     log_message    = Signal(str, str)
-    finished       = Signal()
-    sub_info_ready = Signal(dict, str)
+    job_finished   = Signal(dict)
+    snapshot_published = Signal(object)
 
-    def __init__(self, url: str):
+    def __init__(self):
         super().__init__()
-        self.url = url
+        self._cond = threading.Condition()
+        self._pending: ConvertJob | None = None
+        self._current: ConvertJob | None = None
+        self._stopping = False
+        self._pusher = ReloadPusher(self.log_message.emit)
+        self._last_digest: str | None = None
+        self._source: SourceDocument | None = None
+
+    @property
+    def busy(self) -> bool:
+        with self._cond:
+            return self._pending is not None or self._current is not None
+
+    def submit(self, job: ConvertJob) -> bool:
+        """Ставит задачу в очередь. True — если она вытеснила ожидавшую."""
+        with self._cond:
+            superseded = self._pending is not None
+            self._pending = job
+            self._cond.notify()
+        return superseded
+
+    def cancel(self):
+        with self._cond:
+            self._pending = None
+            if self._current:
+                self._current.cancel()
+
+    def stop(self, timeout_ms: int = 3000):
+        self._pusher.cancel()
+        with self._cond:
+            self._stopping = True
+            self._pending = None
+            if self._current:
+                self._current.cancel()
+            self._cond.notify()
+        self.wait(timeout_ms)
 
     def run(self):
-        global _sub_header, _sub_info
+        while True:
+            with self._cond:
+                while self._pending is None and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                job, self._pending = self._pending, None
+                self._current = job
+            job.begin()
+            self._run_job(job)
+            with self._cond:
+                self._current = None
+            # text/data из _run_job уже недостижимы — отдаём память системе
+            rss = release_memory()
+            if not job.cancelled:
+                self._record_history(job, rss)
+            self.job_finished.emit({
+                "id": job.id, "ok": job.ok, "cancelled": job.cancelled,
+                "timings": dict(job.timings), "rss": rss,
+            })
+
+    def _record_history(self, job: ConvertJob, rss: int | None):
+        traffic = take_traffic()
         try:
-            self.log_message.emit("Начинаю обработку...", "accent")
-            download_url = prepare_url(self.url)
-            if download_url != self.url:
-                self.log_message.emit("Hiddify: добавлен фильтр протоколов", "info")
+            record_history({
+                **job.stats, "ts": time.time(), "ok": int(job.ok),
+                "total_sec": round(sum(job.timings.values()), 3),
+                "timings": {k: round(v, 3) for k, v in job.timings.items()}, "rss": rss,
+                "served_requests": traffic["requests"], "served_bytes": traffic["bytes"],
+            })
+        except (sqlite3.Error, OSError) as e:
+            self.log_message.emit(f"История не записана: {e}", "warning")
+
+    def _fetch_source(self, job: ConvertJob) -> tuple:
+        """Скачивает подписку; разбирает YAML, только если тело изменилось. (source, data|None)"""
+        if prepare_url(self.url) != self.url:
+            self.log_message.emit("Hiddify: добавлен фильтр протоколов", "info")
+
+        self.log_message.emit("Скачиваю конфиг...", "info")
+        with job.stage("download"):
+            text, resp_headers = self._download_mirrors(job)
+        self.log_message.emit(f"Скачано: {len(text):,} символов", "success")
+
+        headers_ci = {k.lower(): v for k, v in resp_headers.items()}
+        sub_hdr = ""
+        for name in ("subscription-userinfo", "x-subscription-userinfo", "profile-userinfo"):
+            sub_hdr = headers_ci.get(name, "")
+            if sub_hdr:
+                break
+
+        raw = text.encode("utf-8")
+        job.stats["download_bytes"] = len(raw)
+        key = hashlib.sha1(raw).hexdigest()
+        source = self._source
+        if (source is not None and source.url == self.url and source.key == key
+                and source.available()):
+            self.log_message.emit("Подписка не изменилась — разбор пропущен", "info")
+            source.sub_hdr = sub_hdr
+            return source, None
+
+        self.log_message.emit("Парсю YAML...", "info")
+        with job.stage("parse"):
+            data = yaml.safe_load(text)
+        if not isinstance(data, dict):
+            raise ValueError("Не Clash YAML — ожидался словарь")
+        self._source = SourceDocument(self.url, key, data, sub_hdr)
+        return self._source, data
+
+    def _download_mirrors(self, job: ConvertJob) -> tuple:
+        """Основной URL и зеркала из настройки mirrors — гонкой, см. race_mirrors."""
+        configured = self.options.get("mirrors") or {}
+        urls = list(dict.fromkeys([self.url, *(configured.get(self.url) or [])]))
+        if len(urls) == 1:
+            return self._download(job, prepare_url(self.url))
+
+        stats = MirrorStats.load()
+        urls = stats.rank(urls)
+        keep = {u for primary, extra in configured.items() for u in [primary, *(extra or [])]}
+        self.log_message.emit(
+            f"Зеркал: {len(urls)}, порядок: {', '.join(urlparse(u).hostname or u for u in urls)}",
+            "info")
+        def fetch(u, abort):
+            text, headers = self._download(job, prepare_url(u), abort)
+            if not looks_like_config(text):
+                raise ValueError("ответ не похож на конфиг")
+            return text, headers
 
-            self.log_message.emit("Скачиваю конфиг...", "info")
-            resp = requests.get(download_url, headers=HEADERS, timeout=20)
+        try:
+            url, result, seconds, errors, lost = race_mirrors(urls, fetch, job)
+        except (JobCancelled, JobDeadlineExceeded):
+            raise
+        except Exception:
+            for u in urls:
+                stats.record_fail(u)
+            stats.save(keep)
+            raise
+        for u, e in errors.items():
+            stats.record_fail(u)
+            self.log_message.emit(f"Зеркало {urlparse(u).hostname}: {e}", "warning")
+        for u, lost_sec in lost.items():
+            stats.record_lost(u, lost_sec)
+        stats.record_ok(url, seconds)
+        stats.save(keep)
+        self.log_message.emit(
+            f"Ответило зеркало {urlparse(url).hostname} за {seconds * 1000:.0f} мс"
+            + (f", оборвано загрузок: {len(lost)}" if lost else ""), "success")
+        return result
+
+    def _download(self, job: ConvertJob, url: str, abort: threading.Event | None = None):
+        timeout = max(min(20.0, job.remaining()), 0.1)
+        record = bool(self.options.get("record_upstream"))
+        t0 = time.perf_counter()
+        with requests.get(url, headers=HEADERS, timeout=(min(10.0, timeout), timeout),
+                          stream=True) as resp:
+            ttfb = time.perf_counter() - t0
+            if not record:
+                resp.raise_for_status()
+            chunks = []
+            for chunk in resp.iter_content(DOWNLOAD_CHUNK):
+                job.checkpoint()
+                if abort is not None and abort.is_set():
+                    raise MirrorCancelled()
+                chunks.append(chunk)
+            body = b"".join(chunks)
+            headers = dict(resp.headers)
+            encoding = resp.encoding
+        if record:
+            # пишем и неудачные ответы — их-то обычно и нужно воспроизвести
+            path = save_recording(url, resp.status_code, headers, body,
+                                  {"ttfb": ttfb, "total": time.perf_counter() - t0})
+            self.log_message.emit(f"Ответ провайдера записан: {path.name}", "info")
             resp.raise_for_status()
-            resp.encoding = resp.apparent_encoding or "utf-8"
-            text = resp.text
-            self.log_message.emit(f"Скачано: {len(text):,} символов", "success")
-
-            sub_hdr = resp.headers.get("subscription-userinfo", "")
-            if not sub_hdr:
-                for alt in ("x-subscription-userinfo", "profile-userinfo"):
-                    sub_hdr = resp.headers.get(alt, "")
-                    if sub_hdr:
-                        break
-            _sub_header = sub_hdr
-            _sub_info   = parse_subscription_info(sub_hdr)
-
-            self.log_message.emit("Парсю YAML...", "info")
-            data = yaml.safe_load(text)
-            if not isinstance(data, dict):
-                raise ValueError("Не Clash YAML — ожидался словарь")
+        try:
+            text = body.decode("utf-8")
+        except UnicodeDecodeError:
+            text = body.decode(encoding or "latin-1", errors="replace")
+        return text, headers
 
-            self.log_message.emit("Фильтрую протоколы и группы...", "info")
-            clean_config, removed, proxy_cnt, group_cnt, main_group = process_config(data)
+    def _run_job(self, job: ConvertJob):
+        self.url, self.options = job.url, job.options
+        try:
+            self.log_message.emit("Начинаю обработку...", "accent")
+            source = self._source
+            data = None
+            if (job.reuse and source is not None and source.url == self.url
+                    and source.available()):
+                self.log_message.emit("Пересобираю из последней загрузки...", "info")
+            else:
+                source, data = self._fetch_source(job)
+
+            latency = None
+            if self.options.get("latency_order"):
+                with job.stage("latency"):
+                    latency = self._collect_latency(job, source.meta)
 
-            if removed:
-                removed_str = ", ".join(f"{t}({n})" for t, n in sorted(removed.items()))
+            self.log_message.emit("Фильтрую протоколы и группы...", "info")
+            with job.stage("filter"):
+                clean_config, stats = process_config(
+                    data if data is not None else source.data, self.options, latency, source.key)
+            cached = [name for name, hit in stats["stages"].items() if hit]
+            job.stats.update(proxies=stats["proxies"], groups=stats["groups"],
+                             removed=stats["removed"], cached_stages=len(cached))
+            if cached:
+                self.log_message.emit(
+                    f"Из кеша этапов: {', '.join(cached)} "
+                    f"({len(cached)}/{len(stats['stages'])})", "info")
+
+            if stats["removed"]:
+                removed_str = ", ".join(f"{t}({n})" for t, n in sorted(stats["removed"].items()))
                 self.log_message.emit(f"Удалены протоколы: {removed_str}", "warning")
+            if stats["invalid"]:
+                self._log_invalid(stats["invalid"])
+            if stats["duplicates"]:
+                self.log_message.emit(f"Удалены дубли узлов: {stats['duplicates']}", "info")
+            if stats["demoted"]:
+                self.log_message.emit(
+                    f"Не отвечают {LATENCY_DEAD_STREAK}+ раз подряд — в конец групп: "
+                    f"{stats['demoted']}", "warning")
+            if stats["split_groups"]:
+                self.log_message.emit(
+                    f"Разделено больших групп: {stats['split_groups']} — "
+                    f"теперь групп {stats['groups']}", "info")
+            if stats["rule_hits"]:
+                self._log_rule_hits(stats["rule_hits"])
+
+            if self.options.get("dns_prefetch") or self.options.get("dns_pin"):
+                self.log_message.emit("Разрешаю адреса серверов...", "info")
+                with job.stage("dns"):
+                    dns = prefetch_dns(clean_config["proxies"], bool(self.options.get("dns_pin")),
+                                       total_timeout=max(job.remaining(), 0.1))
+                self._log_dns(dns)
+
+            with job.stage("dump"):
+                push = None
+                if self.options.get("split_providers"):
+                    push, files = self._write_providers(clean_config, stats["regions"])
+                else:
+                    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+                    header_comment = (
+                        f"# Очищенный конфиг Clash Meta\n"
+                        f"# Источник: {self.url}\n"
+                        f"# Обработано: {now}\n\n"
+                    )
+                    as_json = bool(self.options.get("json_output"))
+                    if as_json:
+                        # комментарий сделал бы файл невалидным JSON
+                        header_comment = ""
+                    text = dump_config(clean_config, as_json)
+                    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
+                        f.write(header_comment + text)
+                    files = snapshot_files(header_comment + text)
+                    self.log_message.emit(f"✓ Сохранено: {OUTPUT_FILE.name}", "success")
+                    # метка времени в шапке меняется всегда — сравниваем только тело
+                    digest = config_digest(text)
+                    if self._last_digest is None:
+                        # после перезапуска Clash уже загрузил отданный прошлым запуском
+                        served = current_snapshot().files.get(f"/{OUTPUT_FILE.name}")
+                        if served is not None:
+                            self._last_digest = config_digest(
+                                served[0].decode("utf-8", errors="replace"))
+                    if digest != self._last_digest:
+                        self._last_digest = digest
+                        push = (header_comment + text, ())
+
+            if latency is not None:
+                latency.names = stats["name_keys"]
+                latency.save()
+            if push and self.options.get("push_reload"):
+                controller = self._controller(source.meta)
+                if controller is None:
+                    self.log_message.emit("Push: не задан external-controller", "warning")
+                else:
+                    self._pusher.schedule(controller, *push)
 
-            now = datetime.now().strftime("%Y-%m-%d %H:%M")
-            header_comment = (
-                f"# Очищенный конфиг Clash Meta\n"
-                f"# Источник: {self.url}\n"
-                f"# Обработано: {now}\n\n"
+            # Заголовок подписки публикуем только вместе с новым конфигом
+            snapshot = Snapshot(
+                files, source.sub_hdr, parse_subscription_info(source.sub_hdr), time.time(),
+                {k: stats[k] for k in ("proxies", "groups", "main_group")},
+                pack_blob(clean_config),
             )
-            yaml_text = yaml.dump(clean_config, allow_unicode=True, sort_keys=False,
-                                  width=4096, default_flow_style=False)
-            with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-                f.write(header_comment + yaml_text)
-
-            self.log_message.emit(f"✓ Сохранено: {OUTPUT_FILE.name}", "success")
+            publish_snapshot(snapshot)
             self.log_message.emit(
-                f"✓ Прокси: {proxy_cnt}  Группы: {group_cnt}  Главная: {main_group}", "success"
+                f"✓ Прокси: {stats['proxies']}  Группы: {stats['groups']}  "
+                f"Главная: {stats['main_group']}", "success"
             )
-            self.sub_info_ready.emit(_sub_info, _sub_header)
+            self.snapshot_published.emit(snapshot)
+            job.ok = True
 
+        except JobCancelled:
+            self.log_message.emit("⏹ Конвертация отменена", "warning")
+        except JobDeadlineExceeded:
+            self.log_message.emit(
+                f"❌ Конвертация не уложилась в {job.deadline_sec:g} с", "error"
+            )
         except requests.exceptions.ConnectionError:
             self.log_message.emit("❌ Ошибка подключения. Проверьте URL и интернет.", "error")
         except requests.exceptions.Timeout:
-            self.log_message.emit("❌ Сервер не ответил за 20 секунд.", "error")
+            self.log_message.emit("❌ Сервер не ответил вовремя.", "error")
         except requests.exceptions.HTTPError as e:
             self.log_message.emit(f"❌ HTTP ошибка: {e}", "error")
         except yaml.YAMLError as e:
             self.log_message.emit(f"❌ Невалидный YAML: {e}", "error")
         except Exception as e:
             self.log_message.emit(f"❌ Ошибка: {e}", "error")
+
+    def _controller(self, meta: dict) -> ClashController | None:
+        address = self.options.get("controller") or meta.get("external-controller")
+        if not address:
+            return None
+        return ClashController(address,
+                               self.options.get("controller_secret") or meta.get("secret") or "")
+
+    def _collect_latency(self, job: ConvertJob, meta: dict) -> LatencyHistory:
+        history = LatencyHistory.load()
+        controller = self._controller(meta)
+        if controller is None:
+            self.log_message.emit("Задержки: не задан external-controller", "warning")
+            return history
+        if not history.names:
+            return history  # узлы отданного конфига станут известны после этой конвертации
+        try:
+            st = collect_delays(controller, history,
+                                budget=min(LATENCY_BUDGET, max(job.remaining() / 3, 0.1)))
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self.log_message.emit(f"Задержки: Clash API недоступен ({e})", "warning")
+            return history
+        msg = (f"Задержки: из проверок ядра {st['passive']}, замерено {st['probed']}, "
+               f"не ответили {st['dead']}")
+        if st["skipped"]:
+            msg += f", отложено {st['skipped']}"
+        self.log_message.emit(msg, "info")
+        return history
+
+    def _write_providers(self, clean_config: dict, regions: dict):
+        port = int(self.options.get("port", DEFAULT_PORT))
+        as_json = bool(self.options.get("json_output"))
+        base, shards = split_providers(clean_config, regions, port)
+        PROVIDERS_DIR.mkdir(exist_ok=True)
+        changed = []
+        texts = {}
+        for name, items in shards.items():
+            texts[name] = dump_config({"proxies": items}, as_json)
+            if write_if_changed(PROVIDERS_DIR / f"{name}.yaml", texts[name]):
+                changed.append(name)
+        for path in PROVIDERS_DIR.glob("*.yaml"):
+            if path.stem not in shards:
+                path.unlink(missing_ok=True)
+        # Без метки времени: база меняется только вместе с содержимым,
+        # и клиенты не перекачивают её по ETag без нужды
+        header_comment = "" if as_json else (
+            f"# Очищенный конфиг Clash Meta (proxy-providers)\n"
+            f"# Источник: {self.url}\n\n"
+        )
+        base_text = header_comment + dump_config(base, as_json)
+        base_changed = write_if_changed(OUTPUT_FILE, base_text)
+        self.log_message.emit(
+            f"✓ Провайдеры: {len(shards)}, изменено {len(changed)}; "
+            f"{OUTPUT_FILE.name} {'обновлён' if base_changed else 'без изменений'}", "success"
+        )
+        files = snapshot_files(base_text, texts)
+        # что отправить в Clash: база целиком или только изменённые провайдеры
+        if base_changed:
+            return (base_text, ()), files
+        if changed:
+            return (None, changed), files
+        return None, files
+
+    def _log_dns(self, dns: dict, limit: int = 10):
+        msg = f"DNS: хостов {dns['hosts']}, из кеша {dns['cached']}"
+        if dns["pinned"]:
+            msg += f", IP подставлен в {dns['pinned']} узлов"
+        self.log_message.emit(msg, "info")
+        if dns["unknown"]:
+            self.log_message.emit(
+                f"Не успели разрешиться к сроку: {len(dns['unknown'])} хостов — узлы оставлены",
+                "warning")
+        if dns["dead"]:
+            self.log_message.emit(
+                f"Не разрешились ({len(dns['failed'])} хостов) — мёртвые узлы: {len(dns['dead'])}",
+                "warning",
+            )
+            for name in dns["dead"][:limit]:
+                self.log_message.emit(f"  {name}", "warning")
+            if len(dns["dead"]) > limit:
+                self.log_message.emit(f"  ...и ещё {len(dns['dead']) - limit}", "warning")
+
+    def _log_rule_hits(self, rule_hits: list):
+        self.log_message.emit("Пользовательские правила:", "info")
+        for label, n in rule_hits:
+            self.log_message.emit(f"  {label}: {n}", "info" if n else "warning")
+
+    def _log_invalid(self, invalid: list, limit: int = 10):
+        self.log_message.emit(f"Отброшены невалидные узлы: {len(invalid)}", "warning")
+        for name, errors in invalid[:limit]:
+            self.log_message.emit(f"  {name}: {'; '.join(errors)}", "warning")
+        if len(invalid) > limit:
+            self.log_message.emit(f"  ...и ещё {len(invalid) - limit}", "warning")
+
+
+# ─────────────────────────────────────────────
+# Запись и воспроизведение ответов провайдера
+# ─────────────────────────────────────────────
+#
+# "record_upstream": true — каждая загрузка сохраняется в fixtures/*.rec.gz:
+# строка JSON (url, статус, заголовки, время) и сырое тело. Запуск
+#   clash_app.py --replay fixtures/....rec.gz [--latency 300] [--bandwidth 512]
+# поднимает сервер, отдающий запись с задержкой и ограничением скорости,
+# а с --bench N ещё и прогоняет по ней весь конвейер N раз.
+
+FIXTURES_DIR = APP_DIR / "fixtures"
+# тело уже распаковано requests, длина и кодировка оригинала к нему не относятся
+_REPLAY_SKIP_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection"}
+
+
+def save_recording(url: str, status: int, headers: dict, body: bytes, timings: dict) -> Path:
+    FIXTURES_DIR.mkdir(exist_ok=True)
+    host = re.sub(r"[^\w.-]", "_", urlparse(url).hostname or "upstream")
+    path = FIXTURES_DIR / f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')[:-3]}-{host}.rec.gz"
+    meta = {"url": url, "status": status, "headers": headers, "timings": timings,
+            "size": len(body), "recorded": datetime.now().isoformat(timespec="seconds")}
+    with gzip.open(path, "wb") as f:
+        f.write(json.dumps(meta, ensure_ascii=False).encode("utf-8") + b"\n")
+        f.write(body)
+    return path
+
+
+def load_recording(path) -> tuple:
+    """(meta, body) из файла save_recording."""
+    with gzip.open(path, "rb") as f:
+        meta = json.loads(f.readline())
+        body = f.read()
+    return meta, body
+
+
+def make_replay_server(path, port: int = 0, latency_ms: float = 0,
+                       bandwidth_kbps: float = 0) -> http.server.ThreadingHTTPServer:
+    """
+    Сервер, отдающий запись на любой GET: тот же статус и заголовки,
+    задержка перед ответом latency_ms и скорость не выше bandwidth_kbps (КБ/с).
+    """
+    meta, body = load_recording(path)
+    headers = [(k, v) for k, v in meta["headers"].items()
+               if k.lower() not in _REPLAY_SKIP_HEADERS]
+    chunk = DOWNLOAD_CHUNK if not bandwidth_kbps else max(int(bandwidth_kbps * 1024 / 20), 1024)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if latency_ms:
+                time.sleep(latency_ms / 1000)
+            self.send_response(meta["status"])
+            for k, v in headers:
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            t0 = time.perf_counter()
+            for i in range(0, len(body), chunk):
+                self.wfile.write(body[i:i + chunk])
+                if bandwidth_kbps:
+                    ahead = (i + chunk) / (bandwidth_kbps * 1024) - (time.perf_counter() - t0)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def run_replay(args) -> int:
+    """Точка входа --replay: только сервер или, с --bench, прогон конвейера."""
+    global APP_DIR, OUTPUT_FILE, PROVIDERS_DIR, STAGE_CACHE_DIR
+    meta, _body = load_recording(args.replay)
+    server = make_replay_server(args.replay, args.replay_port, args.latency, args.bandwidth)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/sub"
+    print(f"Запись: {meta['url']} — HTTP {meta['status']}, {meta['size']:,} байт, "
+          f"записано {meta['recorded']}, TTFB {meta['timings']['ttfb'] * 1000:.0f} мс")
+    if not args.bench:
+        print(f"Воспроизведение: {url}  (Ctrl+C — выход)")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    # Прогон пишет результат во временный каталог, а не поверх clean.yaml
+    tmp = tempfile.TemporaryDirectory()
+    APP_DIR = Path(tmp.name)
+    OUTPUT_FILE = APP_DIR / OUTPUT_FILE.name
+    PROVIDERS_DIR = APP_DIR / PROVIDERS_DIR.name
+    STAGE_CACHE_DIR = APP_DIR / STAGE_CACHE_DIR.name
+    out = start_server(0)
+    options = {**load_settings(), "port": out.server_address[1],
+               "dns_prefetch": False, "dns_pin": False, "record_upstream": False,
+               "latency_order": False, "push_reload": False}
+    runs = []
+    for _ in range(args.bench):
+        # каждый прогон холодный: без кеша загрузки и этапов
+        clear_stage_cache()
+        worker = ConvertWorker()
+        job = ConvertJob(url, options, float(options.get("job_deadline") or JOB_DEADLINE))
+        job.begin()
+        worker._run_job(job)
+        if not job.ok:
+            print("Конвертация не удалась — см. запись")
+            return 1
+        t0 = time.perf_counter()
+        for path in (f"/{OUTPUT_FILE.name}", *RENDERERS):
+            requests.get(f"http://localhost:{out.server_address[1]}{path}", timeout=30).content
+        job.timings["serve"] = time.perf_counter() - t0
+        runs.append(job.timings)
+    stop_server()
+    server.shutdown()
+    tmp.cleanup()
+    print(f"Прогонов: {len(runs)} (медиана / минимум, мс)")
+    for name in [*STAGE_LABELS, "serve"]:
+        values = sorted(r[name] for r in runs if name in r)
+        if values:
+            print(f"  {STAGE_LABELS.get(name, 'отдача'):<12} "
+                  f"{values[len(values) // 2] * 1000:8.1f} {values[0] * 1000:8.1f}")
+    return 0
+
+
+# ─────────────────────────────────────────────
+# Микробенчмарки (--benchmark ИМЯ [--bench N])
+# ─────────────────────────────────────────────
+#
+# Замеры горячих мест на синтетических данных — без подписки, сети и GUI.
+# Подготовка вызывается один раз и возвращает прогон: {метка: секунды}.
+
+BENCHMARKS: dict = {}   # имя → (описание, подготовка)
+
+
+def benchmark(name: str, description: str):
+    def register(setup):
+        BENCHMARKS[name] = (description, setup)
+        return setup
+    return register
+
+
+def run_benchmark(name: str, runs: int) -> int:
+    description, setup = BENCHMARKS[name]
+    print(f"{name}: {description}")
+    once = setup()
+    results = [once() for _ in range(max(runs, 1))]
+    print(f"Прогонов: {len(results)} (медиана / минимум, мс)")
+    for label in results[0]:
+        values = sorted(r[label] for r in results)
+        print(f"  {label:<28} {values[len(values) // 2] * 1000:8.1f} {values[0] * 1000:8.1f}")
+    return 0
+
+
+def _timed(func, *args) -> float:
+    t0 = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - t0
+
+
+@contextlib.contextmanager
+def _scratch_app_dir():
+    """Файлы приложения (настройки, кеши, история) — во временном каталоге на время замера."""
+    root, saved = APP_DIR, {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, value in list(globals().items()):
+            if (name.endswith(("_FILE", "_DIR")) and isinstance(value, Path)
+                    and (value == root or root in value.parents)):
+                saved[name] = value
+                globals()[name] = Path(tmp) / value.relative_to(root)
+        try:
+            yield Path(tmp)
+        finally:
+            globals().update(saved)
+
+
+def _process_events(app, seconds: float):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        app.processEvents()
+        time.sleep(0.005)
+
+
+@benchmark("classify", "classify_region на 50 000 имён узлов")
+def _bench_classify():
+    samples = ["🇭🇰 Hong Kong {}", "JP-Tokyo-{}", "US {} | 1x", "узел Германия {}",
+               "Premium {} 香港", "剩余流量 {} GB", "[Relay] SG {}", "node-{}"]
+    names = [samples[i % len(samples)].format(i) for i in range(50000)]
+
+    def once():
+        classify_region.cache_clear()
+        cold = _timed(lambda: [classify_region(n) for n in names])
+        warm = _timed(lambda: [classify_region(n) for n in names])
+        return {"без кеша": cold, "из кеша": warm}
+    return once
+
+
+@benchmark("log", "100 000 строк лога: кольцевой буфер и вывод пачками")
+def _bench_log():
+    app = QApplication.instance() or QApplication([])
+    colors = [COLORS["text2"], COLORS["success"], COLORS["warning"], COLORS["danger"]]
+    messages = [(f"[12:00:00] Сообщение {i}: " + "x" * (i % 80), colors[i % 4])
+                for i in range(100000)]
+    batch = 10000   # столько строк успевает прийти за LOG_FLUSH_MS в худшем случае
+
+    def once():
+        edit = QPlainTextEdit()
+        edit.setMaximumBlockCount(LOG_CAPACITY)
+        formats: dict = {}
+        pending: deque = deque(maxlen=LOG_CAPACITY)
+        accept = flush = worst = 0.0
+        for start in range(0, len(messages), batch):
+            accept += _timed(pending.extend, messages[start:start + batch])
+            lines, pending = pending, deque(maxlen=LOG_CAPACITY)
+            took = _timed(append_log_lines, edit, lines, formats)
+            flush += took
+            worst = max(worst, took)
+        assert edit.document().blockCount() <= LOG_CAPACITY
+        app.processEvents()
+        return {"приём в буфер": accept, "вывод пачек, всего": flush, "худшая пачка": worst}
+    return once
+
+
+@benchmark("rules", "filter_proxies на 50 000 узлов: без правил и с правилами transform")
+def _bench_rules():
+    spec = {
+        "include": [{"keyword": "hk"}, {"field": "server", "regex": r"\.jp$"},
+                    {"regex": "(?i)vip"}],
+        "exclude": [{"keyword": "剩余流量"}, {"field": "type", "regex": "^vmess$"}],
+        "rename":  [{"regex": r"^\[VIP\]\s*", "replace": ""},
+                    {"regex": "HK", "replace": "Hong Kong"}],
+    }
+    labels = ["🇭🇰 HK", "🇯🇵 JP", "🇺🇸 US", "[VIP] SG", "剩余流量"]
+    proxies = [{"name": f"{labels[i % 5]} {i}", "type": ("ss", "vmess")[i % 2],
+                "server": f"s{i}.example.{('jp', 'com')[i % 2]}", "port": 443,
+                "cipher": "aes-128-gcm", "password": "p",
+                "uuid": "11111111-1111-1111-1111-111111111111", "alterId": 0}
+               for i in range(50000)]
+
+    def once():
+        # filter_proxies правит узлы на месте — каждому замеру свежие копии
+        plain = [dict(p) for p in proxies]
+        ruled = [dict(p) for p in proxies]
+        _compile_transform.cache_clear()
+        compile_time = _timed(get_transform, spec)
+        transform = get_transform(spec)
+        return {
+            "без правил": _timed(filter_proxies, plain),
+            "с правилами": _timed(filter_proxies, ruled, transform, {}),
+            "компиляция правил": compile_time,
+        }
+    return once
+
+
+@benchmark("json", "запись и чтение конфига на 5 000 узлов: YAML против компактного JSON")
+def _bench_json():
+    names = [f"🇭🇰 HK {i}" for i in range(5000)]
+    config = {
+        "proxies": [{"name": n, "type": "vless", "server": f"s{i}.example.com", "port": 443,
+                     "uuid": "11111111-1111-1111-1111-111111111111", "tls": True,
+                     "network": "ws", "ws-opts": {"path": f"/p{i}", "headers": {"Host": "cdn"}}}
+                    for i, n in enumerate(names)],
+        "proxy-groups": [{"name": "Выбор", "type": "select", "proxies": names}],
+        "rules": list(LOCAL_RULES) + ["MATCH,Выбор"],
+    }
+    as_yaml, as_json = dump_config(config), dump_config(config, as_json=True)
+    engine = "orjson" if orjson is not None else "json"
+
+    def once():
+        return {
+            "запись YAML": _timed(dump_config, config),
+            f"запись JSON ({engine})": _timed(dump_config, config, True),
+            "чтение YAML": _timed(load_config_text, as_yaml),
+            "чтение JSON": _timed(load_config_text, as_json),
+        }
+    return once
+
+
+@benchmark("startup", "ClashApp до видимого трея: ленивое окно (--minimized) и полное")
+def _bench_startup():
+    app = QApplication.instance() or QApplication([])
+
+    def start(minimized: bool) -> float:
+        with _scratch_app_dir():
+            save_settings({"port": 0})
+            t0 = time.perf_counter()
+            window = ClashApp(start_minimized=minimized)
+            assert window._tray.isVisible()
+            took = time.perf_counter() - t0
+            # отложенное сворачивание в трей должно отработать до разбора окна
+            _process_events(app, 0.15)
+            for timer in window.findChildren(QTimer):
+                timer.stop()
+            window._worker.stop()
+            stop_server()
+            window._tray.hide()
+            window.hide()
+            window.deleteLater()
+            _process_events(app, 0.01)
+        return took
+
+    def once():
+        return {"трей, окно лениво": start(True), "трей и полное окно": start(False)}
+    return once
+
+
+@benchmark("server_start", "start_server до первого ответа: свободный и занятый первый порт")
+def _bench_server_start():
+    def start(busy: bool) -> float:
+        with socket.socket() as blocker:
+            blocker.bind(("127.0.0.1", 0))
+            blocker.listen()
+            port = blocker.getsockname()[1] if busy else 0
+            t0 = time.perf_counter()
+            server = start_server(port, span=8)
+            resp = requests.get(
+                f"http://127.0.0.1:{server.server_address[1]}/{OUTPUT_FILE.name}", timeout=5)
+            took = time.perf_counter() - t0
+            stop_server()
+        assert resp.status_code == 200
+        return took
+
+    def once():
+        saved = _snapshot
+        publish_snapshot(Snapshot(snapshot_files("proxies: []\n"), created=time.time()))
+        try:
+            return {"свободный порт": start(False), "первый порт занят": start(True)}
         finally:
-            self.finished.emit()
+            publish_snapshot(saved)
+    return once
+
+
+# ─────────────────────────────────────────────
+# Один экземпляр
+# ─────────────────────────────────────────────
+#
+# Автозапуск плюс ручной клик давали две копии: вторая молча занимала
+# следующий порт и качала подписку параллельно. Теперь первая копия держит
+# QLockFile и слушает QLocalServer, а вторая передаёт ей команды
+# ("show", "convert") и сразу выходит.
+
+INSTANCE_CONNECT_TIMEOUT = 3.0  # секунд ждать, пока первая копия начнёт слушать
+
+
+def instance_key() -> str:
+    """Имя канала: своё для каждого пользователя и каталога приложения."""
+    user = os.environ.get("USERNAME") or os.environ.get("USER") or ""
+    digest = hashlib.sha1(f"{user}|{APP_DIR}".encode("utf-8")).hexdigest()[:12]
+    return f"{APP_NAME.replace(' ', '')}-{digest}"
+
+
+class InstanceGuard(QObject):
+    """Блокировка единственного экземпляра и приём команд от повторных запусков."""
+
+    command = Signal(list)
+
+    def __init__(self):
+        super().__init__()
+        self.key = instance_key()
+        self._lock = QLockFile(str(APP_DIR / "instance.lock"))
+        # устаревшей блокировку делает только смерть процесса-владельца,
+        # а не возраст файла — приложение работает неделями
+        self._lock.setStaleLockTime(0)
+        self._locked = False
+        self._server: QLocalServer | None = None
+
+    def acquire(self) -> bool:
+        """False — блокировку держит работающая копия, команды нужно передать ей."""
+        if self._lock.tryLock(0):
+            self._locked = True
+            return True
+        error = self._lock.error()
+        if error == QLockFile.LockError.LockFailedError:
+            return False
+        # нет прав на каталог и т. п.: о второй копии ничего не известно —
+        # запускаемся без защиты, а не молча выходим
+        logging.getLogger("clash_app").warning(
+            "Блокировка экземпляра недоступна (%s) — запуск без неё", error.name)
+        return True
+
+    def listen(self):
+        if not self._locked:
+            return
+        self._server = QLocalServer(self)
+        # сокет от упавшей копии (Unix) мешает listen — блокировка уже наша
+        QLocalServer.removeServer(self.key)
+        self._server.setSocketOptions(QLocalServer.SocketOption.UserAccessOption)
+        self._server.newConnection.connect(self._on_connection)
+        if not self._server.listen(self.key):
+            logging.getLogger("clash_app").warning(
+                "Канал команд не открыт: %s", self._server.errorString())
+
+    def release(self):
+        if self._server is not None:
+            self._server.close()
+        if self._locked:
+            self._lock.unlock()
+            self._locked = False
+
+    def _on_connection(self):
+        while self._server.hasPendingConnections():
+            sock = self._server.nextPendingConnection()
+            sock.readyRead.connect(lambda s=sock: self._read(s))
+            sock.disconnected.connect(sock.deleteLater)
+
+    def _read(self, sock: QLocalSocket):
+        if not sock.canReadLine():
+            return
+        try:
+            commands = json.loads(bytes(sock.readLine()).decode("utf-8"))
+        except ValueError:
+            commands = None
+        sock.write(b"ok\n")
+        sock.flush()
+        sock.disconnectFromServer()
+        if isinstance(commands, list):
+            self.command.emit([str(c) for c in commands])
+
+    def forward(self, commands: list, timeout: float = INSTANCE_CONNECT_TIMEOUT) -> bool:
+        """Передаёт команды работающей копии. False — она не ответила."""
+        deadline = time.monotonic() + timeout
+        while True:
+            sock = QLocalSocket()
+            sock.connectToServer(self.key)
+            if sock.waitForConnected(200):
+                sock.write(json.dumps(commands).encode("utf-8") + b"\n")
+                if (sock.waitForBytesWritten(500) and sock.waitForReadyRead(1000)
+                        and bytes(sock.readLine()).strip() == b"ok"):
+                    return True
+                return False
+            # первая копия ещё стартует и не успела открыть канал
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
 
 
 # ─────────────────────────────────────────────
@@ -579,7 +4058,7 @@ QLineEdit {{
 }}
 QLineEdit:focus     {{ border: 1px solid {COLORS['accent']}; }}
 QLineEdit:read-only {{ color: {COLORS['accent']}; }}
-QTextEdit {{
+QPlainTextEdit {{
     background-color: {COLORS['input_bg']};
     color: {COLORS['text']};
     border: 1px solid {COLORS['border']};
@@ -726,20 +4205,68 @@ class SubInfoDialog(QDialog):
 # Главное окно
 # ─────────────────────────────────────────────
 
+def append_log_lines(edit: QPlainTextEdit, lines, formats: dict):
+    """
+    Дописывает пачку [(текст, цвет)] в конец лога одним блоком правки.
+    formats — кеш QTextCharFormat по цвету. Прокрутка идёт за концом,
+    только если лог и так был прокручен до конца.
+    """
+    bar = edit.verticalScrollBar()
+    at_bottom = bar.value() >= bar.maximum() - 4
+    doc = edit.document()
+    first = doc.isEmpty()
+    cursor = QTextCursor(doc)
+    cursor.movePosition(QTextCursor.End)
+    cursor.beginEditBlock()
+    for text, color in lines:
+        fmt = formats.get(color)
+        if fmt is None:
+            fmt = formats[color] = QTextCharFormat()
+            fmt.setForeground(QColor(color))
+        if not first:
+            cursor.insertBlock()
+        first = False
+        cursor.insertText(text, fmt)
+    cursor.endEditBlock()
+    if at_bottom:
+        bar.setValue(bar.maximum())
+
+
 class ClashApp(QMainWindow):
+    stale_refresh = Signal()   # из потока сервера: конфиг устарел
+
     def __init__(self, start_minimized: bool = False):
         super().__init__()
 
         self.settings = load_settings()
+        # сервер с первого запроса отдаёт конфиг прошлого запуска
+        publish_snapshot(load_snapshot())
         saved_port = self.settings.get("port", DEFAULT_PORT)
-        self.port  = find_free_port(saved_port)
+        self._server_error: OSError | None = None
+        self._server_start_ms = 0.0
+        t0 = time.perf_counter()
+        configure_lan(self.settings.get("lan_devices"), self.settings.get("lan_rate"))
+        try:
+            server = start_server(saved_port, int(self.settings.get("port_range", PORT_RANGE)),
+                                  self._server_host())
+            self.port = server.server_address[1]
+        except OSError as e:
+            self.port = saved_port
+            self._server_error = e
+        self._server_start_ms = (time.perf_counter() - t0) * 1000
         if self.port != saved_port:
             self.settings["port"] = self.port
             save_settings(self.settings)
 
         self.server_url    = f"http://localhost:{self.port}/clean.yaml"
         self.is_converting = False
-        self._worker: ConvertWorker | None  = None
+        self._worker = ConvertWorker()
+        self._worker.log_message.connect(self._log)
+        self._worker.snapshot_published.connect(self._on_snapshot_published)
+        self._worker.job_finished.connect(self._convert_done)
+        self._worker.start()
+        # поток живёт всё время работы — останавливаем до разрушения QThread
+        QApplication.instance().aboutToQuit.connect(self._worker.stop)
         self._sub_dialog: SubInfoDialog | None = None
         self._autostart_state = get_autostart()
 
@@ -747,11 +4274,36 @@ class ClashApp(QMainWindow):
         self._toggle_btn: QPushButton | None       = None
         self._copy_btn_settings: QPushButton | None = None
         self._url_display: QLineEdit | None         = None
+        self._option_btns: dict[str, QPushButton]   = {}
+
+        # Лог: строки копятся в кольцевом буфере и выводятся пачкой по таймеру
+        self._log_pending: deque = deque(maxlen=LOG_CAPACITY)
+        self._log_formats: dict  = {}
+        self._log_timer = QTimer(self)
+        self._log_timer.setSingleShot(True)
+        self._log_timer.setInterval(LOG_FLUSH_MS)
+        self._log_timer.timeout.connect(self._flush_log)
+        self._file_log: logging.Logger | None = None
+        self._setup_file_log()
+
+        # Страницы строятся при первом показе окна: при --minimized
+        # сначала поднимается только трей
+        self._ui_built = False
+        self._settings_page: QWidget | None = None
+        self._last_timing = ""
 
         self._setup_window()
-        self._build_ui()
         self._setup_tray()
-        self._start_server_thread()
+        if not start_minimized:
+            self._ensure_ui()
+        self._log_server_status()
+        self._setup_settings_watcher()
+        self._setup_refresh_timer()
+        self._setup_stale_refresh()
+        self._lan_timer = QTimer(self)
+        self._lan_timer.timeout.connect(self._update_lan_ui)
+        self._lan_timer.start(5000)
+        self._log(f"Запуск до трея: {(time.perf_counter() - _STARTUP_T0) * 1000:.0f} мс", "info")
 
         if start_minimized:
             QTimer.singleShot(100, self._hide_to_tray)
@@ -786,8 +4338,7 @@ class ClashApp(QMainWindow):
         root.addWidget(self._hline())
 
         self._stacked = QStackedWidget()
-        self._stacked.addWidget(self._make_main_page())      # 0
-        self._stacked.addWidget(self._make_settings_page())  # 1
+        self._stacked.addWidget(self._make_main_page())      # 0, настройки (1) — при открытии
         self._stacked.currentChanged.connect(self._on_stack_changed)
         root.addWidget(self._stacked, 1)
 
@@ -919,7 +4470,7 @@ class ClashApp(QMainWindow):
             f"QPushButton:hover {{ background-color: #3a7be0; }}"
             f"QPushButton:disabled {{ background-color: {COLORS['btn']}; color: {COLORS['text2']}; }}"
         )
-        self._convert_btn.clicked.connect(self._start_convert)
+        self._convert_btn.clicked.connect(self._on_convert_clicked)
         lay.addWidget(self._convert_btn)
 
         # ── Прогресс ──
@@ -930,6 +4481,13 @@ class ClashApp(QMainWindow):
         self._progress.hide()
         lay.addWidget(self._progress)
 
+        self._timing_label = QLabel("")
+        self._timing_label.setStyleSheet(
+            f"font-size: 8pt; color: {COLORS['text2']}; background: transparent;"
+        )
+        self._timing_label.hide()
+        lay.addWidget(self._timing_label)
+
         # ── Блок подписки ──
         sub_card = QFrame()
         sub_card.setObjectName("card")
@@ -982,8 +4540,9 @@ class ClashApp(QMainWindow):
         log_hdr.addWidget(clear_btn)
         ll.addLayout(log_hdr)
 
-        self._log_edit = QTextEdit()
+        self._log_edit = QPlainTextEdit()
         self._log_edit.setReadOnly(True)
+        self._log_edit.setMaximumBlockCount(LOG_CAPACITY)
         self._log_edit.setMinimumHeight(170)
         ll.addWidget(self._log_edit)
         lay.addWidget(log_w)
@@ -1023,43 +4582,44 @@ class ClashApp(QMainWindow):
         lay.addWidget(self._section_label("ЗАПУСК"))
         lay.addWidget(self._hline())
 
-        autostart_card = QFrame()
-        autostart_card.setObjectName("card")
-        ac = QHBoxLayout(autostart_card)
-        ac.setContentsMargins(14, 14, 14, 14)
-
-        lcol = QVBoxLayout()
-        lcol.setSpacing(3)
-
-        lbl_row = QHBoxLayout()
-        a_ico = QLabel(); a_ico.setPixmap(_px("fa5s.rocket", COLORS["text"], 14))
-        a_ico.setStyleSheet("background: transparent;")
-        lbl_row.addWidget(a_ico)
-        m_lbl = QLabel("  Автозапуск с Windows")
-        m_lbl.setStyleSheet(f"font-weight: bold; color: {COLORS['text']}; background: transparent;")
-        lbl_row.addWidget(m_lbl)
-        lbl_row.addStretch()
-        lcol.addLayout(lbl_row)
-
-        s_lbl = QLabel("Запускать свёрнутым в трей при входе в систему")
-        s_lbl.setStyleSheet(f"font-size: 8pt; color: {COLORS['text2']}; background: transparent;")
-        lcol.addWidget(s_lbl)
-
-        rcol = QVBoxLayout()
-        rcol.setAlignment(Qt.AlignRight | Qt.AlignVCenter)
-        self._toggle_btn = QPushButton(
-            "Включён ✓" if self._autostart_state else "Отключён"
+        autostart_card, self._toggle_btn = self._make_toggle_card(
+            "fa5s.rocket", "Автозапуск с Windows",
+            "Запускать свёрнутым в трей при входе в систему",
+            self._autostart_state, self._toggle_autostart,
         )
-        self._toggle_btn.setFixedWidth(110)
-        self._toggle_btn.setStyleSheet(self._toggle_style(self._autostart_state))
-        self._toggle_btn.clicked.connect(self._toggle_autostart)
-        rcol.addWidget(self._toggle_btn)
-
-        ac.addLayout(lcol, 1)
-        ac.addLayout(rcol)
         lay.addWidget(autostart_card)
         lay.addSpacing(8)
 
+        # ── КОНВЕРТАЦИЯ ──
+        lay.addWidget(self._section_label("КОНВЕРТАЦИЯ"))
+        lay.addWidget(self._hline())
+
+        for key, icon, title, subtitle in (
+            ("region_groups", "fa5s.globe-europe", "Группы по странам",
+             "Создавать url-test группы по флагам и названиям стран в именах узлов"),
+            ("split_groups", "fa5s.sitemap", "Делить большие группы",
+             "Большие url-test/fallback группы — на подгруппы по регионам, "
+             "узлы проверяются реже"),
+            ("latency_order", "fa5s.tachometer-alt", "Сортировка по задержке",
+             "Брать задержки узлов из Clash API: быстрые — выше, мёртвые — в конец групп"),
+            ("push_reload", "fa5s.bolt", "Мгновенное применение",
+             "После конвертации сразу перезагружать конфиг в Clash через API"),
+            ("split_providers", "fa5s.layer-group", "Узлы через proxy-providers",
+             "Отдавать узлы отдельными файлами по регионам — клиент перекачивает только изменённые"),
+            ("dns_prefetch", "fa5s.network-wired", "Проверка DNS серверов",
+             "Заранее разрешать адреса узлов и сообщать о неразрешимых"),
+            ("dns_pin", "fa5s.thumbtack", "Подставлять IP",
+             "Записывать IP вместо имени сервера, имя остаётся в sni/servername"),
+            ("json_output", "fa5s.file-code", "Компактный JSON",
+             "Отдавать конфиг минифицированным JSON: быстрее сборка и разбор в клиенте"),
+        ):
+            card, self._option_btns[key] = self._make_toggle_card(
+                icon, title, subtitle, bool(self.settings.get(key)),
+                lambda _=False, k=key, t=title: self._toggle_option(k, t),
+            )
+            lay.addWidget(card)
+        lay.addSpacing(8)
+
         # ── СЕРВЕР ──
         lay.addWidget(self._section_label("СЕРВЕР"))
         lay.addWidget(self._hline())
@@ -1096,6 +4656,55 @@ class ClashApp(QMainWindow):
         url_row.addWidget(self._copy_btn_settings)
         sc.addLayout(url_row)
         lay.addWidget(srv_card)
+
+        lan_card, self._option_btns["lan_mode"] = self._make_toggle_card(
+            "fa5s.wifi", "Доступ из локальной сети",
+            "Устройства в сети берут общий конфиг по своей ссылке с токеном",
+            bool(self.settings.get("lan_mode")), self._toggle_lan,
+        )
+        lay.addWidget(lan_card)
+        self._lan_label = QLabel()
+        self._lan_label.setWordWrap(True)
+        self._lan_label.setTextInteractionFlags(Qt.TextSelectableByMouse)
+        self._lan_label.setStyleSheet(
+            f"font-size: 9pt; color: {COLORS['text2']}; background: transparent; "
+            f"font-family: Consolas; padding: 4px 14px;"
+        )
+        lay.addWidget(self._lan_label)
+        self._update_lan_ui()
+        lay.addSpacing(8)
+
+        # ── ИСТОРИЯ ──
+        lay.addWidget(self._section_label("ИСТОРИЯ"))
+        lay.addWidget(self._hline())
+
+        hist_card = QFrame()
+        hist_card.setObjectName("card")
+        hc = QVBoxLayout(hist_card)
+        hc.setContentsMargins(14, 12, 14, 12)
+        hist_title_row = QHBoxLayout()
+        hist_ico = QLabel(); hist_ico.setPixmap(_px("fa5s.chart-line", COLORS["text"], 14))
+        hist_ico.setStyleSheet("background: transparent;")
+        hist_title_row.addWidget(hist_ico)
+        hist_title_row.addWidget(QLabel("  Последние конвертации"))
+        hist_title_row.addStretch()
+        export_btn = QPushButton()
+        export_btn.setIcon(_ico("fa5s.file-export", COLORS["text"]))
+        export_btn.setIconSize(QSize(14, 14))
+        export_btn.setText("  Экспорт CSV")
+        export_btn.setFixedWidth(130)
+        export_btn.clicked.connect(self._export_history)
+        hist_title_row.addWidget(export_btn)
+        hc.addLayout(hist_title_row)
+        self._history_label = QLabel()
+        self._history_label.setTextInteractionFlags(Qt.TextSelectableByMouse)
+        self._history_label.setStyleSheet(
+            f"font-size: 9pt; color: {COLORS['text2']}; background: transparent; "
+            f"font-family: Consolas;"
+        )
+        hc.addWidget(self._history_label)
+        lay.addWidget(hist_card)
+        self._update_history_ui()
         lay.addSpacing(8)
 
         # ── О ПРОГРАММЕ ──
@@ -1174,6 +4783,43 @@ class ClashApp(QMainWindow):
         )
         return lbl
 
+    def _make_toggle_card(self, icon: str, title: str, subtitle: str,
+                          state: bool, slot) -> tuple:
+        card = QFrame()
+        card.setObjectName("card")
+        cl = QHBoxLayout(card)
+        cl.setContentsMargins(14, 14, 14, 14)
+
+        lcol = QVBoxLayout()
+        lcol.setSpacing(3)
+
+        lbl_row = QHBoxLayout()
+        ico = QLabel(); ico.setPixmap(_px(icon, COLORS["text"], 14))
+        ico.setStyleSheet("background: transparent;")
+        lbl_row.addWidget(ico)
+        m_lbl = QLabel(f"  {title}")
+        m_lbl.setStyleSheet(f"font-weight: bold; color: {COLORS['text']}; background: transparent;")
+        lbl_row.addWidget(m_lbl)
+        lbl_row.addStretch()
+        lcol.addLayout(lbl_row)
+
+        s_lbl = QLabel(subtitle)
+        s_lbl.setWordWrap(True)
+        s_lbl.setStyleSheet(f"font-size: 8pt; color: {COLORS['text2']}; background: transparent;")
+        lcol.addWidget(s_lbl)
+
+        rcol = QVBoxLayout()
+        rcol.setAlignment(Qt.AlignRight | Qt.AlignVCenter)
+        btn = QPushButton("Включён ✓" if state else "Отключён")
+        btn.setFixedWidth(110)
+        btn.setStyleSheet(self._toggle_style(state))
+        btn.clicked.connect(slot)
+        rcol.addWidget(btn)
+
+        cl.addLayout(lcol, 1)
+        cl.addLayout(rcol)
+        return card, btn
+
     @staticmethod
     def _hline() -> QFrame:
         f = QFrame()
@@ -1183,9 +4829,30 @@ class ClashApp(QMainWindow):
 
     # ── Стек ──────────────────────────────────
 
+    def _ensure_ui(self):
+        if self._ui_built:
+            return
+        self._build_ui()
+        self._ui_built = True
+        self._update_server_ui()
+        self._set_busy_ui(self.is_converting)
+        self._update_sub_info_ui()
+        if self._last_timing:
+            self._timing_label.setText(f"Последняя конвертация: {self._last_timing}")
+            self._timing_label.show()
+        self._flush_log()
+
     def _open_settings(self):
+        self._ensure_ui()
+        if self._settings_page is None:
+            self._settings_page = self._make_settings_page()
+            self._stacked.addWidget(self._settings_page)
         self._stacked.setCurrentIndex(1)
 
+    def _show_settings(self):
+        self._show_window()
+        self._open_settings()
+
     def _back_to_main(self):
         self._stacked.setCurrentIndex(0)
 
@@ -1219,7 +4886,7 @@ class ClashApp(QMainWindow):
         items = [
             ("fa5s.window-maximize", "Открыть",    self._show_window),
             ("fa5s.chart-bar",       "Подписка",   self._show_sub_popup),
-            ("fa5s.cog",             "Настройки",  self._open_settings),
+            ("fa5s.cog",             "Настройки",  self._show_settings),
         ]
         for icon_name, label, slot in items:
             act = QAction(_ico(icon_name, COLORS["text"]), label, self)
@@ -1251,11 +4918,20 @@ class ClashApp(QMainWindow):
         self._log("Свёрнуто в трей. Двойной клик — открыть.", "info")
 
     def _show_window(self):
+        self._ensure_ui()
         self.show()
         self.raise_()
         self.activateWindow()
 
+    def _on_instance_command(self, commands: list):
+        self._log(f"Повторный запуск: {', '.join(commands) or 'без команд'}", "info")
+        if "show" in commands:
+            self._show_window()
+        if "convert" in commands:
+            self._start_convert(silent=True)
+
     def _quit_app(self):
+        self._worker.stop()
         stop_server()
         self._tray.hide()
         QApplication.quit()
@@ -1270,18 +4946,49 @@ class ClashApp(QMainWindow):
             "error":   COLORS["danger"],
             "accent":  COLORS["accent"],
         }
-        color  = COLOR_MAP.get(level, COLORS["text2"])
-        ts     = datetime.now().strftime("%H:%M:%S")
-        cursor = self._log_edit.textCursor()
-        cursor.movePosition(QTextCursor.End)
-        fmt = cursor.charFormat()
-        fmt.setForeground(QColor(color))
-        cursor.setCharFormat(fmt)
-        cursor.insertText(f"[{ts}] {msg}\n")
-        self._log_edit.setTextCursor(cursor)
-        self._log_edit.ensureCursorVisible()
+        color = COLOR_MAP.get(level, COLORS["text2"])
+        ts    = datetime.now().strftime("%H:%M:%S")
+        line  = f"[{ts}] {msg}"
+        if self._file_log:
+            self._file_log.log(logging.WARNING if level in ("warning", "error")
+                               else logging.INFO, line)
+        # пока окно не построено, строки ждут в кольцевом буфере
+        self._log_pending.append((line, color))
+        if not self._ui_built:
+            return
+        if not self._log_timer.isActive():
+            self._log_timer.start()
+
+    def _flush_log(self):
+        if not self._log_pending or not self._ui_built:
+            return
+        lines, self._log_pending = self._log_pending, deque(maxlen=LOG_CAPACITY)
+        append_log_lines(self._log_edit, lines, self._log_formats)
+
+    def _setup_file_log(self):
+        logger = logging.getLogger("clash_app")
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        for h in list(logger.handlers):
+            logger.removeHandler(h)
+            h.close()
+        # без обработчиков logging пишет WARNING в stderr — держим None
+        self._file_log = None
+        if not self.settings.get("log_file"):
+            return
+        try:
+            handler = logging.handlers.RotatingFileHandler(
+                LOG_FILE, maxBytes=LOG_FILE_MAX, backupCount=LOG_FILE_BACKUPS, encoding="utf-8"
+            )
+        except OSError as e:
+            self._log(f"Не удалось открыть {LOG_FILE.name}: {e}", "warning")
+            return
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s", "%Y-%m-%d"))
+        logger.addHandler(handler)
+        self._file_log = logger
 
     def _clear_log(self):
+        self._log_pending.clear()
         self._log_edit.clear()
 
     def _paste_url(self):
@@ -1295,10 +5002,19 @@ class ClashApp(QMainWindow):
         # Временно меняем иконку статуса на галочку
         self._server_status_ico.setPixmap(_px("fa5s.check-circle", COLORS["success"], 10))
         self._server_label.setText("Скопировано!")
-        QTimer.singleShot(2000, lambda: (
-            self._server_status_ico.setPixmap(_px("fa5s.circle", COLORS["success"], 10)),
-            self._server_label.setText(f"localhost:{self.port}"),
-        ))
+        QTimer.singleShot(2000, self._update_server_ui)
+
+    def _update_server_ui(self):
+        if not self._ui_built:
+            return
+        color = COLORS["danger"] if self._server_error else COLORS["success"]
+        self._server_status_ico.setPixmap(_px("fa5s.circle", color, 10))
+        self._server_label.setText(f"localhost:{self.port}")
+        self._server_label.setStyleSheet(
+            f"font-size: 9pt; color: {color}; background: transparent;"
+        )
+        if self._url_display:
+            self._url_display.setText(self.server_url)
 
     def _toggle_style(self, state: bool) -> str:
         if state:
@@ -1324,6 +5040,101 @@ class ClashApp(QMainWindow):
         else:
             self._log("Не удалось изменить автозапуск", "warning")
 
+    def _toggle_option(self, key: str, title: str):
+        new = dict(self.settings)
+        new[key] = not new.get(key, False)
+        self._log(f"{title}: {'включено' if new[key] else 'отключено'}", "success")
+        save_settings(new)
+        self._apply_settings(new)
+
+    def _update_option_btn(self, key: str):
+        btn = self._option_btns.get(key)
+        if btn:
+            state = bool(self.settings.get(key))
+            btn.setText("Включён ✓" if state else "Отключён")
+            btn.setStyleSheet(self._toggle_style(state))
+
+    def _toggle_lan(self):
+        new = dict(self.settings)
+        new["lan_mode"] = not new.get("lan_mode", False)
+        if new["lan_mode"] and not new.get("lan_devices"):
+            new["lan_devices"] = {"Устройство 1": secrets.token_urlsafe(16)}
+        save_settings(new)
+        self._apply_settings(new)
+
+    def _lan_urls(self) -> list:
+        base = f"http://{lan_address()}:{self.port}"
+        return [(name, f"{base}/t/{token}/{OUTPUT_FILE.name}")
+                for name, token in (self.settings.get("lan_devices") or {}).items()]
+
+    def _update_history_ui(self):
+        if not self._ui_built or not hasattr(self, "_history_label"):
+            return
+        try:
+            records = load_history(HISTORY_SPARK_POINTS)
+        except sqlite3.Error as e:
+            self._history_label.setText(f"История недоступна: {e}")
+            return
+        if not records:
+            self._history_label.setText("Записей пока нет")
+            return
+        done = [r for r in records if r["ok"]]
+        lines = []
+        for title, key, fmt in (
+            ("время ", "total_sec", lambda v: f"{v:.2f} с"),
+            ("размер", "download_bytes", lambda v: f"{v / 1024 / 1024:.2f} MB"),
+            ("узлы  ", "proxies", str),
+        ):
+            values = [r[key] for r in done if r[key] is not None]
+            if values:
+                lines.append(f"{title} {sparkline(values)}  {fmt(values[-1])}")
+        lines.append("")
+        lines.append(f"{'когда':<11} {'всего':>7} {'MB':>6} {'узлы':>6} {'групп':>5} "
+                     f"{'кеш':>3} {'запр.':>6}")
+        for r in reversed(records[-HISTORY_TABLE_ROWS:]):
+            when = datetime.fromtimestamp(r["ts"]).strftime("%d.%m %H:%M")
+            if not r["ok"]:
+                lines.append(f"{when:<11} {'ошибка':>7} {'':>6} {'':>6} {'':>5} {'':>3} "
+                             f"{r['served_requests'] or 0:>6}")
+                continue
+            mb = (r["download_bytes"] or 0) / 1024 / 1024
+            lines.append(f"{when:<11} {r['total_sec'] or 0:>6.2f}с {mb:>6.2f} "
+                         f"{r['proxies'] or 0:>6} {r['groups'] or 0:>5} "
+                         f"{r['cached_stages'] or 0:>3} {r['served_requests'] or 0:>6}")
+        self._history_label.setText("\n".join(lines))
+
+    def _export_history(self):
+        path, _ = QFileDialog.getSaveFileName(
+            self, "Экспорт истории", str(Path.home() / "clash_history.csv"), "CSV (*.csv)")
+        if not path:
+            return
+        try:
+            count = export_history_csv(path)
+        except (sqlite3.Error, OSError) as e:
+            self._log(f"Не удалось выгрузить историю: {e}", "error")
+            return
+        self._log(f"История выгружена: {count} записей → {path}", "success")
+
+    def _update_lan_ui(self):
+        if not self._ui_built or not hasattr(self, "_lan_label"):
+            return
+        if not self.settings.get("lan_mode"):
+            self._lan_label.hide()
+            return
+        stats = lan_stats()
+        lines = []
+        for name, url in self._lan_urls():
+            st = stats.get(name)
+            usage = "ещё не подключалось"
+            if st:
+                seen = datetime.fromtimestamp(st["last_seen"]).strftime("%H:%M:%S")
+                usage = (f"запросов {st['requests']} (304: {st['not_modified']}, "
+                         f"429: {st['limited']}), {st['bytes'] // 1024} KB, "
+                         f"{st['last_ip']} в {seen}")
+            lines.append(f"{name}: {url}\n    {usage}")
+        self._lan_label.setText("\n".join(lines) or "Нет устройств в lan_devices")
+        self._lan_label.show()
+
     def _copy_server_url_settings(self):
         QApplication.clipboard().setText(self.server_url)
         if self._copy_btn_settings:
@@ -1341,7 +5152,7 @@ class ClashApp(QMainWindow):
             self._sub_dialog.raise_()
             self._sub_dialog.activateWindow()
             return
-        self._sub_dialog = SubInfoDialog(self, _sub_info)
+        self._sub_dialog = SubInfoDialog(self, dict(current_snapshot().sub_info))
         self._sub_dialog.show()
 
     # ── Конвертация ───────────────────────────
@@ -1350,7 +5161,8 @@ class ClashApp(QMainWindow):
         url = self.settings.get("url", "").strip()
         if not url:
             return
-        self._url_edit.setText(url)
+        if self._ui_built:
+            self._url_edit.setText(url)
         if OUTPUT_FILE.exists():
             self._log(f"Конфиг найден: {OUTPUT_FILE.name}", "success")
             self._log(f"Сервер отдаёт: {self.server_url}", "accent")
@@ -1361,30 +5173,31 @@ class ClashApp(QMainWindow):
         self._start_convert(silent=True)
 
     def _load_existing_config_info(self):
-        try:
-            if SUB_CACHE_FILE.exists():
-                with open(SUB_CACHE_FILE, "r", encoding="utf-8") as f:
-                    cached = json.load(f)
-                global _sub_header, _sub_info
-                _sub_header = cached.get("header", "")
-                _sub_info   = cached.get("info", {})
-                if _sub_info:
-                    self._update_sub_info_ui()
-                    self._log("Данные подписки загружены из кеша", "info")
-        except Exception:
-            pass
+        # sub_cache.json уже прочитан в снимок прошлого запуска (load_snapshot)
+        if current_snapshot().sub_info:
+            self._update_sub_info_ui()
+            self._log("Данные подписки загружены из кеша", "info")
 
-    def _save_sub_cache(self):
+    def _save_sub_cache(self, snapshot: Snapshot):
         try:
             with open(SUB_CACHE_FILE, "w", encoding="utf-8") as f:
-                json.dump({"header": _sub_header, "info": _sub_info}, f, ensure_ascii=False)
+                json.dump({"header": snapshot.sub_header, "info": dict(snapshot.sub_info)},
+                          f, ensure_ascii=False)
         except Exception:
             pass
 
-    def _start_convert(self, silent: bool = False):
+    def _on_convert_clicked(self):
         if self.is_converting:
-            return
-        url = self._url_edit.text().strip()
+            self._worker.cancel()
+            self._log("Отменяю конвертацию...", "warning")
+        else:
+            self._start_convert()
+
+    def _start_convert(self, silent: bool = False, reuse: bool = False):
+        if self._ui_built:
+            url = self._url_edit.text().strip()
+        else:
+            url = str(self.settings.get("url", "")).strip()
         if not url:
             if not silent:
                 QMessageBox.warning(self, "Нет URL", "Введите ссылку на подписку")
@@ -1397,35 +5210,74 @@ class ClashApp(QMainWindow):
         self.settings["url"] = url
         save_settings(self.settings)
 
+        try:
+            deadline = float(self.settings.get("job_deadline") or JOB_DEADLINE)
+        except (TypeError, ValueError):
+            deadline = JOB_DEADLINE
+        job = ConvertJob(url, {**self.settings, "port": self.port}, deadline, reuse=reuse)
+        if self._worker.submit(job):
+            self._log("Новая конвертация заменила ожидавшую в очереди", "info")
+        elif self.is_converting:
+            self._log("Конвертация поставлена в очередь", "info")
+
         self.is_converting = True
-        self._convert_btn.setIcon(_ico("fa5s.spinner", "white"))
-        self._convert_btn.setText("  Обработка...")
-        self._convert_btn.setEnabled(False)
-        self._progress.show()
+        self._set_busy_ui(True)
 
-        self._worker = ConvertWorker(url)
-        self._worker.log_message.connect(self._log)
-        self._worker.sub_info_ready.connect(self._on_sub_info_ready)
-        self._worker.finished.connect(self._convert_done)
-        self._worker.start()
+    def _set_busy_ui(self, busy: bool):
+        if not self._ui_built:
+            return
+        if busy:
+            self._convert_btn.setIcon(_ico("fa5s.stop", "white"))
+            self._convert_btn.setText("  Отменить")
+            self._progress.show()
+        else:
+            self._progress.hide()
+            self._convert_btn.setIcon(_ico("fa5s.sync-alt", "white"))
+            self._convert_btn.setText("  Конвертировать")
 
-    def _on_sub_info_ready(self, info: dict, header: str):
-        global _sub_header, _sub_info
-        _sub_header = header
-        _sub_info   = info
-        self._save_sub_cache()
+    def _on_snapshot_published(self, snapshot: Snapshot):
+        self._save_sub_cache(snapshot)
         self._update_sub_info_ui()
         self._log(f"✓ Ссылка для Clash Verge: {self.server_url}", "accent")
-
-    def _convert_done(self):
+        base = f"http://localhost:{self.port}"
+        self._log(f"  sing-box: {base}/singbox.json  ·  v2ray/base64: {base}/sub.txt", "info")
+
+    def _convert_done(self, result: dict):
+        refresh_finished(result["ok"])
+        if result["timings"]:
+            self._last_timing = format_timings(result["timings"])
+            if result.get("rss"):
+                self._last_timing += f" · память {self._memory_text(result['rss'])}"
+            self._log(f"Время: {self._last_timing}", "info")
+            if self._ui_built:
+                self._timing_label.setText(f"Последняя конвертация: {self._last_timing}")
+                self._timing_label.show()
+        budget = self._rss_budget()
+        if result.get("rss") and budget and result["rss"] > budget:
+            self._log(f"Память после очистки {self._memory_text(result['rss'])} — "
+                      f"больше бюджета", "warning")
+        self._update_history_ui()
+        if self._worker.busy:
+            return
         self.is_converting = False
-        self._progress.hide()
-        self._convert_btn.setIcon(_ico("fa5s.sync-alt", "white"))
-        self._convert_btn.setText("  Конвертировать")
-        self._convert_btn.setEnabled(True)
+        self._set_busy_ui(False)
+
+    def _rss_budget(self) -> int:
+        try:
+            return max(int(self.settings.get("rss_budget_mb") or 0), 0) * 1024 * 1024
+        except (TypeError, ValueError):
+            return 0
+
+    def _memory_text(self, rss: int) -> str:
+        text = f"{rss // (1024 * 1024)} MB"
+        budget = self._rss_budget()
+        return f"{text} / {budget // (1024 * 1024)} MB" if budget else text
 
     def _update_sub_info_ui(self):
-        info = _sub_info
+        if not self._ui_built:
+            self._update_tray_tooltip()
+            return
+        info = current_snapshot().sub_info
         if not info:
             self._sub_info_label.setText("Сервер не вернул данные о подписке")
             self._sub_info_label.setStyleSheet(
@@ -1475,7 +5327,7 @@ class ClashApp(QMainWindow):
         self._update_tray_tooltip()
 
     def _update_tray_tooltip(self):
-        info = _sub_info
+        info = current_snapshot().sub_info
         if not info:
             self._tray.setToolTip(APP_NAME)
             return
@@ -1494,9 +5346,14 @@ class ClashApp(QMainWindow):
 
     # ── HTTP-сервер ───────────────────────────
 
-    def _start_server_thread(self):
-        threading.Thread(target=start_server, args=(self.port,), daemon=True).start()
-        self._log(f"Сервер запущен: {self.server_url}", "success")
+    def _log_server_status(self):
+        if self._server_error:
+            self._log(f"❌ Не удалось запустить сервер: {self._server_error}", "error")
+            self._update_server_ui()
+            return
+        self._log(
+            f"Сервер запущен: {self.server_url} ({self._server_start_ms:.1f} мс)", "success"
+        )
         if OUTPUT_FILE.exists():
             self._log(
                 f"Конфиг готов: clean.yaml ({OUTPUT_FILE.stat().st_size // 1024} KB)", "success"
@@ -1504,6 +5361,111 @@ class ClashApp(QMainWindow):
         else:
             self._log("Конфиг не найден — нажмите Конвертировать", "warning")
         self._log("Вставьте эту ссылку в Clash Verge/Party → Profiles → Remote", "accent")
+        if self.settings.get("lan_mode"):
+            self._log("Доступ из локальной сети:", "info")
+            for name, url in self._lan_urls():
+                self._log(f"  {name}: {url}", "accent")
+
+    def _server_host(self) -> str:
+        return "0.0.0.0" if self.settings.get("lan_mode") else "localhost"
+
+    def _rebind_port(self, port: int):
+        try:
+            server = start_server(port, host=self._server_host())
+        except OSError as e:
+            self._log(f"Порт {port} недоступен ({e}), сервер остаётся на {self.port}", "error")
+            return
+        port = server.server_address[1]
+        self.port = port
+        self._server_error = None
+        self.server_url = f"http://localhost:{port}/clean.yaml"
+        self._update_server_ui()
+        self._log(f"Сервер перенесён: {self.server_url}", "accent")
+
+    # ── Настройки на лету ─────────────────────
+
+    def _setup_settings_watcher(self):
+        self._settings_mtime = settings_mtime()
+        self._settings_timer = QTimer(self)
+        self._settings_timer.timeout.connect(self._check_settings_file)
+        self._settings_timer.start(SETTINGS_POLL_MS)
+
+    def _check_settings_file(self):
+        mtime = settings_mtime()
+        if mtime == self._settings_mtime:
+            return
+        self._settings_mtime = mtime
+        self._apply_settings(load_settings())
+
+    def _apply_settings(self, new: dict):
+        old = self.settings
+        changed = {k for k in set(old) | set(new) if old.get(k) != new.get(k)}
+        if not changed:
+            return
+        self.settings = new
+        self._log(f"app_config.json изменён: {', '.join(sorted(changed))}", "info")
+
+        if changed & {"lan_devices", "lan_rate"}:
+            configure_lan(new.get("lan_devices"), new.get("lan_rate"))
+        if changed & {"port", "lan_mode"}:
+            try:
+                self._rebind_port(int(new.get("port", self.port)))
+            except (TypeError, ValueError):
+                self._log(f"Некорректный порт: {new['port']!r}", "error")
+        if "lan_mode" in changed:
+            if new.get("lan_mode"):
+                self._log("Доступ из локальной сети включён:", "success")
+                for name, url in self._lan_urls():
+                    self._log(f"  {name}: {url}", "accent")
+            else:
+                self._log("Доступ из локальной сети отключён", "success")
+        if changed & {"lan_mode", "lan_devices"}:
+            self._update_lan_ui()
+        if "refresh_interval" in changed:
+            self._setup_refresh_timer()
+        if "max_age" in changed:
+            self._setup_stale_refresh()
+        if "log_file" in changed:
+            self._setup_file_log()
+        if "url" in changed and self._ui_built:
+            self._url_edit.setText(str(new.get("url", "")))
+        for key in changed.intersection(self._option_btns):
+            self._update_option_btn(key)
+        # ссылки на провайдеров в базовом конфиге содержат порт
+        reconvert = changed.intersection(CONVERT_SETTINGS) or (
+            "port" in changed and new.get("split_providers")
+        )
+        if reconvert and new.get("url"):
+            # смена одних опций не требует новой загрузки — хватит кеша этапов
+            self._start_convert(silent=True, reuse="url" not in changed)
+
+    def _setup_stale_refresh(self):
+        global _on_stale, _stale_max_age
+        if _on_stale is None:
+            self.stale_refresh.connect(self._on_stale_refresh)
+            _on_stale = self.stale_refresh.emit
+        try:
+            _stale_max_age = max(int(self.settings.get("max_age") or 0), 0) * 60
+        except (TypeError, ValueError):
+            _stale_max_age = 0
+
+    def _on_stale_refresh(self):
+        self._log("Конфиг устарел — клиент получил кеш, обновляю в фоне...", "info")
+        self._start_convert(silent=True)
+        if not self.is_converting:
+            refresh_finished(False)
+
+    def _setup_refresh_timer(self):
+        if not hasattr(self, "_refresh_timer"):
+            self._refresh_timer = QTimer(self)
+            self._refresh_timer.timeout.connect(lambda: self._start_convert(silent=True))
+        self._refresh_timer.stop()
+        try:
+            minutes = int(self.settings.get("refresh_interval") or 0)
+        except (TypeError, ValueError):
+            minutes = 0
+        if minutes > 0:
+            self._refresh_timer.start(minutes * 60_000)
 
 
 # ─────────────────────────────────────────────
@@ -1525,7 +5487,31 @@ def main():
     
     parser = argparse.ArgumentParser(description=APP_NAME)
     parser.add_argument("--minimized", action="store_true")
+    parser.add_argument("--convert", action="store_true",
+                        help="сразу обновить конфиг (в том числе в уже запущенной копии)")
+    parser.add_argument("--replay", metavar="FILE", help="отдать запись из fixtures/")
+    parser.add_argument("--replay-port", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0, metavar="MS")
+    parser.add_argument("--bandwidth", type=float, default=0, metavar="KBPS")
+    parser.add_argument("--bench", type=int, default=0, metavar="N",
+                        help="с --replay: прогнать конвейер N раз и вывести время этапов")
+    parser.add_argument("--benchmark", choices=sorted(BENCHMARKS), metavar="ИМЯ",
+                        help="микробенчмарк: " + ", ".join(sorted(BENCHMARKS))
+                        + " (--bench N — число прогонов)")
     args = parser.parse_args()
+    if args.benchmark:
+        sys.exit(run_benchmark(args.benchmark, args.bench or 5))
+    if args.replay:
+        sys.exit(run_replay(args))
+
+    # до QApplication: повторный запуск должен выходить за миллисекунды
+    commands = ([] if args.minimized else ["show"]) + (["convert"] if args.convert else [])
+    guard = InstanceGuard()
+    if not guard.acquire():
+        if guard.forward(commands):
+            sys.exit(0)
+        print(f"{APP_NAME} уже запущен, но не отвечает", file=sys.stderr)
+        sys.exit(1)
 
     app = QApplication(sys.argv)
     app.setApplicationName(APP_NAME)
@@ -1546,7 +5532,10 @@ def main():
     app.setWindowIcon(load_taskbar_icon())
     # Для отдельных окон (диалоги, главное) используется load_app_icon()
 
+    guard.listen()
+    app.aboutToQuit.connect(guard.release)
     window = ClashApp(start_minimized=args.minimized)
+    guard.command.connect(window._on_instance_command)
     if not args.minimized:
         window.show()
 
@@ -1554,4 +5543,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
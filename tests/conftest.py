@@ -0,0 +1,101 @@
+import http.server
+import json
+import os
+import pathlib
+import sys
+import threading
+import urllib.parse
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import clash_app  # noqa: E402
+
+
+@pytest.fixture
+def app_dir(tmp_path, monkeypatch):
+    """Все файлы приложения (конфиг, кеши, история) — во временном каталоге."""
+    root = clash_app.APP_DIR
+    for name in dir(clash_app):
+        if not name.endswith(("_FILE", "_DIR")):
+            continue
+        value = getattr(clash_app, name)
+        if isinstance(value, pathlib.Path) and (value == root or root in value.parents):
+            monkeypatch.setattr(clash_app, name, tmp_path / value.relative_to(root))
+    monkeypatch.setattr(clash_app, "_dns_cache", None)
+    monkeypatch.setattr(clash_app, "_snapshot", clash_app.Snapshot())
+    return tmp_path
+
+
+@pytest.fixture(scope="session")
+def qapp():
+    """QApplication для виджетов и сигналов QThread-воркеров."""
+    from PySide6.QtWidgets import QApplication
+    return QApplication.instance() or QApplication([])
+
+
+class StubServer:
+    """
+    Локальный http.server вместо внешнего сервиса. handler(запрос) возвращает
+    (код, тело: bytes | dict | list); запросы копятся в requests. В запросе
+    path раскодирован, raw_path — как пришёл (имена узлов со слешем).
+    """
+
+    def __init__(self, handler):
+        self.requests = []
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def _serve(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                parsed = urllib.parse.urlparse(self.path)
+                request = {
+                    "method": self.command,
+                    "path": urllib.parse.unquote(parsed.path),
+                    "raw_path": parsed.path,
+                    "query": dict(urllib.parse.parse_qsl(parsed.query)),
+                    "headers": dict(self.headers),
+                    "body": self.rfile.read(length) if length else b"",
+                }
+                stub.requests.append(request)
+                status, body = handler(request)
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode("utf-8")
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except OSError:
+                    pass    # клиент уже ушёл (отменённая загрузка)
+
+            do_GET = do_PUT = do_POST = _serve
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.address = f"127.0.0.1:{self.server.server_address[1]}"
+        self.url = f"http://{self.address}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def http_stub():
+    """Фабрика StubServer; все серверы гасятся после теста."""
+    servers = []
+
+    def start(handler) -> StubServer:
+        servers.append(StubServer(handler))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
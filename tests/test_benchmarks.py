@@ -0,0 +1,10 @@
+"""Микробенчмарки из --benchmark не должны гнить: один прогон каждого."""
+import pytest
+
+import clash_app
+
+
+@pytest.mark.parametrize("name", sorted(clash_app.BENCHMARKS))
+def test_benchmark_runs(name, app_dir, qapp, capsys):
+    assert clash_app.run_benchmark(name, 1) == 0
+    assert "Прогонов: 1" in capsys.readouterr().out
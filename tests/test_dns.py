@@ -0,0 +1,46 @@
+import asyncio
+import time
+
+import clash_app
+
+
+def _proxies(hosts):
+    return [{"name": f"n-{h}", "type": "ss", "server": h, "port": 1} for h in hosts]
+
+
+def test_deadline_keeps_finished_hosts(app_dir):
+    fast = [f"fast{i}.example" for i in range(50)]
+
+    async def resolver(host):
+        await asyncio.sleep(5 if host == "slow.example" else 0.01)
+        return ["10.0.0.1"]
+
+    t0 = time.perf_counter()
+    dns = clash_app.prefetch_dns(_proxies(fast + ["slow.example"]), pin=True,
+                                 resolver=resolver, total_timeout=1.0)
+    assert time.perf_counter() - t0 < 2
+    assert dns["failed"] == [] and dns["dead"] == []
+    assert dns["unknown"] == ["slow.example"]
+    assert dns["pinned"] == 50
+
+    # не успевший хост не закеширован как мёртвый: повтор спрашивает его снова
+    asked = []
+
+    async def again(host):
+        asked.append(host)
+        return ["10.0.0.2"]
+
+    dns = clash_app.prefetch_dns(_proxies(fast + ["slow.example"]), resolver=again)
+    assert asked == ["slow.example"] and dns["cached"] == 50 and not dns["unknown"]
+
+
+def test_blocking_resolver_does_not_hold_deadline(app_dir, monkeypatch):
+    def getaddrinfo(host, *args, **kwargs):
+        time.sleep(6)
+        return []
+
+    monkeypatch.setattr(clash_app.socket, "getaddrinfo", getaddrinfo)
+    t0 = time.perf_counter()
+    result, _, unknown = clash_app.resolve_hosts(["hang.example"], total_timeout=1.0)
+    assert time.perf_counter() - t0 < 2
+    assert result == {} and unknown == ["hang.example"]
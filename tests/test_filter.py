@@ -0,0 +1,78 @@
+import clash_app
+
+
+def _ss(name, **extra):
+    return {"name": name, "type": "ss", "server": "s.example", "port": 1,
+            "cipher": "aes-128-gcm", "password": "p", **extra}
+
+
+def test_type_aliases_and_field_aliases():
+    proxies = [
+        {"name": "a", "type": "Shadowsocks", "server": "s", "port": 1, "method": "aes-128-gcm",
+         "password": "p"},
+        {"name": "b", "type": "hy2", "server": "s", "port": 2, "auth": "secret", "insecure": "1"},
+        {"name": "c", "type": "wg", "server": "s", "port": 3, "privateKey": "k"},
+        {"name": "d", "type": "vmess", "server": "s", "port": 4, "id": "u", "aid": "2"},
+    ]
+    kept, removed, invalid, _renamed = clash_app.filter_proxies(proxies)
+    assert not removed and not invalid
+    assert [p["type"] for p in kept] == ["ss", "hysteria2", "wireguard", "vmess"]
+    assert kept[0]["cipher"] == "aes-128-gcm" and "method" not in kept[0]
+    assert kept[1]["password"] == "secret" and kept[1]["skip-cert-verify"] is True
+    assert kept[2]["private-key"] == "k"
+    assert kept[3]["uuid"] == "u" and kept[3]["alterId"] == 2 and kept[3]["cipher"] == "auto"
+
+
+def test_port_int_and_bool_coercion():
+    kept, _removed, invalid, _renamed = clash_app.filter_proxies([
+        _ss("a", port=" 8388 ", udp="yes", tls="off"),
+        {"name": "b", "type": "wireguard", "server": "s", "port": 1, "private-key": "k",
+         "mtu": "1420"},
+    ])
+    assert not invalid
+    assert (kept[0]["port"], kept[0]["udp"], kept[0]["tls"]) == (8388, True, False)
+    assert kept[1]["mtu"] == 1420
+
+
+def test_errors_are_collected_per_node():
+    proxies = [
+        {"name": "no-port", "type": "trojan", "server": "s"},
+        _ss("bad-values", port="http", udp="maybe"),
+        _ss("out-of-range", port=70000),
+        {"name": "tuic", "type": "tuic", "server": "s", "port": 1},
+        {"name": "naive", "type": "naive", "server": "s", "port": 1},
+        _ss("ok"),
+    ]
+    kept, removed, invalid, _renamed = clash_app.filter_proxies(proxies)
+    assert [p["name"] for p in kept] == ["ok"]
+    assert removed == {"naive": 1}
+    assert dict(invalid) == {
+        "no-port": ["нет поля port", "нет поля password"],
+        "bad-values": ["порт не число: 'http'", "udp не bool: 'maybe'"],
+        "out-of-range": ["порт вне диапазона: 70000"],
+        "tuic": ["нужно одно из полей: uuid, token"],
+    }
+
+
+def test_invalid_node_leaves_no_alias():
+    broken = _ss("🇭🇰 HK 1")
+    del broken["password"]
+    kept, _removed, invalid, renamed = clash_app.filter_proxies([broken, _ss("🇯🇵 JP 1")])
+    assert [p["name"] for p in kept] == [clash_app.clean_name("🇯🇵 JP 1")]
+    assert len(invalid) == 1
+    assert "🇭🇰 HK 1" not in renamed
+    assert renamed == {"🇯🇵 JP 1": clash_app.clean_name("🇯🇵 JP 1")}
+
+
+def test_dedup_keeps_nodes_differing_in_alter_id_or_port_range():
+    vmess = {"type": "vmess", "server": "v.example", "port": 443,
+             "uuid": "11111111-1111-1111-1111-111111111111", "cipher": "auto"}
+    hy2 = {"type": "hysteria2", "server": "h.example", "port": 443, "password": "p"}
+    proxies = [
+        {"name": "a", **vmess, "alterId": 0}, {"name": "b", **vmess, "alterId": 64},
+        {"name": "c", **hy2, "ports": "20000-30000"}, {"name": "d", **hy2, "ports": "40000-50000"},
+        {"name": "e", **hy2, "ports": "40000-50000"},
+    ]
+    kept, aliases = clash_app.dedup_proxies(proxies)
+    assert [p["name"] for p in kept] == ["a", "b", "c", "d"]
+    assert aliases == {"e": "d"}
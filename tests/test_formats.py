@@ -0,0 +1,26 @@
+import json
+
+import clash_app
+
+TUIC_V5 = {"name": "v5", "type": "tuic", "server": "t.example", "port": 443,
+           "uuid": "11111111-1111-1111-1111-111111111111", "password": "pw"}
+TUIC_V4 = {"name": "v4", "type": "tuic", "server": "t.example", "port": 443, "token": "tok"}
+
+
+def test_tuic_v4_is_not_exported():
+    assert clash_app.singbox_outbound(dict(TUIC_V4)) is None
+    assert clash_app.proxy_uri(dict(TUIC_V4)) is None
+
+    out = clash_app.singbox_outbound(dict(TUIC_V5))
+    assert out["uuid"] == TUIC_V5["uuid"] and out["password"] == "pw"
+    assert clash_app.proxy_uri(dict(TUIC_V5)).startswith("tuic://")
+
+
+def test_singbox_groups_skip_unexported_nodes():
+    config = {"proxies": [dict(TUIC_V5), dict(TUIC_V4)],
+              "proxy-groups": [{"name": "Sel", "type": "select", "proxies": ["v5", "v4"]}]}
+    doc = json.loads(clash_app.render_singbox(config))
+    tags = {out["tag"] for out in doc["outbounds"]}
+    assert "v4" not in tags
+    selector = next(out for out in doc["outbounds"] if out["tag"] == "Sel")
+    assert selector["outbounds"] == ["v5"]
@@ -0,0 +1,23 @@
+import pathlib
+
+import clash_app
+
+
+def test_second_guard_sees_running_instance(app_dir, qapp):
+    first, second = clash_app.InstanceGuard(), clash_app.InstanceGuard()
+    assert first.acquire()
+    try:
+        assert not second.acquire()
+    finally:
+        first.release()
+    assert second.acquire()
+    second.release()
+
+
+def test_lock_error_does_not_block_start(app_dir, qapp, monkeypatch):
+    # каталог, где файл блокировки не создать: это не «уже запущен»
+    monkeypatch.setattr(clash_app, "APP_DIR", pathlib.Path("/proc/clash-app-nonexistent"))
+    guard = clash_app.InstanceGuard()
+    assert guard.acquire()
+    guard.listen()
+    guard.release()
@@ -0,0 +1,52 @@
+import requests
+
+import clash_app
+
+
+def test_token_guessing_is_rate_limited_per_address(app_dir):
+    clash_app.configure_lan({"phone": "right-token"}, rate=5)
+    base = clash_app.snapshot_files("proxies: []\n")
+    clash_app.publish_snapshot(clash_app.Snapshot(base, created=1.0))
+    port = clash_app.start_server(0).server_address[1]
+    try:
+        url = f"http://localhost:{port}/t/{{}}/{clash_app.OUTPUT_FILE.name}"
+        codes = [requests.get(url.format(f"guess{i}"), timeout=5).status_code for i in range(5)]
+        assert codes == [403] * 5
+
+        resp = requests.get(url.format("guess5"), timeout=5)
+        assert resp.status_code == 429 and int(resp.headers["Retry-After"]) >= 1
+        # адрес исчерпал лимит — верный токен с него тоже ждёт
+        assert requests.get(url.format("right-token"), timeout=5).status_code == 429
+    finally:
+        clash_app.stop_server()
+        clash_app.configure_lan({})
+
+
+def test_ip_buckets_forget_refilled_addresses(monkeypatch):
+    clash_app.configure_lan({}, rate=5)
+    monkeypatch.setattr(clash_app, "LAN_IP_BUCKETS", 3)
+    for i in range(5):
+        clash_app.lan_allow_ip(f"10.0.0.{i}")
+    # все вёдра почти полные, но ещё не наполнились — ни одно не забыто
+    assert len(clash_app._lan_ip_buckets) == 5
+    for bucket in clash_app._lan_ip_buckets.values():
+        bucket[1] -= 60
+    clash_app.lan_allow_ip("10.0.0.99")
+    assert list(clash_app._lan_ip_buckets) == ["10.0.0.99"]
+    clash_app.configure_lan({})
+
+
+def test_loopback_gets_only_configs(app_dir):
+    clash_app.save_settings({"lan_devices": {"phone": "secret-token"}})
+    base = clash_app.snapshot_files("proxies: []\n")
+    clash_app.publish_snapshot(clash_app.Snapshot(base, created=1.0))
+    port = clash_app.start_server(0).server_address[1]
+    try:
+        url = f"http://localhost:{port}/{{}}"
+        for name in (clash_app.CONFIG_FILE.name, "history.db", "", "providers/../app_config.json"):
+            assert requests.get(url.format(name), timeout=5).status_code == 404, name
+        resp = requests.get(url.format(clash_app.OUTPUT_FILE.name), timeout=5)
+        assert resp.status_code == 200
+        assert "Access-Control-Allow-Origin" not in resp.headers
+    finally:
+        clash_app.stop_server()
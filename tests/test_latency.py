@@ -0,0 +1,65 @@
+import time
+import urllib.parse
+
+import clash_app
+
+
+def _core(delays, passive=()):
+    """Ответы ядра: /proxies с историей проверок для passive, /delay — по delays."""
+    def handler(request):
+        if request["path"] == "/proxies":
+            return 200, {"proxies": {
+                name: {"alive": delays[name] > 0,
+                       "history": [{"time": "t1", "delay": delays[name]}] if name in passive else []}
+                for name in delays
+            }}
+        name = urllib.parse.unquote(request["raw_path"].split("/")[2])
+        if request["query"].get("url") == "slow":
+            time.sleep(1)
+        if delays.get(name):
+            return 200, {"delay": delays[name]}
+        return 408, {"message": "Timeout"}
+    return handler
+
+
+def test_controller_auth_and_quoting(http_stub):
+    core = http_stub(_core({"🇭🇰 HK/1": 120, "dead": 0}))
+    api = clash_app.ClashController(":" + core.address.split(":")[1], "s3cret")
+    assert set(api.proxies()) == {"🇭🇰 HK/1", "dead"}
+    assert api.delay("🇭🇰 HK/1") == 120
+    assert api.delay("dead") == 0
+    assert core.requests[1]["path"] == "/proxies/🇭🇰 HK/1/delay"
+    assert all(r["headers"]["Authorization"] == "Bearer s3cret" for r in core.requests)
+
+
+def test_controller_down_reports_zero():
+    assert clash_app.ClashController("127.0.0.1:1", timeout=0.5).delay("x", timeout_ms=200) == 0
+
+
+def test_collect_delays_prefers_core_history(http_stub):
+    delays = {f"n{i}": (0 if i % 4 == 0 else 100 + i) for i in range(12)}
+    core = http_stub(_core(delays, passive={"n1", "n2", "n4"}))
+    history = clash_app.LatencyHistory({"names": {name: f"k-{name}" for name in delays}})
+    stats = clash_app.collect_delays(clash_app.ClashController(core.address), history,
+                                     max_probes=5)
+    assert stats == {"passive": 3, "probed": 5, "dead": 2, "skipped": 4}
+    assert sum(r["path"].endswith("/delay") for r in core.requests) == 5
+    assert history.score("k-n1") == (False, 101)
+
+    # повтор с той же отметкой времени ядра не считается новым замером
+    version = history.version
+    stats = clash_app.collect_delays(clash_app.ClashController(core.address), history,
+                                     max_probes=0)
+    assert stats["passive"] == 0 and history.version == version
+
+
+def test_collect_delays_respects_budget(http_stub, monkeypatch):
+    delays = {f"n{i}": 50 for i in range(6)}
+    core = http_stub(_core(delays))
+    api = clash_app.ClashController(core.address)
+    monkeypatch.setattr(api, "delay", lambda name: api.__class__.delay(api, name, url="slow"))
+    history = clash_app.LatencyHistory({"names": {name: name for name in delays}})
+    t0 = time.perf_counter()
+    stats = clash_app.collect_delays(api, history, budget=0.3, concurrency=2)
+    assert time.perf_counter() - t0 < 1
+    assert stats["probed"] == 0 and stats["skipped"] == 6
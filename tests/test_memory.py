@@ -0,0 +1,115 @@
+"""
+Регрессия памяти: подряд N конвертаций подписки, у которой каждый раз
+другие серверы (кеш этапов промахивается), а имена те же — как у живых
+провайдеров. После прогрева ни tracemalloc, ни RSS не должны расти от
+прогона к прогону.
+
+MEMORY_LARGE=1 добавляет проверку на подписке в LARGE_NODES узлов: RSS после
+конвертации и release_memory() возвращается к замеру до неё, с поправкой
+на опубликованный снимок.
+"""
+import http.server
+import os
+import threading
+import tracemalloc
+
+import pytest
+
+import clash_app
+
+NODES = 1000
+RUNS = int(os.environ.get("MEMORY_RUNS", "6"))
+TRACED_GROWTH = 1 * 2**20    # байт Python-объектов на все прогоны после прогрева
+RSS_GROWTH = 32 * 2**20
+LARGE_NODES = 50_000
+LARGE_RSS_BUDGET = 64 * 2**20    # сверх базы и байт опубликованного снимка
+
+
+def _body(gen: int, nodes: int = NODES) -> bytes:
+    lines = ["proxies:"]
+    lines += [f"  - {{name: 'HK {i}', type: vless, server: s{i}-g{gen}.example.com, port: 443, "
+              f"uuid: 11111111-1111-1111-1111-{i:012d}, tls: true, network: ws, "
+              f"ws-opts: {{path: /p{i}}}}}" for i in range(nodes)]
+    lines += ["proxy-groups:", "  - {name: Sel, type: select, proxies: ['HK 1']}"]
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def _serve(nodes: int):
+    """Подписка на локальном http.server; каждый запрос — новое поколение."""
+    counter = [0]
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            counter[0] += 1
+            body = _body(counter[0], nodes)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/sub"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def subscription():
+    yield from _serve(NODES)
+
+
+@pytest.fixture
+def large_subscription():
+    yield from _serve(LARGE_NODES)
+
+
+OPTIONS = {"port": 1, "dns_prefetch": False, "dns_pin": False, "record_upstream": False,
+           "latency_order": False, "push_reload": False, "region_groups": True}
+
+
+def _converter(url: str, deadline: float = 120):
+    worker = clash_app.ConvertWorker()
+
+    def convert():
+        job = clash_app.ConvertJob(url, OPTIONS, deadline)
+        job.begin()
+        worker._run_job(job)
+        assert job.ok
+        return clash_app.release_memory()
+    return convert
+
+
+def test_repeated_conversions_do_not_grow(app_dir, qapp, subscription):
+    convert = _converter(subscription)
+
+    # прогрев: импорты, кеши регулярок, первый снимок
+    convert()
+    convert()
+    tracemalloc.start()
+    try:
+        base_rss = convert()
+        base_traced = tracemalloc.get_traced_memory()[0]
+        for _ in range(RUNS):
+            rss = convert()
+        traced = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    assert traced - base_traced < TRACED_GROWTH, f"+{(traced - base_traced) / 2**20:.1f} МБ"
+    if base_rss is not None:
+        assert rss - base_rss < RSS_GROWTH, f"RSS +{(rss - base_rss) / 2**20:.1f} МБ"
+
+
+@pytest.mark.skipif(not os.environ.get("MEMORY_LARGE"), reason="MEMORY_LARGE=1 — долгий прогон")
+def test_large_conversion_returns_to_baseline(app_dir, qapp, large_subscription):
+    base_rss = clash_app.release_memory()
+    if base_rss is None:
+        pytest.skip("RSS процесса недоступен")
+    rss = _converter(large_subscription, 600)()
+    kept = sum(len(entry[0]) for entry in clash_app._snapshot.files.values())
+    grown = rss - base_rss - kept
+    assert grown < LARGE_RSS_BUDGET, f"RSS +{grown / 2**20:.1f} МБ сверх снимка {kept / 2**20:.1f} МБ"
@@ -0,0 +1,68 @@
+import time
+
+import pytest
+import requests
+
+import clash_app
+
+CONFIG = b"proxies:\n  - {name: a, type: ss, server: s, port: 1}\n"
+
+
+def _mirror(http_stub, status=200, body=CONFIG, delay=0.0):
+    def handler(request):
+        time.sleep(delay)
+        return status, body
+    return http_stub(handler)
+
+
+def _race(urls):
+    """Гонка через ConvertWorker._download_mirrors: первый url — основной."""
+    worker = clash_app.ConvertWorker()
+    worker.url = urls[0]
+    worker.options = {"mirrors": {urls[0]: urls[1:]}}
+    job = clash_app.ConvertJob(urls[0], worker.options, 30)
+    job.begin()
+    t0 = time.perf_counter()
+    text, _headers = worker._download_mirrors(job)
+    return text, time.perf_counter() - t0
+
+
+@pytest.fixture
+def stagger(monkeypatch):
+    """Сдвиг зеркал подставляется в значение по умолчанию race_mirrors."""
+    def set_stagger(seconds):
+        monkeypatch.setattr(clash_app.race_mirrors, "__defaults__", (seconds,))
+    return set_stagger
+
+
+def test_fast_mirror_beats_slow_primary(app_dir, qapp, http_stub, stagger):
+    stagger(0.2)
+    slow = _mirror(http_stub, delay=1.5)
+    fast = _mirror(http_stub)
+    text, elapsed = _race([f"{slow.url}/sub", f"{fast.url}/sub"])
+    assert text.encode() == CONFIG and elapsed < 1.0
+
+    stats = clash_app.MirrorStats.load()
+    assert stats.urls[f"{fast.url}/sub"]["ok"] == 1
+    # в следующий раз быстрое зеркало стартует первым
+    assert stats.rank([f"{slow.url}/sub", f"{fast.url}/sub"])[0] == f"{fast.url}/sub"
+
+
+def test_failure_starts_next_mirror_without_waiting(app_dir, qapp, http_stub, stagger):
+    stagger(5.0)
+    broken = _mirror(http_stub, status=502)
+    blocked = _mirror(http_stub, body=b"<!DOCTYPE html><html>captcha</html>")
+    good = _mirror(http_stub)
+    text, elapsed = _race([f"{broken.url}/sub", f"{blocked.url}/sub", f"{good.url}/sub"])
+    assert text.encode() == CONFIG and elapsed < 2.0
+    stats = clash_app.MirrorStats.load()
+    assert stats.urls[f"{broken.url}/sub"]["fail"] == 1
+    assert stats.urls[f"{blocked.url}/sub"]["fail"] == 1
+
+
+def test_all_mirrors_failing_raises_primary_error(app_dir, qapp, http_stub, stagger):
+    stagger(0.1)
+    first = _mirror(http_stub, status=503)
+    second = _mirror(http_stub, status=404)
+    with pytest.raises(requests.exceptions.HTTPError, match="503"):
+        _race([f"{first.url}/sub", f"{second.url}/sub"])
@@ -0,0 +1,15 @@
+import clash_app
+
+
+def test_only_groups_health_check_provider_nodes():
+    proxies = [{"name": f"HK {i}", "type": "ss", "server": f"s{i}", "port": 1} for i in range(3)]
+    config = {"proxies": proxies, "proxy-groups": [
+        clash_app.tune_group({"name": "Auto", "type": "url-test",
+                              "proxies": [p["name"] for p in proxies]}, len(proxies)),
+    ]}
+    base, shards = clash_app.split_providers(config, {p["name"]: "HK" for p in proxies}, 7890)
+    assert shards
+    for provider in base["proxy-providers"].values():
+        assert provider["health-check"]["enable"] is False
+    group = base["proxy-groups"][0]
+    assert group["use"] == list(shards) and group["interval"] > 0
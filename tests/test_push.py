@@ -0,0 +1,120 @@
+import json
+import threading
+import time
+
+import pytest
+
+import clash_app
+
+
+@pytest.fixture(autouse=True)
+def fast_push(monkeypatch):
+    monkeypatch.setattr(clash_app, "PUSH_DEBOUNCE", 0.05)
+    monkeypatch.setattr(clash_app, "PUSH_BACKOFF", 0.01)
+
+
+class Log:
+    def __init__(self):
+        self.lines = []
+        self.done = threading.Event()
+
+    def __call__(self, msg, level):
+        self.lines.append((msg, level))
+        self.done.set()
+
+
+def _pushes(core):
+    return [(r["method"], r["path"]) for r in core.requests if r["method"] == "PUT"]
+
+
+def test_debounced_config_reload(http_stub):
+    core = http_stub(lambda request: (204, b""))
+    log = Log()
+    pusher = clash_app.ReloadPusher(log)
+    api = clash_app.ClashController(core.address)
+    pusher.schedule(api, "old: 1\n")
+    pusher.schedule(api, "new: 2\n")
+    assert log.done.wait(2)
+    assert _pushes(core) == [("PUT", "/configs")]
+    assert json.loads(core.requests[0]["body"])["payload"] == "new: 2\n"
+    assert core.requests[0]["query"] == {"force": "true"}
+    assert log.lines[0][1] == "success"
+
+
+def test_partial_failure_retries_only_failed_providers(http_stub):
+    failures = {"hk": 1}
+
+    def handler(request):
+        name = request["path"].rsplit("/", 1)[1]
+        if failures.get(name):
+            failures[name] -= 1
+            return 503, b""
+        return 204, b""
+
+    core = http_stub(handler)
+    log = Log()
+    pusher = clash_app.ReloadPusher(log)
+    pusher.schedule(clash_app.ClashController(core.address), None, ["hk", "jp", "us"])
+    assert log.done.wait(2)
+    assert [p for _m, p in _pushes(core)] == [
+        "/providers/proxies/hk", "/providers/proxies/jp", "/providers/proxies/us",
+        "/providers/proxies/hk",
+    ]
+    assert log.lines == [(log.lines[0][0], "success")]
+    assert "провайдеры (3)" in log.lines[0][0]
+
+
+def test_giving_up_names_failed_providers(http_stub):
+    core = http_stub(lambda request: (503, b"") if request["path"].endswith("/jp") else (204, b""))
+    log = Log()
+    pusher = clash_app.ReloadPusher(log)
+    pusher.schedule(clash_app.ClashController(core.address), None, ["hk", "jp"])
+    assert log.done.wait(2)
+    assert len(_pushes(core)) == 1 + clash_app.PUSH_RETRIES
+    assert log.lines[0][1] == "warning" and "jp" in log.lines[0][0]
+
+
+def test_empty_provider_set_is_not_pushed(http_stub):
+    core = http_stub(lambda request: (204, b""))
+    log = Log()
+    pusher = clash_app.ReloadPusher(log)
+    pusher.schedule(clash_app.ClashController(core.address), None, [])
+    time.sleep(0.3)
+    assert core.requests == [] and log.lines == []
+
+
+def test_restart_does_not_push_unchanged_config(app_dir, qapp, http_stub):
+    body = {"text": ""}
+
+    def handler(request):
+        if request["path"] == "/sub":
+            return 200, body["text"].encode("utf-8")
+        return 204, b""
+
+    core = http_stub(handler)
+    body["text"] = (f"external-controller: {core.address}\n"
+                    "proxies:\n  - {name: a, type: ss, server: s, port: 1, "
+                    "cipher: aes-128-gcm, password: p}\n"
+                    "proxy-groups:\n  - {name: Sel, type: select, proxies: [a]}\n")
+    options = {"port": 1, "push_reload": True, "latency_order": False,
+               "dns_prefetch": False, "dns_pin": False, "record_upstream": False}
+
+    def convert():
+        worker = clash_app.ConvertWorker()
+        job = clash_app.ConvertJob(f"{core.url}/sub", options, 30)
+        job.begin()
+        worker._run_job(job)
+        assert job.ok
+        time.sleep(0.3)     # PUSH_DEBOUNCE и сама отправка
+
+    convert()
+    assert _pushes(core) == [("PUT", "/configs")]
+
+    # перезапуск: снимок из файлов, та же подписка — Clash уже всё знает
+    clash_app.publish_snapshot(clash_app.load_snapshot())
+    convert()
+    assert len(_pushes(core)) == 1
+
+    body["text"] = body["text"].replace("port: 1", "port: 2")
+    convert()
+    assert len(_pushes(core)) == 2
@@ -0,0 +1,33 @@
+import pytest
+
+import clash_app
+
+
+@pytest.mark.parametrize("name, region", [
+    ("🇭🇰 HK 01", "HK"),
+    ("🇺🇳 Hong Kong", "HK"),          # флаг без своей группы не заслоняет название
+    ("🇺🇳 🇺🇸 relay", "US"),
+    ("Indiana US", "US"),              # латиница — целыми словами
+    ("India 01", "IN"),
+    ("ИНДИЯ-2", "IN"),
+    ("Франции узел", "FR"),            # русские основы — с известными окончаниями
+    ("Южная Корея-2", "KR"),
+    ("английский", "GB"),
+    ("Индивидуальный сервер", None),
+    ("Коренной VIP", None),
+    ("Англиканский приход", None),
+    ("HongKong02", "HK"),
+    ("香港节点01", "HK"),               # иероглифы без границ слов
+    ("JP-Tokyo-1", "JP"),
+    ("Türkiye 1", "TR"),
+    ("America Relay", None),           # континенты — не регион
+    ("Южная Америка", None),
+    ("node-1", None),
+])
+def test_classify_region(name, region):
+    assert clash_app.classify_region(name) == region
+
+
+def test_russian_region_names_are_recognized():
+    for code, (ru, _keywords) in clash_app.REGIONS.items():
+        assert clash_app.classify_region(ru) == code, ru
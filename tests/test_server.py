@@ -0,0 +1,56 @@
+import socket
+
+import pytest
+import requests
+
+import clash_app
+
+
+def _listening(port=0):
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", port))
+    sock.listen()
+    return sock
+
+
+def _busy_pair():
+    """Занятый порт, за которым следующий свободен."""
+    for _ in range(20):
+        sock = _listening()
+        port = sock.getsockname()[1]
+        try:
+            socket.create_server(("127.0.0.1", port + 1)).close()
+        except OSError:
+            sock.close()
+            continue
+        return sock, port
+    pytest.skip("не нашлось двух соседних портов")
+
+
+def test_busy_port_falls_back_to_next():
+    blocker, port = _busy_pair()
+    with blocker:
+        server = clash_app.bind_server(port, span=2)
+        try:
+            assert server.server_address[1] == port + 1
+        finally:
+            server.server_close()
+
+
+def test_all_ports_busy_raises():
+    blocker, port = _busy_pair()
+    with blocker, _listening(port + 1):
+        with pytest.raises(OSError):
+            clash_app.bind_server(port, span=2)
+
+
+def test_port_zero_reports_the_bound_port(app_dir):
+    clash_app.publish_snapshot(clash_app.Snapshot(clash_app.snapshot_files("proxies: []\n")))
+    server = clash_app.start_server(0)
+    try:
+        port = server.server_address[1]
+        assert port != 0
+        resp = requests.get(f"http://127.0.0.1:{port}/{clash_app.OUTPUT_FILE.name}", timeout=5)
+        assert resp.status_code == 200
+    finally:
+        clash_app.stop_server()
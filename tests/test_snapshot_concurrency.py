@@ -0,0 +1,85 @@
+"""
+Стресс: снимки публикуются без пауз, клиенты параллельно читают конфиг,
+провайдер и /sub.txt. Заголовок трафика и тело любого ответа должны быть
+из одного поколения — ни рваных тел, ни чужих заголовков.
+"""
+import base64
+import os
+import re
+import threading
+import time
+
+import pytest
+import requests
+
+import clash_app
+
+DURATION = float(os.environ.get("STRESS_SECONDS", "2"))
+
+
+def _snapshot(gen: int) -> clash_app.Snapshot:
+    proxy = {"name": f"a{gen}", "type": "ss", "server": "s", "port": 1,
+             "cipher": "aes-128-gcm", "password": "p"}
+    base = (f"# gen {gen}\nproxies:\n  - {{name: a{gen}, type: ss, server: s, port: 1, "
+            f"cipher: aes-128-gcm, password: p}}\nproxy-groups: []\n")
+    files = clash_app.snapshot_files(base, {"hk": f"# gen {gen}\nproxies: []\n"})
+    return clash_app.Snapshot(files, f"upload={gen}; download=0; total=1", {"upload": gen},
+                              time.time(), {}, clash_app.pack_blob({"proxies": [proxy]}))
+
+
+def _generation(path: str, body: bytes) -> int:
+    if path == "/sub.txt":
+        return int(re.search(r"#a(\d+)", base64.b64decode(body).decode()).group(1))
+    return int(re.search(rb"# gen (\d+)", body).group(1))
+
+
+def test_headers_and_bodies_come_from_one_snapshot(app_dir):
+    clash_app.publish_snapshot(_snapshot(0))
+    port = clash_app.start_server(0).server_address[1]
+    stop = threading.Event()
+    served, torn, errors = [0], [], []
+
+    def publisher():
+        gen = 0
+        while not stop.is_set():
+            gen += 1
+            clash_app.publish_snapshot(_snapshot(gen))
+            time.sleep(0.0005)
+
+    def client(path):
+        session = requests.Session()
+        try:
+            while not stop.is_set():
+                resp = session.get(f"http://localhost:{port}{path}", timeout=10)
+                header = resp.headers["subscription-userinfo"]
+                gen = int(re.search(r"upload=(\d+)", header).group(1))
+                served[0] += 1
+                if gen != _generation(path, resp.content):
+                    torn.append((path, gen))
+        except Exception as e:  # ошибку клиента показываем в assert
+            errors.append(repr(e))
+
+    paths = ["/clean.yaml"] * 4 + ["/providers/hk.yaml"] * 2 + ["/sub.txt"] * 2
+    threads = [threading.Thread(target=publisher)]
+    threads += [threading.Thread(target=client, args=(p,)) for p in paths]
+    try:
+        for t in threads:
+            t.start()
+        time.sleep(DURATION)
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+        clash_app.stop_server()
+
+    assert not errors
+    assert served[0] > 100
+    assert torn == []
+
+
+def test_snapshot_is_immutable():
+    snapshot = _snapshot(1)
+    with pytest.raises(AttributeError):
+        snapshot.sub_header = "x"
+    with pytest.raises(TypeError):
+        snapshot.files["/clean.yaml"] = (b"", "", "")
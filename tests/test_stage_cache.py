@@ -0,0 +1,52 @@
+import clash_app
+
+
+def _source(n=40):
+    names = [f"🇭🇰 HK {i}" if i % 2 else f"🇯🇵 JP {i}" for i in range(n)]
+    return {
+        "proxies": [{"name": name, "type": "ss", "server": f"h{i}.example", "port": 1,
+                     "cipher": "aes-128-gcm", "password": "p"} for i, name in enumerate(names)],
+        "proxy-groups": [{"name": "Выбор", "type": "select", "proxies": names}],
+    }
+
+
+OPTIONS = {"region_groups": True, "split_groups": True}
+
+
+def test_cache_keeps_only_keys_in_memory(app_dir):
+    clash_app.clear_stage_cache()
+    first, _ = clash_app.process_config(_source(), OPTIONS, None, "k1")
+    assert all(isinstance(key, str) for key in clash_app._stage_cache.values())
+    assert sorted(p.stem for p in clash_app.STAGE_CACHE_DIR.glob("*.bin")) == sorted(clash_app.PIPELINE)
+
+    def no_source():
+        raise AssertionError("источник не должен разбираться при полном попадании")
+
+    again, stats = clash_app.process_config(no_source, OPTIONS, None, "k1")
+    assert all(stats["stages"].values())
+    assert again == first
+
+
+def test_lost_blob_is_recomputed(app_dir):
+    clash_app.clear_stage_cache()
+    first, _ = clash_app.process_config(_source(), OPTIONS, None, "k1")
+    (clash_app.STAGE_CACHE_DIR / "proxies.bin").unlink()
+    again, stats = clash_app.process_config(_source, OPTIONS, None, "k1")
+    assert again == first and not stats["stages"]["proxies"]
+
+
+def test_order_keyed_on_latency_version(app_dir):
+    clash_app.clear_stage_cache()
+    latency = clash_app.LatencyHistory()
+    clash_app.process_config(_source(), OPTIONS, latency, "k1")
+    _, stats = clash_app.process_config(_source, OPTIONS, latency, "k1")
+    assert stats["stages"]["order"]
+
+    latency.record("any", 120)
+    _, stats = clash_app.process_config(_source, OPTIONS, latency, "k1")
+    assert stats["stages"]["region_groups"] and not stats["stages"]["order"]
+
+    # версия переживает сохранение: новый процесс не спутает историю с прежней
+    latency.names = {"x": "any"}
+    latency.save()
+    assert clash_app.LatencyHistory.load().version == latency.version
@@ -0,0 +1,45 @@
+import pytest
+
+import clash_app
+
+
+def _accepted(transform, names):
+    hits = {}
+    kept = [n for n in names if transform.accept({"name": n}, hits)]
+    return kept, hits
+
+
+def test_rules_with_same_named_group_are_checked_apart():
+    t = clash_app.ProxyTransform({"include": [{"regex": "(?P<x>a)"}, {"regex": "(?P<x>b)"}]})
+    kept, hits = _accepted(t, ["a", "b", "c"])
+    assert kept == ["a", "b"]
+    assert hits == {"include0": 1, "include1": 1}
+
+
+def test_backreferences_keep_their_meaning():
+    t = clash_app.ProxyTransform({
+        "exclude": [{"regex": r"(a)\1"}, {"regex": r"(b)\1"}],
+        "rename": [{"regex": r"(x)\1", "replace": "y"}],
+    })
+    kept, hits = _accepted(t, ["aa", "bb", "ab", "a"])
+    assert kept == ["ab", "a"]
+    assert hits == {"exclude0": 1, "exclude1": 1}
+    assert t.rename_gate is None                     # гейт не склеить — проверяются все
+
+
+def test_escaped_backslash_is_not_a_backreference():
+    t = clash_app.ProxyTransform({"include": [{"regex": r"\\1"}, {"keyword": "hk"}]})
+    assert len(t.include) == 1
+    assert _accepted(t, ["a\\1", "HK 1", "a1"])[0] == ["a\\1", "HK 1"]
+
+
+def test_broken_rule_is_reported_by_label():
+    with pytest.raises(ValueError, match="Правило"):
+        clash_app.ProxyTransform({"include": [{"regex": "(a"}]})
+
+
+def test_failed_join_names_the_rules(monkeypatch):
+    monkeypatch.setattr(clash_app, "_combinable", lambda rx: True)
+    with pytest.raises(ValueError, match="не собираются") as e:
+        clash_app.ProxyTransform({"include": [{"regex": "(?P<x>a)"}, {"regex": "(?P<x>b)"}]})
+    assert "(?P<x>a)" in str(e.value) and "(?P<x>b)" in str(e.value)